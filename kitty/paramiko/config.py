@@ -23,25 +23,52 @@ Configuration file (aka ``ssh_config``) support.
 
 import fnmatch
 import getpass
+import glob
+import heapq
+import marshal
 import os
 import re
 import shlex
 import socket
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import ItemsView, ValuesView
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
-from io import StringIO
-from functools import partial
-
-invoke, invoke_import_error = None, None
-try:
-    import invoke
-except ImportError as e:
-    invoke_import_error = e
+from io import BytesIO, StringIO, TextIOWrapper
+from functools import lru_cache, partial
 
 from .ssh_exception import CouldNotCanonicalize, ConfigParseError
 
 
 SSH_PORT = 22
 
+# Same limit as OpenSSH's READCONF_MAX_DEPTH
+MAX_INCLUDE_DEPTH = 16
+
+# Bumped whenever the structure of parsed configs changes, to invalidate files
+# written by `SSHConfig.from_path` to its ``cache_dir``
+CACHE_FORMAT = 1
+
+# How long (in seconds) the local hostname and FQDN are cached for, and for
+# how long an FQDN lookup may block before falling back to the hostname (see
+# `LocalHostResolver`)
+LOCAL_HOST_TTL = 300
+LOCAL_FQDN_TIMEOUT = 1.0
+
+# How long (in seconds) the outcome of resolving a candidate hostname during
+# canonicalization is cached for, when found and when not (see `HostResolver`)
+CANONICAL_TTL = 300
+CANONICAL_NEGATIVE_TTL = 30
+
+# How long (in seconds) a 'Match exec' command may run before it is killed and
+# deemed to have failed, and for how long its outcome is cached (see
+# `MatchExecutor`)
+MATCH_EXEC_TIMEOUT = 5.0
+MATCH_EXEC_TTL = 10
+
 
 class SSHConfig:
     """
@@ -59,17 +86,32 @@ class SSHConfig:
     # TODO: do a full scan of ssh.c & friends to make sure we're fully
     # compatible across the board, e.g. OpenSSH 8.1 added %n to ProxyCommand.
     TOKENS_BY_CONFIG_KEY = {
-        "controlpath": ["%C", "%h", "%l", "%L", "%n", "%p", "%r", "%u"],
-        "hostname": ["%h"],
-        "identityfile": ["%C", "~", "%d", "%h", "%l", "%u", "%r"],
-        "proxycommand": ["~", "%h", "%p", "%r"],
-        "proxyjump": ["%h", "%p", "%r"],
+        "controlpath": [
+            "%%", "%C", "%h", "%i", "%j", "%k", "%l", "%L", "%n", "%p", "%r",
+            "%u",
+        ],
+        "hostname": ["%%", "%h"],
+        "identityfile": [
+            "%%", "%C", "~", "%d", "%h", "%i", "%j", "%k", "%l", "%L", "%n",
+            "%u", "%r",
+        ],
+        "localcommand": [
+            "%%", "%C", "%d", "%h", "%i", "%j", "%k", "%L", "%l", "%n", "%p",
+            "%r", "%T", "%u",
+        ],
+        "proxycommand": ["%%", "~", "%h", "%n", "%p", "%r"],
+        "proxyjump": ["%%", "%h", "%n", "%p", "%r"],
         # Doesn't seem worth making this 'special' for now, it will fit well
         # enough (no actual match-exec config key to be confused with).
-        "match-exec": ["%C", "%d", "%h", "%L", "%l", "%n", "%p", "%r", "%u"],
+        "match-exec": [
+            "%%", "%C", "%d", "%h", "%i", "%j", "%k", "%L", "%l", "%n", "%p",
+            "%r", "%u",
+        ],
     }
 
-    def __init__(self):
+    def __init__(
+        self, lookup_cache_size=0, resolver=None, match_executor=None
+    ):
         """
         Create a new OpenSSH config object.
 
@@ -87,36 +129,93 @@ class SSHConfig:
             config = SSHConfig.from_path("some-path.config")
             # Or if you have arbitrary ssh_config text from some other source:
             config = SSHConfig.from_text("Host foo\\n\\tUser bar")
+
+        :param int lookup_cache_size:
+            Maximum number of `lookup` results to memoize, keyed by hostname.
+            The default of ``0`` disables the cache. The cache is flushed
+            whenever `parse` is called, and results which depended on ``Match
+            exec`` or on hostname canonicalization are never cached.
+        :param resolver:
+            The `HostResolver` to canonicalize hostnames with. By default, one
+            shared by the whole process, which resolves with `socket`.
+        :param match_executor:
+            The `MatchExecutor` to run ``Match exec`` commands with. By
+            default, one shared by the whole process.
         """
         self._config = []
+        # Absolute Include patterns -> files they matched
+        self._includes = {}
+        # Included files -> SHA-1 of the contents they were parsed from
+        self._include_digests = {}
+        # Compiled host patterns per stanza (see `_index_config`)
+        self._host_patterns = []
+        self._literal_index = {}
+        self._unindexed = []
+        # Compiled token templates per (key, value) (see `_template`)
+        self._templates = {}
+        self._lookup_cache_size = lookup_cache_size
+        self._lookup_cache = OrderedDict()
+        self._lookup_cache_lock = threading.Lock()
+        self._resolver = resolver if resolver is not None else _host_resolver
+        if match_executor is None:
+            match_executor = _match_executor
+        self._match_executor = match_executor
 
     @classmethod
-    def from_text(cls, text):
+    def from_text(cls, text, **kwargs):
         """
         Create a new, parsed `SSHConfig` from ``text`` string.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
         .. versionadded:: 2.7
         """
-        return cls.from_file(StringIO(text))
+        return cls.from_file(StringIO(text), **kwargs)
 
     @classmethod
-    def from_path(cls, path):
+    def from_path(cls, path, cache_dir=None, **kwargs):
         """
         Create a new, parsed `SSHConfig` from the file found at ``path``.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
+        :param str cache_dir:
+            Directory in which to keep a marshalled copy of the parsed config,
+            so that other processes can load it instead of parsing the file
+            again. The copy is keyed by the contents of the file and of all
+            files it includes, and ignored when any of them changed or when it
+            can't be read. By default, nothing is cached.
+
         .. versionadded:: 2.7
         """
-        with open(path) as flo:
-            return cls.from_file(flo)
+        if cache_dir is None:
+            with open(path) as flo:
+                return cls.from_file(flo, **kwargs)
+
+        obj = cls(**kwargs)
+        with open(path, "rb") as flo:
+            data = flo.read()
+        cache_file = os.path.join(
+            cache_dir,
+            sha1(os.path.abspath(path).encode()).hexdigest() + ".marshal",
+        )
+        base_dir = _include_base_dir(path)
+        if not obj._load_cache(cache_file, data, base_dir):
+            # Decoded the same way as by open() in text mode
+            obj._parse(TextIOWrapper(BytesIO(data)), base_dir)
+            obj._save_cache(cache_file, data, base_dir)
+        return obj
 
     @classmethod
-    def from_file(cls, flo):
+    def from_file(cls, flo, **kwargs):
         """
         Create a new, parsed `SSHConfig` from file-like object ``flo``.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
         .. versionadded:: 2.7
         """
-        obj = cls()
+        obj = cls(**kwargs)
         obj.parse(flo)
         return obj
 
@@ -124,12 +223,124 @@ class SSHConfig:
         """
         Read an OpenSSH config from the given file object.
 
+        ``Include`` directives are followed, with glob patterns and paths
+        relative to ``~/.ssh`` (or ``/etc/ssh`` for files within it) just like
+        in OpenSSH, up to `MAX_INCLUDE_DEPTH` levels deep.
+
         :param file_obj: a file-like object to read the config file from
         """
+        base_dir = _include_base_dir(getattr(file_obj, "name", None))
+        self._parse(file_obj, base_dir)
+
+    def _parse(self, file_obj, base_dir):
+        # Previous lookup results may not hold anymore
+        with self._lookup_cache_lock:
+            self._lookup_cache.clear()
         # Start out w/ implicit/anonymous global host-like block to hold
         # anything not contained by an explicit one.
         context = {"host": ["*"], "config": {}}
-        for line in file_obj:
+        context = self._apply_lines(
+            self._read_lines(file_obj), context, base_dir, depth=0
+        )
+        # Store last 'open' block and we're done
+        if "config" in context:
+            self._config.append(context)
+        self._index_config()
+
+    def _load_cache(self, cache_file, data, base_dir):
+        """
+        Load the config from ``cache_file``, written by `_save_cache`.
+
+        :param bytes data: Contents of the config file.
+        :returns:
+            Whether the cache was loaded, i.e. it could be read and neither the
+            config file nor any of its included files changed since.
+        """
+        try:
+            with open(cache_file, "rb") as flo:
+                cached = marshal.loads(flo.read())
+            (
+                format_,
+                digest,
+                cached_base_dir,
+                includes,
+                deps,
+                config,
+                index,
+            ) = cached
+            if (
+                format_ != CACHE_FORMAT
+                or digest != sha1(data).hexdigest()
+                or cached_base_dir != base_dir
+            ):
+                return False
+            for pattern, paths in includes.items():
+                if sorted(glob.glob(pattern)) != paths:
+                    return False
+            for path, dep_digest in deps.items():
+                with open(path, "rb") as flo:
+                    if sha1(flo.read()).hexdigest() != dep_digest:
+                        return False
+            # Host patterns are compiled on demand, as most are never needed
+            self._config = config
+            self._includes = includes
+            self._include_digests = deps
+            self._literal_index, self._unindexed = index
+            self._host_patterns = [None] * len(config)
+        except Exception:
+            # Unreadable, corrupt or written in an unknown format; parsing the
+            # config again is always safe
+            self._config = []
+            self._includes = {}
+            self._include_digests = {}
+            self._literal_index, self._unindexed = {}, []
+            return False
+        return True
+
+    def _save_cache(self, cache_file, data, base_dir):
+        """
+        Write the parsed config to ``cache_file``, for `_load_cache`.
+        """
+        try:
+            # The digests of what was parsed, and not of the files as they are
+            # now, which may have changed since
+            deps = self._include_digests
+            if None in deps.values():
+                # A file changed while it was being included several times
+                return
+            cached = marshal.dumps(
+                (
+                    CACHE_FORMAT,
+                    sha1(data).hexdigest(),
+                    base_dir,
+                    self._includes,
+                    deps,
+                    self._config,
+                    (self._literal_index, self._unindexed),
+                )
+            )
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Replace the file atomically, so that it's never read half-written
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_file, "wb") as flo:
+                flo.write(cached)
+            os.replace(tmp_file, cache_file)
+        except (OSError, ValueError):
+            # Caching is best effort
+            pass
+
+    def _read_lines(self, file_obj):
+        """
+        Read a config file into a list of ``(key, value)`` tuples.
+
+        Keys are lowercased, and values are processed according to the key,
+        e.g. ``Host`` values are split into a list of patterns.
+        """
+        # Splitting the whole buffer is much faster than iterating over lines,
+        # and yields the same lines ("\n" is what both split on)
+        read = getattr(file_obj, "read", None)
+        lines = []
+        for line in read().split("\n") if read is not None else file_obj:
             # Strip any leading or trailing whitespace from the line.
             # Refer to https://github.com/paramiko/paramiko/issues/499
             line = line.strip()
@@ -137,16 +348,70 @@ class SSHConfig:
             if not line or line.startswith("#"):
                 continue
 
-            # Parse line into key, value
-            match = re.match(self.SETTINGS_REGEX, line)
-            if not match:
-                raise ConfigParseError("Unparsable line {}".format(line))
-            key = match.group(1).lower()
-            value = match.group(2)
+            # Parse line into key, value. The common "Key value" and
+            # "Key=value" forms are split without a regex, in ways that give
+            # the same results as SETTINGS_REGEX.
+            key, _, value = line.partition(" ")
+            if not (
+                key.isalnum()
+                and value
+                and value[0] != "="
+                and not value[0].isspace()
+            ):
+                key, _, value = line.partition("=")
+                if not (key.isalnum() and value and not value[0].isspace()):
+                    match = re.match(self.SETTINGS_REGEX, line)
+                    if not match:
+                        raise ConfigParseError(
+                            "Unparsable line {}".format(line)
+                        )
+                    key = match.group(1)
+                    value = match.group(2)
+            key = key.lower()
+
+            if key == "host":
+                value = self._get_hosts(value)
+            elif key == "match":
+                value = self._get_matches(value)
+            elif key == "include":
+                try:
+                    value = _split_words(value)
+                except ValueError:
+                    raise ConfigParseError(
+                        "Unparsable include {}".format(value)
+                    )
+            # Special-case for noop ProxyCommands
+            elif key == "proxycommand" and value.lower() == "none":
+                # Store 'none' as None - not as a string implying that the
+                # proxycommand is the literal shell command "none"!
+                value = None
+            elif value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            lines.append((key, value))
+        return lines
 
+    def _apply_lines(self, lines, context, base_dir, depth, guard=None):
+        """
+        Add the stanzas described by ``lines`` (from `_read_lines`) to the
+        config.
+
+        :param context:
+            The context which is open at the start of ``lines``. Contexts
+            without a ``"config"`` key yet are only added to the config once
+            an option is set in them.
+        :param guard:
+            Condition (``"host"`` or ``"matches"``, and maybe a ``"guard"`` of
+            its own) which stanzas started by ``lines`` additionally need to
+            match, for files included from within a ``Host`` or ``Match``
+            block.
+
+        :returns: The context which is still open at the end of ``lines``.
+        """
+        for key, value in lines:
             # Host keyword triggers switch to new block/context
             if key in ("host", "match"):
-                self._config.append(context)
+                if "config" in context:
+                    self._config.append(context)
                 context = {"config": {}}
                 if key == "host":
                     # TODO 4.0: make these real objects or at least name this
@@ -154,19 +419,17 @@ class SSHConfig:
                     # to 3.0, despite it being a private API, feels bad -
                     # surely such an old codebase has folks actually relying on
                     # these keys.)
-                    context["host"] = self._get_hosts(value)
+                    context["host"] = value[:]
                 else:
-                    context["matches"] = self._get_matches(value)
-            # Special-case for noop ProxyCommands
-            elif key == "proxycommand" and value.lower() == "none":
-                # Store 'none' as None - not as a string implying that the
-                # proxycommand is the literal shell command "none"!
-                context["config"][key] = None
+                    context["matches"] = value
+                if guard is not None:
+                    context["guard"] = guard
+            elif key == "include":
+                context = self._include(value, context, base_dir, depth)
             # All other keywords get stored, directly or via append
             else:
-                if value.startswith('"') and value.endswith('"'):
-                    value = value[1:-1]
-
+                if "config" not in context:
+                    context = dict(context, config={})
                 # identityfile, localforward, remoteforward keys are special
                 # cases, since they are allowed to be specified multiple times
                 # and they should be tried in order of specification.
@@ -175,12 +438,142 @@ class SSHConfig:
                         context["config"][key].append(value)
                     else:
                         context["config"][key] = [value]
+                # A noop ProxyCommand (None, see _read_lines) overrides any
+                # earlier ProxyCommand of the stanza.
+                elif key == "proxycommand" and value is None:
+                    context["config"][key] = None
                 elif key not in context["config"]:
                     context["config"][key] = value
-        # Store last 'open' block and we're done
-        self._config.append(context)
+        return context
+
+    def _include(self, patterns, context, base_dir, depth):
+        """
+        Handle an ``Include`` of ``patterns`` within the open ``context``.
+
+        Like in OpenSSH, included files are read as if their contents were
+        found in place of the ``Include``: their leading options belong to the
+        enclosing block, and their stanzas only apply when that block does.
+        Each file is only parsed again when it changed (see `_read_fragment`).
+
+        :returns:
+            The context in which the rest of the enclosing block continues.
+        """
+        if depth >= MAX_INCLUDE_DEPTH:
+            raise ConfigParseError(
+                "Maximum Include depth of {} exceeded".format(
+                    MAX_INCLUDE_DEPTH
+                )
+            )
+        if "config" in context:
+            self._config.append(context)
+        condition = {
+            key: context[key]
+            for key in ("host", "matches", "guard")
+            if key in context
+        }
+        # No need to check the implicit global block
+        guard = None if condition == {"host": ["*"]} else condition
+        for pattern in patterns:
+            pattern = os.path.join(base_dir, os.path.expanduser(pattern))
+            paths = sorted(glob.glob(pattern))
+            self._includes[pattern] = paths
+            for path in paths:
+                lines, digest = _read_fragment(self, path)
+                if self._include_digests.get(path, digest) != digest:
+                    digest = None
+                self._include_digests[path] = digest
+                # Each file starts back in the enclosing block, like OpenSSH
+                # does, rather than in the last block of the previous file
+                context = self._apply_lines(
+                    lines,
+                    condition,
+                    base_dir,
+                    depth + 1,
+                    guard,
+                )
+                if "config" in context:
+                    self._config.append(context)
+        return condition
 
-    def lookup(self, hostname):
+    def get_includes(self):
+        """
+        Return a dict of the ``Include`` patterns (made absolute) seen while
+        parsing, mapped to the sorted list of files each of them matched.
+        """
+        return {
+            pattern: paths[:] for pattern, paths in self._includes.items()
+        }
+
+    def _index_config(self):
+        """
+        Precompile the ``Host`` patterns of all stanzas.
+
+        Literal patterns are put into a map from hostname to the stanzas they
+        occur in, so that `_lookup` only has to evaluate those stanzas, plus
+        the ones which can't be indexed: stanzas with wildcard patterns (which
+        are compiled to a regex instead) and ``Match`` stanzas.
+
+        The token templates of their values are compiled along the way.
+        """
+        host_patterns, literal_index, unindexed = [], {}, []
+        for i, context in enumerate(self._config):
+            self._compile_templates(context)
+            if "host" not in context:
+                # Match criteria depend on the options obtained so far
+                host_patterns.append(None)
+                unindexed.append(i)
+                continue
+            patterns = _compile_patterns(tuple(context["host"]))
+            host_patterns.append(patterns)
+            literals, wildcards, _ = patterns
+            if wildcards is not None:
+                unindexed.append(i)
+                continue
+            # Stanzas with nothing but negated patterns never match
+            for literal in literals:
+                literal_index.setdefault(literal, []).append(i)
+        self._host_patterns = host_patterns
+        self._literal_index = literal_index
+        self._unindexed = unindexed
+
+    def _compile_templates(self, context):
+        """
+        Compile the token templates of the values of a stanza, for keys which
+        support tokens.
+        """
+        for key, value in context.get("config", {}).items():
+            if key not in self.TOKENS_BY_CONFIG_KEY or value is None:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                self._template(key, item)
+        if "matches" in context:
+            for match in context["matches"]:
+                if match["type"] == "exec":
+                    self._template("match-exec", match["param"])
+
+    def _template(self, key, value):
+        """
+        Return the compiled token template of ``value`` for config ``key``.
+
+        Templates are compiled when parsing, except after loading a cached
+        config, in which case they're compiled (once) on first use.
+
+        :returns:
+            A `str.format` template expanding the tokens allowed for ``key``
+            from a `_TokenContext`, or ``None`` if ``value`` has none.
+        """
+        if "%" not in value and "~" not in value:
+            return None
+        try:
+            return self._templates[key, value]
+        except KeyError:
+            pass
+        tokens = tuple(self._allowed_tokens(key))
+        template = _compile_template(value, tokens, key == "hostname")
+        self._templates[key, value] = template
+        return template
+
+    def lookup(self, hostname, lazy=False):
         """
         Return a dict (`SSHConfigDict`) of config options for a given hostname.
 
@@ -211,6 +604,9 @@ class SSHConfig:
             get to OpenSSH's behavior around that particular option.
 
         :param str hostname: the hostname to lookup
+        :param bool lazy:
+            Return a `LazySSHConfigDict`, which only expands the tokens of a
+            value when it is first read, instead of expanding them all upfront.
 
         .. versionchanged:: 2.5
             Returns `SSHConfigDict` objects instead of dict literals.
@@ -221,47 +617,162 @@ class SSHConfig:
         .. versionchanged:: 3.3
             Added ``Match final`` support.
         """
-        # First pass
-        options = self._lookup(hostname=hostname)
-        # Inject HostName if it was not set (this used to be done incidentally
-        # during tokenization, for some reason).
-        if "hostname" not in options:
-            options["hostname"] = hostname
-        # Handle canonicalization
-        canon = options.get("canonicalizehostname", None) in ("yes", "always")
-        maxdots = int(options.get("canonicalizemaxdots", 1))
-        if canon and hostname.count(".") <= maxdots:
-            # NOTE: OpenSSH manpage does not explicitly state this, but its
-            # implementation for CanonicalDomains is 'split on any whitespace'.
-            domains = options["canonicaldomains"].split()
-            hostname = self.canonicalize(hostname, options, domains)
-            # Overwrite HostName again here (this is also what OpenSSH does)
-            options["hostname"] = hostname
+        return self._lookup_all([hostname], _local_environment(), lazy=lazy)[0]
+
+    def lookup_many(self, hostnames, max_workers=None, lazy=False):
+        """
+        Return a list of `SSHConfigDict` objects for ``hostnames``, in order.
+
+        The results are the same as those of calling `lookup` for each of the
+        hostnames, but the local environment (user, hostname, home directory)
+        is only queried once for the whole batch.
+
+        :param hostnames: an iterable of hostnames to lookup
+        :param int max_workers:
+            If given, hostnames which need canonicalization are canonicalized
+            in parallel, in a pool of up to this many threads. Otherwise they
+            are canonicalized one after the other.
+        :param bool lazy: return `LazySSHConfigDict` objects, as with `lookup`
+        """
+        return self._lookup_all(
+            list(hostnames), _local_environment(), max_workers, lazy
+        )
+
+    def _lookup_all(self, hostnames, env, max_workers=None, lazy=False):
+        results = [None] * len(hostnames)
+        pending = []
+        for i, hostname in enumerate(hostnames):
+            if self._lookup_cache_size > 0:
+                with self._lookup_cache_lock:
+                    cached = self._lookup_cache.get(hostname)
+                    if cached is not None:
+                        self._lookup_cache.move_to_end(hostname)
+                        results[i] = _copy_options(cached, lazy)
+                        continue
+            # Keeps track of whether the result depends on anything but the
+            # config itself (e.g. the outcome of a 'Match exec' command)
+            volatile = set()
+            # First pass
             options = self._lookup(
-                hostname, options, canonical=True, final=True
+                hostname=hostname, volatile=volatile, env=env
             )
+            # Inject HostName if it was not set (this used to be done
+            # incidentally during tokenization, for some reason).
+            if "hostname" not in options:
+                options["hostname"] = hostname
+            pending.append((i, hostname, options, volatile))
+
+        # Handle canonicalization, which may involve slow DNS lookups
+        to_canonicalize = []
+        for j, (_, hostname, options, _) in enumerate(pending):
+            domains = self._canonical_domains(hostname, options)
+            if domains is not None:
+                to_canonicalize.append((j, hostname, options, domains))
+        args = [item[1:] for item in to_canonicalize]
+        if max_workers is not None and len(args) > 1:
+            with ThreadPoolExecutor(max_workers) as executor:
+                names = list(
+                    executor.map(lambda a: self.canonicalize(*a), args)
+                )
         else:
+            names = [self.canonicalize(*a) for a in args]
+        canonical_names = {
+            item[0]: name for item, name in zip(to_canonicalize, names)
+        }
+
+        # Final pass
+        for j, (i, hostname, options, volatile) in enumerate(pending):
+            canonical = j in canonical_names
+            if canonical:
+                hostname = canonical_names[j]
+                # Overwrite HostName again here (this is also what OpenSSH
+                # does)
+                options["hostname"] = hostname
+                volatile.add("canonical")
             options = self._lookup(
-                hostname, options, canonical=False, final=True
+                hostname,
+                options,
+                canonical=canonical,
+                final=True,
+                volatile=volatile,
+                env=env,
+                lazy=lazy,
             )
-        return options
+            if self._lookup_cache_size > 0 and not volatile:
+                self._cache_lookup(hostname, options)
+            results[i] = options
+        return results
 
-    def _lookup(self, hostname, options=None, canonical=False, final=False):
+    def _canonical_domains(self, hostname, options):
+        """
+        Return the domains to canonicalize ``hostname`` with, given the
+        ``options`` of the first lookup pass, or ``None`` if it isn't to be
+        canonicalized.
+        """
+        canon = options.get("canonicalizehostname", None) in ("yes", "always")
+        maxdots = int(options.get("canonicalizemaxdots", 1))
+        if canon and hostname.count(".") <= maxdots:
+            # NOTE: OpenSSH manpage does not explicitly state this, but its
+            # implementation for CanonicalDomains is 'split on any whitespace'.
+            return options["canonicaldomains"].split()
+        return None
+
+    def _cache_lookup(self, hostname, options):
+        with self._lookup_cache_lock:
+            self._lookup_cache[hostname] = _copy_options(options)
+            self._lookup_cache.move_to_end(hostname)
+            while len(self._lookup_cache) > self._lookup_cache_size:
+                self._lookup_cache.popitem(last=False)
+
+    def _lookup(
+        self,
+        hostname,
+        options=None,
+        canonical=False,
+        final=False,
+        volatile=None,
+        env=None,
+        lazy=False,
+    ):
         # Init
         if options is None:
             options = SSHConfigDict()
-        # Iterate all stanzas, applying any that match, in turn (so that things
-        # like Match can reference currently understood state)
-        for context in self._config:
-            if not (
-                self._pattern_matches(context.get("host", []), hostname)
-                or self._does_match(
-                    context.get("matches", []),
-                    hostname,
-                    canonical,
-                    final,
-                    options,
-                )
+        if env is None:
+            env = _local_environment()
+        # Iterate all stanzas which may apply, in file order, applying any that
+        # match, in turn (so that things like Match can reference currently
+        # understood state)
+        key = os.path.normcase(hostname)
+        literal_stanzas = self._literal_index.get(key, [])
+        for i in heapq.merge(literal_stanzas, self._unindexed):
+            context = self._config[i]
+            if "host" in context:
+                host_patterns = self._host_patterns[i]
+                if host_patterns is None:
+                    # Not compiled yet, see _load_cache()
+                    host_patterns = _compile_patterns(tuple(context["host"]))
+                    self._host_patterns[i] = host_patterns
+                if not _patterns_match(host_patterns, hostname):
+                    continue
+            elif not self._does_match(
+                context["matches"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
+            ):
+                continue
+            # Stanzas of files included from within a Host or Match block
+            if "guard" in context and not self._guard_matches(
+                context["guard"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
             ):
                 continue
             for key, value in context["config"].items():
@@ -278,9 +789,33 @@ class SSHConfig:
         if final:
             # Expand variables in resulting values
             # (besides 'Match exec' which was already handled above)
-            options = self._expand_variables(options, hostname)
+            options = self._expand_variables(options, hostname, env, lazy)
         return options
 
+    def _guard_matches(
+        self, guard, hostname, canonical, final, options, volatile, env
+    ):
+        """
+        Check the (nested) conditions of the blocks from within which a
+        stanza's file was included.
+        """
+        while guard is not None:
+            if "host" in guard:
+                if not self._pattern_matches(guard["host"], hostname):
+                    return False
+            elif not self._does_match(
+                guard["matches"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
+            ):
+                return False
+            guard = guard.get("guard")
+        return True
+
     def canonicalize(self, hostname, options, domains):
         """
         Return canonicalized version of ``hostname``.
@@ -291,28 +826,18 @@ class SSHConfig:
 
         :returns: A canonicalized hostname if one was found, else ``None``.
 
+        :raises: `CouldNotCanonicalize` if no domain resolves and
+            ``CanonicalizeFallbackLocal`` is not ``yes``.
+
         .. versionadded:: 2.7
         """
-        found = False
-        for domain in domains:
-            candidate = "{}.{}".format(hostname, domain)
-            family_specific = _addressfamily_host_lookup(candidate, options)
-            if family_specific is not None:
-                # TODO: would we want to dig deeper into other results? e.g. to
-                # find something that satisfies PermittedCNAMEs when that is
-                # implemented?
-                found = family_specific[0]
-            else:
-                # TODO: what does ssh use here and is there a reason to use
-                # that instead of gethostbyname?
-                try:
-                    found = socket.gethostbyname(candidate)
-                except socket.gaierror:
-                    pass
-            if found:
-                # TODO: follow CNAME (implied by found != candidate?) if
-                # CanonicalizePermittedCNAMEs allows it
-                return candidate
+        # All the candidates are resolved at once, but the first domain
+        # which resolves still wins, like it does in OpenSSH
+        candidates = ["{}.{}".format(hostname, domain) for domain in domains]
+        # TODO: follow CNAME if CanonicalizePermittedCNAMEs allows it
+        found = self._resolver.first(candidates, _address_family(options))
+        if found is not None:
+            return found
         # If we got here, it means canonicalization failed.
         # When CanonicalizeFallbackLocal is undefined or 'yes', we just spit
         # back the original hostname.
@@ -336,25 +861,23 @@ class SSHConfig:
         # Convenience auto-splitter if not already a list
         if hasattr(patterns, "split"):
             patterns = patterns.split(",")
-        match = False
-        for pattern in patterns:
-            # Short-circuit if target matches a negated pattern
-            if pattern.startswith("!") and fnmatch.fnmatch(
-                target, pattern[1:]
-            ):
-                return False
-            # Flag a match, but continue (in case of later negation) if regular
-            # match occurs
-            elif fnmatch.fnmatch(target, pattern):
-                match = True
-        return match
+        return _patterns_match(_compile_patterns(tuple(patterns)), target)
 
     def _does_match(
-        self, match_list, target_hostname, canonical, final, options
+        self,
+        match_list,
+        target_hostname,
+        canonical,
+        final,
+        options,
+        volatile=None,
+        env=None,
     ):
         matched = []
         candidates = match_list[:]
-        local_username = getpass.getuser()
+        if env is None:
+            env = _local_environment()
+        local_username = env["user"]
         while candidates:
             candidate = candidates.pop(0)
             passed = None
@@ -388,15 +911,12 @@ class SSHConfig:
             elif type_ == "localuser":
                 passed = self._pattern_matches(param, local_username)
             elif type_ == "exec":
+                if volatile is not None:
+                    volatile.add("exec")
                 exec_cmd = self._tokenize(
-                    options, target_hostname, "match-exec", param
+                    options, target_hostname, "match-exec", param, env
                 )
-                # This is the laziest spot in which we can get mad about an
-                # inability to import Invoke.
-                if invoke is None:
-                    raise invoke_import_error
-                # Like OpenSSH, we 'redirect' stdout but let stderr bubble up
-                passed = invoke.run(exec_cmd, hide="stdout", warn=True).ok
+                passed = self._match_executor.run(exec_cmd)
             # Tackle any 'passed, but was negated' results from above
             if passed is not None and self._should_fail(passed, candidate):
                 return False
@@ -408,7 +928,7 @@ class SSHConfig:
     def _should_fail(self, would_pass, candidate):
         return would_pass if candidate["negate"] else not would_pass
 
-    def _tokenize(self, config, target_hostname, key, value):
+    def _tokenize(self, config, target_hostname, key, value, env=None):
         """
         Tokenize a string based on current config/hostname data.
 
@@ -416,59 +936,19 @@ class SSHConfig:
         :param target_hostname: Original target connection hostname.
         :param key: Config key being tokenized (used to filter token list).
         :param value: Config value being tokenized.
+        :param env: Local environment, from `_local_environment`.
 
         :returns: The tokenized version of the input ``value`` string.
         """
-        allowed_tokens = self._allowed_tokens(key)
         # Short-circuit if no tokenization possible
-        if not allowed_tokens:
+        template = self._template(key, value)
+        if template is None:
             return value
-        # Obtain potentially configured hostname, for use with %h.
-        # Special-case where we are tokenizing the hostname itself, to avoid
-        # replacing %h with a %h-bearing value, etc.
-        configured_hostname = target_hostname
-        if key != "hostname":
-            configured_hostname = config.get("hostname", configured_hostname)
-        # Ditto the rest of the source values
-        if "port" in config:
-            port = config["port"]
-        else:
-            port = SSH_PORT
-        user = getpass.getuser()
-        if "user" in config:
-            remoteuser = config["user"]
-        else:
-            remoteuser = user
-        local_hostname = socket.gethostname().split(".")[0]
-        local_fqdn = LazyFqdn(config, local_hostname)
-        homedir = os.path.expanduser("~")
-        tohash = local_hostname + target_hostname + repr(port) + remoteuser
-        # The actual tokens!
-        replacements = {
-            # TODO: %%???
-            "%C": sha1(tohash.encode()).hexdigest(),
-            "%d": homedir,
-            "%h": configured_hostname,
-            # TODO: %i?
-            "%L": local_hostname,
-            "%l": local_fqdn,
-            # also this is pseudo buggy when not in Match exec mode so document
-            # that. also WHY is that the case?? don't we do all of this late?
-            "%n": target_hostname,
-            "%p": port,
-            "%r": remoteuser,
-            # TODO: %T? don't believe this is possible however
-            "%u": user,
-            "~": homedir,
-        }
-        # Do the thing with the stuff
-        tokenized = value
-        for find, replace in replacements.items():
-            if find not in allowed_tokens:
-                continue
-            tokenized = tokenized.replace(find, str(replace))
+        if env is None:
+            env = _local_environment()
+        context = _TokenContext(config, target_hostname, env)
         # TODO: log? eg that value -> tokenized
-        return tokenized
+        return template.format_map(context)
 
     def _allowed_tokens(self, key):
         """
@@ -481,7 +961,7 @@ class SSHConfig:
         """
         return self.TOKENS_BY_CONFIG_KEY.get(key, [])
 
-    def _expand_variables(self, config, target_hostname):
+    def _expand_variables(self, config, target_hostname, env=None, lazy=False):
         """
         Return a dict of config options with expanded substitutions
         for a given original & current target hostname.
@@ -490,24 +970,52 @@ class SSHConfig:
 
         :param dict config: the currently parsed config
         :param str hostname: the hostname whose config is being looked up
+        :param dict env: local environment, from `_local_environment`
+        :param bool lazy:
+            return a `LazySSHConfigDict` expanding values on first access,
+            instead of expanding ``config`` in place
         """
-        for k in config:
-            if config[k] is None:
-                continue
-            tokenizer = partial(self._tokenize, config, target_hostname, k)
-            if isinstance(config[k], list):
-                for i, value in enumerate(config[k]):
-                    config[k][i] = tokenizer(value)
-            else:
-                config[k] = tokenizer(config[k])
+        if env is None:
+            env = _local_environment()
+        # Other tokens refer to the expanded hostname, so it goes first
+        if config.get("hostname") is not None:
+            config["hostname"] = self._tokenize(
+                config, target_hostname, "hostname", config["hostname"], env
+            )
+        # Shared by all the values, which are expanded from the same options
+        context = _TokenContext(config, target_hostname, env)
+        keys = [
+            k
+            for k in config
+            if k in self.TOKENS_BY_CONFIG_KEY
+            and k != "hostname"
+            and config[k] is not None
+        ]
+        expand = partial(self._expand_value, context)
+        if lazy:
+            return LazySSHConfigDict(config, expand, keys)
+        for k in keys:
+            config[k] = expand(k, config[k])
         return config
 
+    def _expand_value(self, context, key, value):
+        """
+        Expand the tokens of a ``value`` (or list of values) of config ``key``
+        from a `_TokenContext`.
+        """
+        if isinstance(value, list):
+            return [self._expand_value(context, key, x) for x in value]
+        template = self._template(key, value)
+        if template is None:
+            return value
+        return template.format_map(context)
+
     def _get_hosts(self, host):
         """
         Return a list of host_names from host value.
         """
         try:
-            return shlex.split(host)
+            return _split_words(host)
         except ValueError:
             raise ConfigParseError("Unparsable host {}".format(host))
 
@@ -518,7 +1026,7 @@ class SSHConfig:
         Performs some parse-time validation as well.
         """
         matches = []
-        tokens = shlex.split(match)
+        tokens = _split_words(match)
         while tokens:
             match = {"type": None, "param": None, "negate": False}
             type_ = tokens.pop(0)
@@ -556,41 +1064,574 @@ class SSHConfig:
         return matches
 
 
-def _addressfamily_host_lookup(hostname, options):
+@lru_cache(maxsize=1024)
+def _compile_patterns(patterns):
+    """
+    Compile a tuple of ``ssh_config`` patterns for `_patterns_match`.
+
+    :returns:
+        A 3-tuple of the set of literal patterns, a regex matching any of the
+        wildcard patterns and a regex matching any of the negated patterns. The
+        regexes are ``None`` when there are no such patterns.
     """
-    Try looking up ``hostname`` in an IPv4 or IPv6 specific manner.
+    literals, wildcards, negated = set(), [], []
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            negated.append(pattern[1:])
+        elif any(c in pattern for c in "*?["):
+            wildcards.append(pattern)
+        else:
+            literals.add(os.path.normcase(pattern))
+    return (
+        frozenset(literals),
+        _compile_fnmatch(wildcards),
+        _compile_fnmatch(negated),
+    )
 
-    This is an odd duck due to needing use in two divergent use cases. It looks
-    up ``AddressFamily`` in ``options`` and if it is ``inet`` or ``inet6``,
-    this function uses `socket.getaddrinfo` to perform a family-specific
-    lookup, returning the result if successful.
 
-    In any other situation -- lookup failure, or ``AddressFamily`` being
-    unspecified or ``any`` -- ``None`` is returned instead and the caller is
-    expected to do something situation-appropriate like calling
-    `socket.gethostbyname`.
+def _compile_fnmatch(patterns):
+    """
+    Compile ``fnmatch``-style ``patterns`` into a single regex, or ``None``.
+    """
+    if not patterns:
+        return None
+    return re.compile(
+        "|".join(fnmatch.translate(os.path.normcase(p)) for p in patterns)
+    )
 
-    :param str hostname: Hostname to look up.
-    :param options: `SSHConfigDict` instance w/ parsed options.
-    :returns: ``getaddrinfo``-style tuples, or ``None``, depending.
+
+def _patterns_match(compiled, target):
+    """
+    Match ``target`` against patterns compiled by `_compile_patterns`.
+
+    Like OpenSSH, ``target`` matches if it matches any of the patterns, unless
+    it also matches any of the negated ones.
+    """
+    literals, wildcards, negated = compiled
+    target = os.path.normcase(target)
+    if negated is not None and negated.match(target):
+        return False
+    if target in literals:
+        return True
+    return wildcards is not None and wildcards.match(target) is not None
+
+
+# Backslashes and any whitespace which shlex doesn't split on (or str.split()
+# does), which are left to shlex itself
+_SHLEX_SPECIAL = re.compile(r"[\\]|[^\S \t]")
+# A word as split by shlex (in POSIX mode) when there are no escapes, and the
+# quoted parts within it
+_SHLEX_WORD = re.compile(r"""(?:[^ \t"']|"[^"]*"|'[^']*')+""")
+_SHLEX_QUOTED = re.compile(r""""([^"]*)"|'([^']*)'""")
+
+
+def _split_words(value):
+    """
+    Split ``value`` into words exactly like `shlex.split` does, without the
+    overhead of shlex in the common cases.
+    """
+    if _SHLEX_SPECIAL.search(value) is not None:
+        return shlex.split(value)
+    if '"' not in value and "'" not in value:
+        return value.split()
+    words, end = [], 0
+    for match in _SHLEX_WORD.finditer(value):
+        # Anything but spaces and tabs in between words is an unbalanced
+        # quote, for shlex to complain about
+        if value[end : match.start()].strip(" \t"):
+            return shlex.split(value)
+        words.append(_SHLEX_QUOTED.sub(_unquote, match.group()))
+        end = match.end()
+    if value[end:].strip(" \t"):
+        return shlex.split(value)
+    return words
+
+
+def _unquote(match):
+    double, single = match.groups()
+    return double if double is not None else single
+
+
+def _local_environment():
+    """
+    Return the local user, hostname and home directory, as needed by lookups.
+    """
+    return {
+        "user": getpass.getuser(),
+        "hostname": _local_host.hostname(),
+        "homedir": os.path.expanduser("~"),
+        "uid": str(os.getuid()) if hasattr(os, "getuid") else "",
+    }
+
+
+@lru_cache(maxsize=None)
+def _token_regex(tokens):
+    """
+    Compile a regex matching any of ``tokens``, e.g. ``("%%", "%h", "~")``.
+    """
+    return re.compile("|".join(re.escape(token) for token in tokens))
+
+
+def _compile_template(value, tokens, hostname=False):
+    """
+    Compile the ``tokens`` of ``value`` into a template for `str.format_map`,
+    so that all of them get replaced in a single pass.
+
+    Tokens become fields named after their last character (``%h`` is ``h``,
+    ``%%`` is ``%`` and ``~`` is ``~``), matching the names in
+    `_TokenContext`. With ``hostname``, ``%h`` is the original hostname, as
+    it is when expanding the ``HostName`` value itself.
+
+    :returns: The template, or ``None`` if ``value`` has no tokens.
+    """
+    parts, last = [], 0
+    for match in _token_regex(tokens).finditer(value):
+        literal = value[last : match.start()]
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        name = match.group()[-1]
+        if hostname and name == "h":
+            name = "n"
+        parts.append("{" + name + "}")
+        last = match.end()
+    if not parts:
+        return None
+    literal = value[last:]
+    parts.append(literal.replace("{", "{{").replace("}", "}}"))
+    return "".join(parts)
+
+
+class _TokenContext(dict):
+    """
+    Values of the tokens of `SSHConfig.TOKENS_BY_CONFIG_KEY`, by the field
+    names of `_compile_template`, for expanding the options of one lookup.
+
+    The costlier values (``%C`` and ``%l``) are only computed when used.
+    """
+
+    def __init__(self, config, target_hostname, env):
+        self.config = config
+        port = config.get("port", SSH_PORT)
+        remoteuser = config.get("user", env["user"])
+        local_hostname = env["hostname"].split(".")[0]
+        # Hashed as it always has been, to keep the same ControlPaths
+        self.tohash = local_hostname + target_hostname + repr(port)
+        self.tohash += remoteuser
+        super().__init__(
+            {
+                "%": "%",
+                "d": env["homedir"],
+                "h": config.get("hostname", target_hostname),
+                "i": env["uid"],
+                "j": config.get("proxyjump") or "",
+                "k": config.get("hostkeyalias", target_hostname),
+                "L": local_hostname,
+                # also this is pseudo buggy when not in Match exec mode so
+                # document that. also WHY is that the case?? don't we do all
+                # of this late?
+                "n": target_hostname,
+                "p": str(port),
+                "r": remoteuser,
+                # Tunnels aren't supported, which OpenSSH expands to NONE
+                "T": "NONE",
+                "u": env["user"],
+                "~": env["homedir"],
+            }
+        )
+
+    def __missing__(self, name):
+        if name == "C":
+            value = sha1(self.tohash.encode()).hexdigest()
+        elif name == "l":
+            family = _address_family(self.config)
+            value = _local_host.fqdn(family, self["L"])
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+
+def _include_base_dir(path):
+    """
+    Return the directory relative to which the config file at ``path``
+    resolves relative ``Include`` paths: ``/etc/ssh`` for system-wide config
+    files and ``~/.ssh`` for all others (just like in OpenSSH).
+    """
+    if isinstance(path, str) and os.path.abspath(path).startswith("/etc/ssh/"):
+        return "/etc/ssh"
+    return os.path.expanduser("~/.ssh")
+
+
+_fragments = {}
+_fragments_lock = threading.Lock()
+
+
+def _read_fragment(config, path):
+    """
+    Return the lines of the included config file at ``path``, as read by
+    `SSHConfig._read_lines`, and the SHA-1 of the contents they were read
+    from.
+
+    Files are cached by their modification time and size, so that including
+    the same files again (e.g. after another of them changed) doesn't need to
+    parse them again.
+    """
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _fragments_lock:
+        cached = _fragments.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1], cached[2]
+    with open(path, "rb") as flo:
+        data = flo.read()
+    digest = sha1(data).hexdigest()
+    # Decoded the same way as by open() in text mode
+    lines = config._read_lines(TextIOWrapper(BytesIO(data)))
+    with _fragments_lock:
+        _fragments[path] = (signature, lines, digest)
+    return lines, digest
+
+
+def _copy_options(options, lazy=None):
+    """
+    Return a copy of lookup result ``options`` that shares no lists with it.
+
+    :param bool lazy:
+        Whether to return a `LazySSHConfigDict`, or an `SSHConfigDict` with
+        all values expanded. By default, the copy is of the same type.
+    """
+    if lazy is None:
+        lazy = isinstance(options, LazySSHConfigDict)
+    if isinstance(options, LazySSHConfigDict):
+        copy = options.copy()
+        return copy if lazy else SSHConfigDict(copy.items())
+    copy = SSHConfigDict(
+        (key, value[:] if isinstance(value, list) else value)
+        for key, value in options.items()
+    )
+    return LazySSHConfigDict(copy, None, ()) if lazy else copy
+
+
+def _address_family(options):
+    """
+    Return the `socket.AddressFamily` for the ``AddressFamily`` of
+    ``options``, with ``AF_UNSPEC`` standing for ``any``.
     """
     address_family = options.get("addressfamily", "any").lower()
     if address_family == "any":
-        return
+        return socket.AF_UNSPEC
+    if address_family == "inet":
+        return socket.AF_INET
+    return socket.AF_INET6
+
+
+def _resolve_fqdn(family, host):
+    """
+    Return the FQDN of local ``host``, looked up in ``family`` if specific.
+    """
+    #
+    # If the SSH config contains AddressFamily, use that when determining the
+    # local host's FQDN. Using socket.getfqdn() from the standard library is
+    # the most general solution, but can result in noticeable delays on some
+    # platforms when IPv6 is misconfigured or not available, as it calls
+    # getaddrinfo with no address family specified, so both IPv4 and IPv6 are
+    # checked.
+    #
+    if family != socket.AF_UNSPEC:
+        try:
+            results = socket.getaddrinfo(
+                host,
+                None,
+                family,
+                socket.SOCK_DGRAM,
+                socket.IPPROTO_IP,
+                socket.AI_CANONNAME,
+            )
+        except socket.gaierror:
+            results = []
+        for af, socktype, proto, canonname, sa in results:
+            if canonname and "." in canonname:
+                return canonname
+    # Handle 'any' / unspecified / lookup failure
+    return socket.getfqdn()
+
+
+class LocalHostResolver:
+    """
+    Process-wide cache of the local hostname and FQDN, as used by the ``%L``
+    and ``%l`` tokens.
+
+    FQDNs are cached per `socket.AddressFamily` for ``ttl`` seconds. Once
+    expired, the previous FQDN keeps being returned while a new one is looked
+    up in the background. When there is no previous FQDN to return, the
+    lookup is waited for for up to ``timeout`` seconds, after which the
+    hostname is returned instead (like OpenSSH's ``%l`` without a domain)
+    and the FQDN is used as soon as the lookup finishes.
+    """
+
+    def __init__(self, ttl=LOCAL_HOST_TTL, timeout=LOCAL_FQDN_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Key -> (value, expiry time)
+        self._entries = {}
+        # FQDN key -> event set when its lookup finishes
+        self._resolving = {}
+
+    def hostname(self):
+        """
+        Return the local hostname, from `socket.gethostname`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get("hostname")
+            if entry is not None and now < entry[1]:
+                return entry[0]
+        hostname = socket.gethostname()
+        with self._lock:
+            self._entries["hostname"] = (hostname, now + self.ttl)
+        return hostname
+
+    def fqdn(self, family=socket.AF_UNSPEC, host=None):
+        """
+        Return the FQDN of the local host.
+
+        :param family:
+            The `socket.AddressFamily` to look it up in, with ``AF_UNSPEC``
+            for any.
+        :param str host:
+            The local hostname to look up, by default the first component of
+            `hostname`.
+        """
+        if host is None:
+            host = self.hostname().split(".")[0]
+        key = (family, host)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[1]:
+                return entry[0]
+            done = self._resolving.get(key)
+            if done is None:
+                done = self._resolving[key] = threading.Event()
+                threading.Thread(
+                    target=self._resolve,
+                    args=(key, done),
+                    name="paramiko-fqdn",
+                    daemon=True,
+                ).start()
+        if entry is not None:
+            return entry[0]
+        if done.wait(self.timeout):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0]
+        return self.hostname()
+
+    def clear(self):
+        """
+        Forget all cached values, e.g. after the hostname changed.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _resolve(self, key, done):
+        try:
+            fqdn = _resolve_fqdn(*key)
+        except OSError:
+            fqdn = None
+        with self._lock:
+            if fqdn is not None:
+                self._entries[key] = (fqdn, time.monotonic() + self.ttl)
+            del self._resolving[key]
+        done.set()
+
+
+_local_host = LocalHostResolver()
+
+
+def _resolve_host(hostname, family):
+    """
+    Return an address of ``hostname``, looked up in ``family`` if specific,
+    or ``None`` if it doesn't resolve.
+    """
+    if family != socket.AF_UNSPEC:
+        try:
+            return socket.getaddrinfo(
+                hostname,
+                None,
+                family,
+                socket.SOCK_DGRAM,
+                socket.IPPROTO_IP,
+                socket.AI_CANONNAME,
+            )[0][4][0]
+        except socket.gaierror:
+            pass
+    # TODO: what does ssh use here and is there a reason to use that instead
+    # of gethostbyname?
     try:
-        family = socket.AF_INET6
-        if address_family == "inet":
-            family = socket.AF_INET
-        return socket.getaddrinfo(
-            hostname,
-            None,
-            family,
-            socket.SOCK_DGRAM,
-            socket.IPPROTO_IP,
-            socket.AI_CANONNAME,
-        )
+        return socket.gethostbyname(hostname)
     except socket.gaierror:
-        pass
+        return None
+
+
+class HostResolver:
+    """
+    Resolver of the candidate hostnames of canonicalization, with a cache.
+
+    Outcomes are cached per hostname and `socket.AddressFamily`, for ``ttl``
+    seconds when the hostname resolves and ``negative_ttl`` seconds when it
+    doesn't, and concurrent requests for the same hostname share a single
+    lookup.
+
+    :param resolve:
+        The callable doing the actual lookups, given a hostname and an
+        address family (``AF_UNSPEC`` for any) and returning an address, or
+        ``None`` if the hostname doesn't resolve. By default, uses `socket`.
+        Handy to substitute a stub in tests.
+    """
+
+    def __init__(
+        self,
+        resolve=None,
+        ttl=CANONICAL_TTL,
+        negative_ttl=CANONICAL_NEGATIVE_TTL,
+    ):
+        self.resolve = resolve if resolve is not None else _resolve_host
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # (hostname, family) -> (address or None, expiry time)
+        self._entries = {}
+        # (hostname, family) -> event set when its lookup finishes
+        self._resolving = {}
+
+    def first(self, hostnames, family=socket.AF_UNSPEC):
+        """
+        Return the first of ``hostnames`` which resolves, or ``None``.
+
+        All of them are looked up concurrently, so this takes as long as the
+        slowest lookup up to the first hostname which resolves, instead of
+        the sum of them all.
+        """
+        pending = [(x, self._start(x, family)) for x in hostnames]
+        for hostname, done in pending:
+            done.wait()
+            with self._lock:
+                address, _ = self._entries.get((hostname, family), (None, 0))
+            if address is not None:
+                return hostname
+        return None
+
+    def clear(self):
+        """
+        Forget all cached outcomes.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _start(self, hostname, family):
+        """
+        Start looking ``hostname`` up unless its outcome is cached, returning
+        an event set once it is.
+        """
+        key = (hostname, family)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                return _DONE
+            done = self._resolving.get(key)
+            if done is None:
+                done = self._resolving[key] = threading.Event()
+                threading.Thread(
+                    target=self._resolve,
+                    args=(key, done),
+                    name="paramiko-canonicalize",
+                    daemon=True,
+                ).start()
+        return done
+
+    def _resolve(self, key, done):
+        address = None
+        try:
+            address = self.resolve(*key)
+        except (OSError, UnicodeError):
+            pass
+        finally:
+            ttl = self.ttl if address is not None else self.negative_ttl
+            with self._lock:
+                self._entries[key] = (address, time.monotonic() + ttl)
+                del self._resolving[key]
+            done.set()
+
+
+_host_resolver = HostResolver()
+
+# Returned by `HostResolver._start` for cached outcomes
+_DONE = threading.Event()
+_DONE.set()
+
+
+class MatchExecutor:
+    """
+    Runner of ``Match exec`` commands, with a cache of their outcomes.
+
+    Commands are run with the shell, like OpenSSH does, and pass if they exit
+    with status 0. Those still running after ``timeout`` seconds are killed
+    and fail. Outcomes are cached per (expanded) command for ``ttl`` seconds,
+    ``0`` disabling the cache.
+
+    ``executions`` counts the commands which were run, and ``avoided`` the
+    ones which weren't thanks to the cache.
+    """
+
+    def __init__(self, timeout=MATCH_EXEC_TIMEOUT, ttl=MATCH_EXEC_TTL):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.executions = 0
+        self.avoided = 0
+        self._lock = threading.Lock()
+        # Command -> (passed, expiry time)
+        self._entries = {}
+
+    def run(self, command):
+        """
+        Return whether ``command`` passes, running it unless cached.
+        """
+        with self._lock:
+            entry = self._entries.get(command)
+            if entry is not None and time.monotonic() < entry[1]:
+                self.avoided += 1
+                return entry[0]
+            self.executions += 1
+        try:
+            # Like OpenSSH, we 'redirect' stdout but let stderr bubble up
+            passed = (
+                subprocess.run(
+                    command,
+                    shell=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    timeout=self.timeout,
+                ).returncode
+                == 0
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            passed = False
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[command] = (passed, time.monotonic() + self.ttl)
+        return passed
+
+    def clear(self):
+        """
+        Forget all cached outcomes.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_match_executor = MatchExecutor()
 
 
 class LazyFqdn:
@@ -605,29 +1646,9 @@ class LazyFqdn:
 
     def __str__(self):
         if self.fqdn is None:
-            #
-            # If the SSH config contains AddressFamily, use that when
-            # determining  the local host's FQDN. Using socket.getfqdn() from
-            # the standard library is the most general solution, but can
-            # result in noticeable delays on some platforms when IPv6 is
-            # misconfigured or not available, as it calls getaddrinfo with no
-            # address family specified, so both IPv4 and IPv6 are checked.
-            #
-
-            # Handle specific option
-            fqdn = None
-            results = _addressfamily_host_lookup(self.host, self.config)
-            if results is not None:
-                for res in results:
-                    af, socktype, proto, canonname, sa = res
-                    if canonname and "." in canonname:
-                        fqdn = canonname
-                        break
-            # Handle 'any' / unspecified / lookup failure
-            if fqdn is None:
-                fqdn = socket.getfqdn()
-            # Cache
-            self.fqdn = fqdn
+            self.fqdn = _local_host.fqdn(
+                _address_family(self.config), self.host
+            )
         return self.fqdn
 
 
@@ -694,3 +1715,131 @@ class SSHConfigDict(dict):
         .. versionadded:: 2.5
         """
         return int(self[key])
+
+
+class LazySSHConfigDict(SSHConfigDict):
+    """
+    An `SSHConfigDict` which expands the tokens of a value the first time it
+    is read, and then keeps the expanded value.
+
+    Returned by `SSHConfig.lookup` when called with ``lazy=True``, for callers
+    which only need some of the options: tokens such as ``%C`` (a SHA-1
+    hash) or ``%l`` (the local FQDN) then cost nothing unless one of the
+    values read uses them.
+
+    Every way of reading values (indexing, `get`, `pop`, `popitem`, the
+    `items` and `values` views, copies made with ``dict()``, `copy`, the
+    `copy` module or `pickle`) yields expanded values, values set by callers
+    (also through `update`, `setdefault` or ``|=``) are never expanded, and
+    results compare equal to the `SSHConfigDict` `SSHConfig.lookup` would
+    have returned otherwise.
+    """
+
+    def __init__(self, options=(), expand=None, keys=()):
+        """
+        :param options: the options of the lookup, with unexpanded values
+        :param expand:
+            a callable expanding the value of a key, given the key and value
+        :param keys: the keys whose values may need expanding
+        """
+        super().__init__(options)
+        self._expand = expand
+        self._unexpanded = set(keys)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if key not in self._unexpanded:
+            return super().__getitem__(key)
+        with self._lock:
+            value = super().__getitem__(key)
+            if key in self._unexpanded:
+                value = self._expand(key, value)
+                super().__setitem__(key, value)
+                self._unexpanded.discard(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self._unexpanded.discard(key)
+
+    def __iter__(self):
+        # Merely defining this makes dict() and dict.update() go through
+        # keys() and __getitem__, instead of copying unexpanded values
+        return super().__iter__()
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super().pop(key, *args)
+
+    def popitem(self):
+        with self._lock:
+            key, value = super().popitem()
+            if key in self._unexpanded:
+                value = self._expand(key, value)
+                self._unexpanded.discard(key)
+            return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        # dict.update() would store values without going through __setitem__
+        for other in args + (kwargs,):
+            if hasattr(other, "keys"):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def __reduce__(self):
+        # Used by the copy module and pickle, which would otherwise copy the
+        # unexpanded values (and fail on the lock)
+        return type(self), (dict(self.items()),)
+
+    def copy(self):
+        """
+        Return a copy, which shares no lists with this one and expands the
+        values which haven't been expanded yet on its own.
+        """
+        with self._lock:
+            options = {
+                key: value[:] if isinstance(value, list) else value
+                for key, value in super().items()
+            }
+            return type(self)(options, self._expand, self._unexpanded)
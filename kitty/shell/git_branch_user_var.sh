@@ -0,0 +1,31 @@
+# Reports the current Git branch to kitty as the "git_branch" user variable on every
+# prompt, so that kitty's tab bar can show it for SSH sessions without polling the
+# remote host. Source this file from .zshrc or .bashrc on remote hosts.
+
+__kitty_set_git_branch() {
+	local branch
+	if branch="$(git symbolic-ref --short -q HEAD 2>/dev/null)"; then
+		:
+	elif git rev-parse --git-dir >/dev/null 2>&1; then
+		branch="DETACHED"
+	else
+		branch=""
+	fi
+
+	# Only talk to the terminal when the branch changed
+	[ "$branch" = "${__kitty_git_branch-unset}" ] && return
+	__kitty_git_branch="$branch"
+	printf '\033]1337;SetUserVar=git_branch=%s\007' "$(printf %s "$branch" | base64 | tr -d '\n')"
+}
+
+__kitty_clear_git_branch() {
+	printf '\033]1337;SetUserVar=git_branch\007'
+}
+
+if [ -n "$ZSH_VERSION" ]; then
+	autoload -Uz add-zsh-hook
+	add-zsh-hook precmd __kitty_set_git_branch
+	add-zsh-hook zshexit __kitty_clear_git_branch
+elif [ -n "$BASH_VERSION" ]; then
+	PROMPT_COMMAND="__kitty_set_git_branch${PROMPT_COMMAND:+;$PROMPT_COMMAND}"
+fi
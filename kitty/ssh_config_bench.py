@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Benchmarks for the bundled paramiko SSHConfig, on generated configs.
+
+Lookups are compared against a linear scan over all stanzas that matches patterns
+one by one with fnmatch, the way SSHConfig used to, which also serves to check
+that both agree on the result.
+
+Parsing is compared against the previous line by line tokenizer in the same way.
+
+Usage: ./ssh_config_bench.py [HOSTS...]
+"""
+
+import copy
+import fnmatch
+import os
+import pickle
+import random
+import re
+import shlex
+import sys
+import tempfile
+import time
+from collections.abc import ItemsView, ValuesView
+from io import StringIO
+from typing import Any, Callable, List, Tuple
+
+from paramiko.config import ConfigParseError, SSHConfig, SSHConfigDict
+
+HOST_COUNTS = (1000, 10000, 20000)
+LOOKUPS = 2000
+# The linear scan is slow enough on large configs to only time a sample of lookups
+LINEAR_LOOKUPS = 100
+PARSE_SIZES_MB = (1, 10)
+
+
+def _timeit(func: Callable[[], Any], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+def _generate_config(hosts: int) -> str:
+    # Mostly literal hosts, like a generated inventory, with some wildcards and
+    # negations in between and catch-all defaults at the end
+    lines = []
+    for i in range(hosts):
+        lines.append(f"Host host{i} host{i}.example.com")
+        lines.append(f"    HostName 10.{i // 65536}.{i // 256 % 256}.{i % 256}")
+        lines.append(f"    User user{i}")
+        lines.append("    IdentityFile ~/.ssh/id_%h")
+        if i % 1000 == 0:
+            lines.append(f"Host *.dc{i // 1000}.example.com !bastion.*")
+            lines.append("    ProxyJump bastion.example.com")
+    lines.append("Match originalhost *.example.com user root")
+    lines.append("    IdentitiesOnly yes")
+    lines.append("Host *")
+    lines.append("    ServerAliveInterval 60")
+    return "\n".join(lines) + "\n"
+
+
+def _linear_lookup(config: SSHConfig, hostname: str) -> SSHConfigDict:
+    # Evaluates every Host stanza with fnmatch, instead of using the index
+    def pattern_matches(patterns: List[str], target: str) -> bool:
+        match = False
+        for pattern in patterns:
+            if pattern.startswith("!") and fnmatch.fnmatch(target, pattern[1:]):
+                return False
+            elif fnmatch.fnmatch(target, pattern):
+                match = True
+        return match
+
+    options = SSHConfigDict()
+    for final in (False, True):
+        for context in config._config:
+            if "host" in context:
+                if not pattern_matches(context["host"], hostname):
+                    continue
+            elif not config._does_match(
+                context["matches"], hostname, False, final, options
+            ):
+                continue
+            for key, value in context["config"].items():
+                if key not in options:
+                    options[key] = value[:] if value is not None else value
+                elif key == "identityfile":
+                    options[key].extend(x for x in value if x not in options[key])
+        if "hostname" not in options:
+            options["hostname"] = hostname
+    return config._expand_variables(options, hostname)
+
+
+def _generate_mixed_config(size: int) -> str:
+    # All the forms lines can take: "Key value", "Key=value", "Key = value",
+    # quoting, comments and indentation with tabs
+    lines: List[str] = []
+    length, i = 0, 0
+    while length < size:
+        entry = [
+            f"# Generated entry {i}",
+            f'Host host{i} "host {i}.example.com" db{i}',
+            f"\tHostName=10.{i // 65536}.{i // 256 % 256}.{i % 256}",
+            f'    User = "user{i}"',
+            f"    Port {2200 + i % 100}",
+            "    IdentityFile ~/.ssh/id_%h",
+        ]
+        if i % 100 == 0:
+            entry.append(f"Match host *.dc{i // 100}.example.com !user root")
+            entry.append("    ProxyJump bastion.example.com")
+        entry.append("")
+        lines.extend(entry)
+        length += sum(len(line) + 1 for line in entry)
+        i += 1
+    return "\n".join(lines)
+
+
+def _reference_read_lines(config: SSHConfig, text: str) -> List[Tuple[str, Any]]:
+    # Tokenizes one line at a time with SETTINGS_REGEX and shlex, like parse() used to
+    lines: List[Tuple[str, Any]] = []
+    for line in StringIO(text):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = re.match(config.SETTINGS_REGEX, line)
+        if not match:
+            raise ConfigParseError(f"Unparsable line {line}")
+        key, value = match.group(1).lower(), match.group(2)
+        if key in ("host", "include"):
+            value = shlex.split(value)
+        elif key == "match":
+            value = config._get_matches(value)
+        elif key == "proxycommand" and value.lower() == "none":
+            value = None
+        elif value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        lines.append((key, value))
+    return lines
+
+
+def bench_parse(megabytes: int) -> None:
+    text = _generate_mixed_config(megabytes * 1000000)
+    config = SSHConfig()
+    assert config._read_lines(StringIO(text)) == _reference_read_lines(config, text)
+
+    reference_time = _timeit(lambda: _reference_read_lines(config, text), 1)
+    tokenize_time = _timeit(lambda: config._read_lines(StringIO(text)), 1)
+    parse_time = _timeit(lambda: SSHConfig.from_text(text), 1)
+    print(f"Parsing {len(text) / 1e6:.1f} MB")
+    print(f"  per-line tokenizer: {len(text) / reference_time / 1e6:8.1f} MB/s")
+    print(f"  buffer tokenizer:   {len(text) / tokenize_time / 1e6:8.1f} MB/s")
+    print(f"  speedup:            {reference_time / tokenize_time:8.1f}x")
+    print(f"  full parse:         {len(text) / parse_time / 1e6:8.1f} MB/s")
+
+
+def bench_lookup(hosts: int) -> None:
+    text = _generate_config(hosts)
+    parse_time = _timeit(lambda: SSHConfig.from_text(text), 1)
+    config = SSHConfig.from_text(text)
+
+    rng = random.Random(hosts)
+    hostnames = [f"host{rng.randrange(hosts)}" for _ in range(LOOKUPS // 2)]
+    hostnames += [f"db{i}.dc{i % 10}.example.com" for i in range(LOOKUPS // 4)]
+    hostnames += [f"unknown{i}" for i in range(LOOKUPS - len(hostnames))]
+    for hostname in hostnames[:: LOOKUPS // 20]:
+        assert config.lookup(hostname) == _linear_lookup(config, hostname), hostname
+
+    def lookup_all(lookup: Callable[[str], Any], sample: List[str]) -> float:
+        start = time.perf_counter()
+        for hostname in sample:
+            lookup(hostname)
+        return (time.perf_counter() - start) / len(sample)
+
+    linear_time = lookup_all(
+        lambda h: _linear_lookup(config, h), hostnames[:: LOOKUPS // LINEAR_LOOKUPS]
+    )
+    indexed_time = lookup_all(config.lookup, hostnames)
+    assert config.lookup_many(hostnames) == [config.lookup(h) for h in hostnames]
+    batch_time = _timeit(lambda: config.lookup_many(hostnames), 1) / len(hostnames)
+    print(f"{hosts} hosts ({len(text) / 1e6:.1f} MB)")
+    print(f"  parse:          {parse_time * 1e3:10.1f} ms")
+    print(f"  linear lookup:  {linear_time * 1e6:10.1f} us/call")
+    print(f"  indexed lookup: {indexed_time * 1e6:10.1f} us/call")
+    print(f"  speedup:        {linear_time / indexed_time:10.1f}x")
+    print(f"  lookup_many:    {batch_time * 1e6:10.1f} us/host")
+
+
+def check_include() -> None:
+    # Options at the top of an included file belong to the block of the
+    # Include, not to the last block of the file included before it
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Relative Includes would be looked up in ~/.ssh
+        include_dir = os.path.join(tmp_dir, "config.d")
+        os.mkdir(include_dir)
+        files = {
+            "config": f"Include {include_dir}/*\n"
+            f"Host c*\n    Include {include_dir}/b\n",
+            "config.d/a": "Host b*\n    User ub\n",
+            "config.d/b": "ForwardAgent yes\nHost *\n    Port 2222\n",
+        }
+        for name, text in files.items():
+            with open(os.path.join(tmp_dir, name), "w") as f:
+                f.write(text)
+        config = SSHConfig.from_path(os.path.join(tmp_dir, "config"))
+        for hostname, expected in (
+            ("a", {"forwardagent": "yes", "port": "2222"}),
+            ("b", {"user": "ub", "forwardagent": "yes", "port": "2222"}),
+            ("c", {"forwardagent": "yes", "port": "2222"}),
+        ):
+            options = dict(config.lookup(hostname))
+            del options["hostname"]
+            assert options == expected, (hostname, options)
+    print("Include: ok")
+
+
+def check_proxycommand_none() -> None:
+    # "ProxyCommand none" overrides an earlier ProxyCommand of the same stanza
+    config = SSHConfig.from_text(
+        "Host a\n    ProxyCommand nc %h %p\n    ProxyCommand none\n"
+        "Host b\n    ProxyCommand none\n    ProxyCommand nc %h %p\n"
+    )
+    assert config.lookup("a")["proxycommand"] is None
+    assert config.lookup("b")["proxycommand"] is None
+    print("ProxyCommand none: ok")
+
+
+def check_lazy_dict() -> None:
+    # Every way of reading a lazy lookup expands values, and no way of setting
+    # one does
+    config = SSHConfig.from_text(
+        "Host a\n    ProxyCommand nc %h %p\n    IdentityFile ~/.ssh/id_%h\n"
+        "    User me\n"
+    )
+    expected = config.lookup("a")
+
+    def lazy() -> SSHConfigDict:
+        return config.lookup("a", lazy=True)
+
+    options = lazy()
+    assert isinstance(options.items(), ItemsView), options.items()
+    assert isinstance(options.values(), ValuesView), options.values()
+    assert dict(lazy().items()) == expected
+    assert list(lazy().values()) == list(expected.values())
+
+    options = lazy()
+    popped = dict(options.popitem() for _ in range(len(expected)))
+    assert popped == expected and not options, popped
+
+    for copied in (
+        copy.copy(lazy()),
+        copy.deepcopy(lazy()),
+        pickle.loads(pickle.dumps(lazy())),
+    ):
+        # Compares the values stored, not those that would be expanded
+        assert dict(dict.items(copied)) == expected, copied
+
+    set_values = {"proxycommand": "%h", "hostname": "%h"}
+    options = lazy()
+    options.update(set_values)
+    assert options == dict(expected, **set_values), options
+    options = lazy()
+    options.update(set_values.items())
+    assert options == dict(expected, **set_values), options
+    options = lazy()
+    options.update(**set_values)
+    assert options == dict(expected, **set_values), options
+    options = lazy()
+    options |= set_values
+    assert options == dict(expected, **set_values), options
+    assert lazy() | set_values == dict(expected, **set_values)
+
+    options = lazy()
+    assert options.setdefault("proxycommand") == expected["proxycommand"]
+    assert options.setdefault("localcommand", "%h") == "%h"
+    assert options["localcommand"] == "%h", options
+    print("Lazy lookups: ok")
+
+
+def bench_cold_start(hosts: int) -> None:
+    # What every new process pays to get a parsed config
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "config")
+        with open(path, "w") as f:
+            f.write(_generate_config(hosts))
+        cache_dir = os.path.join(tmp_dir, "cache")
+
+        parse_time = _timeit(lambda: SSHConfig.from_path(path), 3)
+        miss_time = _timeit(lambda: SSHConfig.from_path(path, cache_dir=cache_dir), 1)
+        hit_time = _timeit(lambda: SSHConfig.from_path(path, cache_dir=cache_dir), 3)
+        uncached = SSHConfig.from_path(path)
+        cached = SSHConfig.from_path(path, cache_dir=cache_dir)
+        assert cached._config == uncached._config
+
+    print(f"{hosts} hosts, cold start")
+    print(f"  parse:          {parse_time * 1e3:10.1f} ms")
+    print(f"  parse + save:   {miss_time * 1e3:10.1f} ms")
+    print(f"  load cache:     {hit_time * 1e3:10.1f} ms")
+    print(f"  speedup:        {parse_time / hit_time:10.1f}x")
+
+
+def main() -> None:
+    host_counts = [int(arg) for arg in sys.argv[1:]] or HOST_COUNTS
+    check_include()
+    check_proxycommand_none()
+    check_lazy_dict()
+    for megabytes in PARSE_SIZES_MB:
+        bench_parse(megabytes)
+    for hosts in host_counts:
+        bench_lookup(hosts)
+        bench_cold_start(hosts)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
+import concurrent.futures
+import ctypes
+import glob
 import math
+import os
 import socket
+import struct
 import subprocess
+import threading
+import time
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional
-
-from kittens.ssh.utils import get_connection_data
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 from kitty.boss import Boss
-from kitty.fast_data_types import Color, Screen, get_boss, get_options
+from kitty.constants import cache_dir, runtime_dir
+from kitty.fast_data_types import Color, Screen, add_timer, get_boss, get_options
 from kitty.tab_bar import Dict, DrawData, ExtraData, TabBarData, as_rgb, draw_title
 from kitty.utils import color_as_int
 from kitty.window import Window
@@ -37,19 +43,22 @@ Configuration file (aka ``ssh_config``) support.
 
 import fnmatch
 import getpass
+import glob
+import heapq
+import marshal
 import os
 import re
 import shlex
 import socket
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import ItemsView, ValuesView
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
-from io import StringIO
-from functools import partial
-
-invoke, invoke_import_error = None, None
-try:
-    import invoke
-except ImportError as e:
-    invoke_import_error = e
+from io import BytesIO, StringIO, TextIOWrapper
+from functools import lru_cache, partial
 
 
 class SSHException(Exception):
@@ -285,6 +294,30 @@ class MessageOrderError(SSHException):
 
 SSH_PORT = 22
 
+# Same limit as OpenSSH's READCONF_MAX_DEPTH
+MAX_INCLUDE_DEPTH = 16
+
+# Bumped whenever the structure of parsed configs changes, to invalidate files
+# written by `SSHConfig.from_path` to its ``cache_dir``
+CACHE_FORMAT = 1
+
+# How long (in seconds) the local hostname and FQDN are cached for, and for
+# how long an FQDN lookup may block before falling back to the hostname (see
+# `LocalHostResolver`)
+LOCAL_HOST_TTL = 300
+LOCAL_FQDN_TIMEOUT = 1.0
+
+# How long (in seconds) the outcome of resolving a candidate hostname during
+# canonicalization is cached for, when found and when not (see `HostResolver`)
+CANONICAL_TTL = 300
+CANONICAL_NEGATIVE_TTL = 30
+
+# How long (in seconds) a 'Match exec' command may run before it is killed and
+# deemed to have failed, and for how long its outcome is cached (see
+# `MatchExecutor`)
+MATCH_EXEC_TIMEOUT = 5.0
+MATCH_EXEC_TTL = 10
+
 
 class SSHConfig:
     """
@@ -302,17 +335,32 @@ class SSHConfig:
     # TODO: do a full scan of ssh.c & friends to make sure we're fully
     # compatible across the board, e.g. OpenSSH 8.1 added %n to ProxyCommand.
     TOKENS_BY_CONFIG_KEY = {
-        "controlpath": ["%C", "%h", "%l", "%L", "%n", "%p", "%r", "%u"],
-        "hostname": ["%h"],
-        "identityfile": ["%C", "~", "%d", "%h", "%l", "%u", "%r"],
-        "proxycommand": ["~", "%h", "%p", "%r"],
-        "proxyjump": ["%h", "%p", "%r"],
+        "controlpath": [
+            "%%", "%C", "%h", "%i", "%j", "%k", "%l", "%L", "%n", "%p", "%r",
+            "%u",
+        ],
+        "hostname": ["%%", "%h"],
+        "identityfile": [
+            "%%", "%C", "~", "%d", "%h", "%i", "%j", "%k", "%l", "%L", "%n",
+            "%u", "%r",
+        ],
+        "localcommand": [
+            "%%", "%C", "%d", "%h", "%i", "%j", "%k", "%L", "%l", "%n", "%p",
+            "%r", "%T", "%u",
+        ],
+        "proxycommand": ["%%", "~", "%h", "%n", "%p", "%r"],
+        "proxyjump": ["%%", "%h", "%n", "%p", "%r"],
         # Doesn't seem worth making this 'special' for now, it will fit well
         # enough (no actual match-exec config key to be confused with).
-        "match-exec": ["%C", "%d", "%h", "%L", "%l", "%n", "%p", "%r", "%u"],
+        "match-exec": [
+            "%%", "%C", "%d", "%h", "%i", "%j", "%k", "%L", "%l", "%n", "%p",
+            "%r", "%u",
+        ],
     }
 
-    def __init__(self):
+    def __init__(
+        self, lookup_cache_size=0, resolver=None, match_executor=None
+    ):
         """
         Create a new OpenSSH config object.
 
@@ -330,36 +378,93 @@ class SSHConfig:
             config = SSHConfig.from_path("some-path.config")
             # Or if you have arbitrary ssh_config text from some other source:
             config = SSHConfig.from_text("Host foo\\n\\tUser bar")
+
+        :param int lookup_cache_size:
+            Maximum number of `lookup` results to memoize, keyed by hostname.
+            The default of ``0`` disables the cache. The cache is flushed
+            whenever `parse` is called, and results which depended on ``Match
+            exec`` or on hostname canonicalization are never cached.
+        :param resolver:
+            The `HostResolver` to canonicalize hostnames with. By default, one
+            shared by the whole process, which resolves with `socket`.
+        :param match_executor:
+            The `MatchExecutor` to run ``Match exec`` commands with. By
+            default, one shared by the whole process.
         """
         self._config = []
+        # Absolute Include patterns -> files they matched
+        self._includes = {}
+        # Included files -> SHA-1 of the contents they were parsed from
+        self._include_digests = {}
+        # Compiled host patterns per stanza (see `_index_config`)
+        self._host_patterns = []
+        self._literal_index = {}
+        self._unindexed = []
+        # Compiled token templates per (key, value) (see `_template`)
+        self._templates = {}
+        self._lookup_cache_size = lookup_cache_size
+        self._lookup_cache = OrderedDict()
+        self._lookup_cache_lock = threading.Lock()
+        self._resolver = resolver if resolver is not None else _host_resolver
+        if match_executor is None:
+            match_executor = _match_executor
+        self._match_executor = match_executor
 
     @classmethod
-    def from_text(cls, text):
+    def from_text(cls, text, **kwargs):
         """
         Create a new, parsed `SSHConfig` from ``text`` string.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
         .. versionadded:: 2.7
         """
-        return cls.from_file(StringIO(text))
+        return cls.from_file(StringIO(text), **kwargs)
 
     @classmethod
-    def from_path(cls, path):
+    def from_path(cls, path, cache_dir=None, **kwargs):
         """
         Create a new, parsed `SSHConfig` from the file found at ``path``.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
+        :param str cache_dir:
+            Directory in which to keep a marshalled copy of the parsed config,
+            so that other processes can load it instead of parsing the file
+            again. The copy is keyed by the contents of the file and of all
+            files it includes, and ignored when any of them changed or when it
+            can't be read. By default, nothing is cached.
+
         .. versionadded:: 2.7
         """
-        with open(path) as flo:
-            return cls.from_file(flo)
+        if cache_dir is None:
+            with open(path) as flo:
+                return cls.from_file(flo, **kwargs)
+
+        obj = cls(**kwargs)
+        with open(path, "rb") as flo:
+            data = flo.read()
+        cache_file = os.path.join(
+            cache_dir,
+            sha1(os.path.abspath(path).encode()).hexdigest() + ".marshal",
+        )
+        base_dir = _include_base_dir(path)
+        if not obj._load_cache(cache_file, data, base_dir):
+            # Decoded the same way as by open() in text mode
+            obj._parse(TextIOWrapper(BytesIO(data)), base_dir)
+            obj._save_cache(cache_file, data, base_dir)
+        return obj
 
     @classmethod
-    def from_file(cls, flo):
+    def from_file(cls, flo, **kwargs):
         """
         Create a new, parsed `SSHConfig` from file-like object ``flo``.
 
+        Keyword arguments are passed on to the `SSHConfig` constructor.
+
         .. versionadded:: 2.7
         """
-        obj = cls()
+        obj = cls(**kwargs)
         obj.parse(flo)
         return obj
 
@@ -367,12 +472,124 @@ class SSHConfig:
         """
         Read an OpenSSH config from the given file object.
 
+        ``Include`` directives are followed, with glob patterns and paths
+        relative to ``~/.ssh`` (or ``/etc/ssh`` for files within it) just like
+        in OpenSSH, up to `MAX_INCLUDE_DEPTH` levels deep.
+
         :param file_obj: a file-like object to read the config file from
         """
+        base_dir = _include_base_dir(getattr(file_obj, "name", None))
+        self._parse(file_obj, base_dir)
+
+    def _parse(self, file_obj, base_dir):
+        # Previous lookup results may not hold anymore
+        with self._lookup_cache_lock:
+            self._lookup_cache.clear()
         # Start out w/ implicit/anonymous global host-like block to hold
         # anything not contained by an explicit one.
         context = {"host": ["*"], "config": {}}
-        for line in file_obj:
+        context = self._apply_lines(
+            self._read_lines(file_obj), context, base_dir, depth=0
+        )
+        # Store last 'open' block and we're done
+        if "config" in context:
+            self._config.append(context)
+        self._index_config()
+
+    def _load_cache(self, cache_file, data, base_dir):
+        """
+        Load the config from ``cache_file``, written by `_save_cache`.
+
+        :param bytes data: Contents of the config file.
+        :returns:
+            Whether the cache was loaded, i.e. it could be read and neither the
+            config file nor any of its included files changed since.
+        """
+        try:
+            with open(cache_file, "rb") as flo:
+                cached = marshal.loads(flo.read())
+            (
+                format_,
+                digest,
+                cached_base_dir,
+                includes,
+                deps,
+                config,
+                index,
+            ) = cached
+            if (
+                format_ != CACHE_FORMAT
+                or digest != sha1(data).hexdigest()
+                or cached_base_dir != base_dir
+            ):
+                return False
+            for pattern, paths in includes.items():
+                if sorted(glob.glob(pattern)) != paths:
+                    return False
+            for path, dep_digest in deps.items():
+                with open(path, "rb") as flo:
+                    if sha1(flo.read()).hexdigest() != dep_digest:
+                        return False
+            # Host patterns are compiled on demand, as most are never needed
+            self._config = config
+            self._includes = includes
+            self._include_digests = deps
+            self._literal_index, self._unindexed = index
+            self._host_patterns = [None] * len(config)
+        except Exception:
+            # Unreadable, corrupt or written in an unknown format; parsing the
+            # config again is always safe
+            self._config = []
+            self._includes = {}
+            self._include_digests = {}
+            self._literal_index, self._unindexed = {}, []
+            return False
+        return True
+
+    def _save_cache(self, cache_file, data, base_dir):
+        """
+        Write the parsed config to ``cache_file``, for `_load_cache`.
+        """
+        try:
+            # The digests of what was parsed, and not of the files as they are
+            # now, which may have changed since
+            deps = self._include_digests
+            if None in deps.values():
+                # A file changed while it was being included several times
+                return
+            cached = marshal.dumps(
+                (
+                    CACHE_FORMAT,
+                    sha1(data).hexdigest(),
+                    base_dir,
+                    self._includes,
+                    deps,
+                    self._config,
+                    (self._literal_index, self._unindexed),
+                )
+            )
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Replace the file atomically, so that it's never read half-written
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_file, "wb") as flo:
+                flo.write(cached)
+            os.replace(tmp_file, cache_file)
+        except (OSError, ValueError):
+            # Caching is best effort
+            pass
+
+    def _read_lines(self, file_obj):
+        """
+        Read a config file into a list of ``(key, value)`` tuples.
+
+        Keys are lowercased, and values are processed according to the key,
+        e.g. ``Host`` values are split into a list of patterns.
+        """
+        # Splitting the whole buffer is much faster than iterating over lines,
+        # and yields the same lines ("\n" is what both split on)
+        read = getattr(file_obj, "read", None)
+        lines = []
+        for line in read().split("\n") if read is not None else file_obj:
             # Strip any leading or trailing whitespace from the line.
             # Refer to https://github.com/paramiko/paramiko/issues/499
             line = line.strip()
@@ -380,16 +597,70 @@ class SSHConfig:
             if not line or line.startswith("#"):
                 continue
 
-            # Parse line into key, value
-            match = re.match(self.SETTINGS_REGEX, line)
-            if not match:
-                raise ConfigParseError("Unparsable line {}".format(line))
-            key = match.group(1).lower()
-            value = match.group(2)
+            # Parse line into key, value. The common "Key value" and
+            # "Key=value" forms are split without a regex, in ways that give
+            # the same results as SETTINGS_REGEX.
+            key, _, value = line.partition(" ")
+            if not (
+                key.isalnum()
+                and value
+                and value[0] != "="
+                and not value[0].isspace()
+            ):
+                key, _, value = line.partition("=")
+                if not (key.isalnum() and value and not value[0].isspace()):
+                    match = re.match(self.SETTINGS_REGEX, line)
+                    if not match:
+                        raise ConfigParseError(
+                            "Unparsable line {}".format(line)
+                        )
+                    key = match.group(1)
+                    value = match.group(2)
+            key = key.lower()
+
+            if key == "host":
+                value = self._get_hosts(value)
+            elif key == "match":
+                value = self._get_matches(value)
+            elif key == "include":
+                try:
+                    value = _split_words(value)
+                except ValueError:
+                    raise ConfigParseError(
+                        "Unparsable include {}".format(value)
+                    )
+            # Special-case for noop ProxyCommands
+            elif key == "proxycommand" and value.lower() == "none":
+                # Store 'none' as None - not as a string implying that the
+                # proxycommand is the literal shell command "none"!
+                value = None
+            elif value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            lines.append((key, value))
+        return lines
 
+    def _apply_lines(self, lines, context, base_dir, depth, guard=None):
+        """
+        Add the stanzas described by ``lines`` (from `_read_lines`) to the
+        config.
+
+        :param context:
+            The context which is open at the start of ``lines``. Contexts
+            without a ``"config"`` key yet are only added to the config once
+            an option is set in them.
+        :param guard:
+            Condition (``"host"`` or ``"matches"``, and maybe a ``"guard"`` of
+            its own) which stanzas started by ``lines`` additionally need to
+            match, for files included from within a ``Host`` or ``Match``
+            block.
+
+        :returns: The context which is still open at the end of ``lines``.
+        """
+        for key, value in lines:
             # Host keyword triggers switch to new block/context
             if key in ("host", "match"):
-                self._config.append(context)
+                if "config" in context:
+                    self._config.append(context)
                 context = {"config": {}}
                 if key == "host":
                     # TODO 4.0: make these real objects or at least name this
@@ -397,19 +668,17 @@ class SSHConfig:
                     # to 3.0, despite it being a private API, feels bad -
                     # surely such an old codebase has folks actually relying on
                     # these keys.)
-                    context["host"] = self._get_hosts(value)
+                    context["host"] = value[:]
                 else:
-                    context["matches"] = self._get_matches(value)
-            # Special-case for noop ProxyCommands
-            elif key == "proxycommand" and value.lower() == "none":
-                # Store 'none' as None - not as a string implying that the
-                # proxycommand is the literal shell command "none"!
-                context["config"][key] = None
+                    context["matches"] = value
+                if guard is not None:
+                    context["guard"] = guard
+            elif key == "include":
+                context = self._include(value, context, base_dir, depth)
             # All other keywords get stored, directly or via append
             else:
-                if value.startswith('"') and value.endswith('"'):
-                    value = value[1:-1]
-
+                if "config" not in context:
+                    context = dict(context, config={})
                 # identityfile, localforward, remoteforward keys are special
                 # cases, since they are allowed to be specified multiple times
                 # and they should be tried in order of specification.
@@ -418,12 +687,142 @@ class SSHConfig:
                         context["config"][key].append(value)
                     else:
                         context["config"][key] = [value]
+                # A noop ProxyCommand (None, see _read_lines) overrides any
+                # earlier ProxyCommand of the stanza.
+                elif key == "proxycommand" and value is None:
+                    context["config"][key] = None
                 elif key not in context["config"]:
                     context["config"][key] = value
-        # Store last 'open' block and we're done
-        self._config.append(context)
+        return context
+
+    def _include(self, patterns, context, base_dir, depth):
+        """
+        Handle an ``Include`` of ``patterns`` within the open ``context``.
+
+        Like in OpenSSH, included files are read as if their contents were
+        found in place of the ``Include``: their leading options belong to the
+        enclosing block, and their stanzas only apply when that block does.
+        Each file is only parsed again when it changed (see `_read_fragment`).
+
+        :returns:
+            The context in which the rest of the enclosing block continues.
+        """
+        if depth >= MAX_INCLUDE_DEPTH:
+            raise ConfigParseError(
+                "Maximum Include depth of {} exceeded".format(
+                    MAX_INCLUDE_DEPTH
+                )
+            )
+        if "config" in context:
+            self._config.append(context)
+        condition = {
+            key: context[key]
+            for key in ("host", "matches", "guard")
+            if key in context
+        }
+        # No need to check the implicit global block
+        guard = None if condition == {"host": ["*"]} else condition
+        for pattern in patterns:
+            pattern = os.path.join(base_dir, os.path.expanduser(pattern))
+            paths = sorted(glob.glob(pattern))
+            self._includes[pattern] = paths
+            for path in paths:
+                lines, digest = _read_fragment(self, path)
+                if self._include_digests.get(path, digest) != digest:
+                    digest = None
+                self._include_digests[path] = digest
+                # Each file starts back in the enclosing block, like OpenSSH
+                # does, rather than in the last block of the previous file
+                context = self._apply_lines(
+                    lines,
+                    condition,
+                    base_dir,
+                    depth + 1,
+                    guard,
+                )
+                if "config" in context:
+                    self._config.append(context)
+        return condition
 
-    def lookup(self, hostname):
+    def get_includes(self):
+        """
+        Return a dict of the ``Include`` patterns (made absolute) seen while
+        parsing, mapped to the sorted list of files each of them matched.
+        """
+        return {
+            pattern: paths[:] for pattern, paths in self._includes.items()
+        }
+
+    def _index_config(self):
+        """
+        Precompile the ``Host`` patterns of all stanzas.
+
+        Literal patterns are put into a map from hostname to the stanzas they
+        occur in, so that `_lookup` only has to evaluate those stanzas, plus
+        the ones which can't be indexed: stanzas with wildcard patterns (which
+        are compiled to a regex instead) and ``Match`` stanzas.
+
+        The token templates of their values are compiled along the way.
+        """
+        host_patterns, literal_index, unindexed = [], {}, []
+        for i, context in enumerate(self._config):
+            self._compile_templates(context)
+            if "host" not in context:
+                # Match criteria depend on the options obtained so far
+                host_patterns.append(None)
+                unindexed.append(i)
+                continue
+            patterns = _compile_patterns(tuple(context["host"]))
+            host_patterns.append(patterns)
+            literals, wildcards, _ = patterns
+            if wildcards is not None:
+                unindexed.append(i)
+                continue
+            # Stanzas with nothing but negated patterns never match
+            for literal in literals:
+                literal_index.setdefault(literal, []).append(i)
+        self._host_patterns = host_patterns
+        self._literal_index = literal_index
+        self._unindexed = unindexed
+
+    def _compile_templates(self, context):
+        """
+        Compile the token templates of the values of a stanza, for keys which
+        support tokens.
+        """
+        for key, value in context.get("config", {}).items():
+            if key not in self.TOKENS_BY_CONFIG_KEY or value is None:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                self._template(key, item)
+        if "matches" in context:
+            for match in context["matches"]:
+                if match["type"] == "exec":
+                    self._template("match-exec", match["param"])
+
+    def _template(self, key, value):
+        """
+        Return the compiled token template of ``value`` for config ``key``.
+
+        Templates are compiled when parsing, except after loading a cached
+        config, in which case they're compiled (once) on first use.
+
+        :returns:
+            A `str.format` template expanding the tokens allowed for ``key``
+            from a `_TokenContext`, or ``None`` if ``value`` has none.
+        """
+        if "%" not in value and "~" not in value:
+            return None
+        try:
+            return self._templates[key, value]
+        except KeyError:
+            pass
+        tokens = tuple(self._allowed_tokens(key))
+        template = _compile_template(value, tokens, key == "hostname")
+        self._templates[key, value] = template
+        return template
+
+    def lookup(self, hostname, lazy=False):
         """
         Return a dict (`SSHConfigDict`) of config options for a given hostname.
 
@@ -454,6 +853,9 @@ class SSHConfig:
             get to OpenSSH's behavior around that particular option.
 
         :param str hostname: the hostname to lookup
+        :param bool lazy:
+            Return a `LazySSHConfigDict`, which only expands the tokens of a
+            value when it is first read, instead of expanding them all upfront.
 
         .. versionchanged:: 2.5
             Returns `SSHConfigDict` objects instead of dict literals.
@@ -464,47 +866,162 @@ class SSHConfig:
         .. versionchanged:: 3.3
             Added ``Match final`` support.
         """
-        # First pass
-        options = self._lookup(hostname=hostname)
-        # Inject HostName if it was not set (this used to be done incidentally
-        # during tokenization, for some reason).
-        if "hostname" not in options:
-            options["hostname"] = hostname
-        # Handle canonicalization
-        canon = options.get("canonicalizehostname", None) in ("yes", "always")
-        maxdots = int(options.get("canonicalizemaxdots", 1))
-        if canon and hostname.count(".") <= maxdots:
-            # NOTE: OpenSSH manpage does not explicitly state this, but its
-            # implementation for CanonicalDomains is 'split on any whitespace'.
-            domains = options["canonicaldomains"].split()
-            hostname = self.canonicalize(hostname, options, domains)
-            # Overwrite HostName again here (this is also what OpenSSH does)
-            options["hostname"] = hostname
+        return self._lookup_all([hostname], _local_environment(), lazy=lazy)[0]
+
+    def lookup_many(self, hostnames, max_workers=None, lazy=False):
+        """
+        Return a list of `SSHConfigDict` objects for ``hostnames``, in order.
+
+        The results are the same as those of calling `lookup` for each of the
+        hostnames, but the local environment (user, hostname, home directory)
+        is only queried once for the whole batch.
+
+        :param hostnames: an iterable of hostnames to lookup
+        :param int max_workers:
+            If given, hostnames which need canonicalization are canonicalized
+            in parallel, in a pool of up to this many threads. Otherwise they
+            are canonicalized one after the other.
+        :param bool lazy: return `LazySSHConfigDict` objects, as with `lookup`
+        """
+        return self._lookup_all(
+            list(hostnames), _local_environment(), max_workers, lazy
+        )
+
+    def _lookup_all(self, hostnames, env, max_workers=None, lazy=False):
+        results = [None] * len(hostnames)
+        pending = []
+        for i, hostname in enumerate(hostnames):
+            if self._lookup_cache_size > 0:
+                with self._lookup_cache_lock:
+                    cached = self._lookup_cache.get(hostname)
+                    if cached is not None:
+                        self._lookup_cache.move_to_end(hostname)
+                        results[i] = _copy_options(cached, lazy)
+                        continue
+            # Keeps track of whether the result depends on anything but the
+            # config itself (e.g. the outcome of a 'Match exec' command)
+            volatile = set()
+            # First pass
             options = self._lookup(
-                hostname, options, canonical=True, final=True
+                hostname=hostname, volatile=volatile, env=env
             )
+            # Inject HostName if it was not set (this used to be done
+            # incidentally during tokenization, for some reason).
+            if "hostname" not in options:
+                options["hostname"] = hostname
+            pending.append((i, hostname, options, volatile))
+
+        # Handle canonicalization, which may involve slow DNS lookups
+        to_canonicalize = []
+        for j, (_, hostname, options, _) in enumerate(pending):
+            domains = self._canonical_domains(hostname, options)
+            if domains is not None:
+                to_canonicalize.append((j, hostname, options, domains))
+        args = [item[1:] for item in to_canonicalize]
+        if max_workers is not None and len(args) > 1:
+            with ThreadPoolExecutor(max_workers) as executor:
+                names = list(
+                    executor.map(lambda a: self.canonicalize(*a), args)
+                )
         else:
+            names = [self.canonicalize(*a) for a in args]
+        canonical_names = {
+            item[0]: name for item, name in zip(to_canonicalize, names)
+        }
+
+        # Final pass
+        for j, (i, hostname, options, volatile) in enumerate(pending):
+            canonical = j in canonical_names
+            if canonical:
+                hostname = canonical_names[j]
+                # Overwrite HostName again here (this is also what OpenSSH
+                # does)
+                options["hostname"] = hostname
+                volatile.add("canonical")
             options = self._lookup(
-                hostname, options, canonical=False, final=True
+                hostname,
+                options,
+                canonical=canonical,
+                final=True,
+                volatile=volatile,
+                env=env,
+                lazy=lazy,
             )
-        return options
+            if self._lookup_cache_size > 0 and not volatile:
+                self._cache_lookup(hostname, options)
+            results[i] = options
+        return results
 
-    def _lookup(self, hostname, options=None, canonical=False, final=False):
+    def _canonical_domains(self, hostname, options):
+        """
+        Return the domains to canonicalize ``hostname`` with, given the
+        ``options`` of the first lookup pass, or ``None`` if it isn't to be
+        canonicalized.
+        """
+        canon = options.get("canonicalizehostname", None) in ("yes", "always")
+        maxdots = int(options.get("canonicalizemaxdots", 1))
+        if canon and hostname.count(".") <= maxdots:
+            # NOTE: OpenSSH manpage does not explicitly state this, but its
+            # implementation for CanonicalDomains is 'split on any whitespace'.
+            return options["canonicaldomains"].split()
+        return None
+
+    def _cache_lookup(self, hostname, options):
+        with self._lookup_cache_lock:
+            self._lookup_cache[hostname] = _copy_options(options)
+            self._lookup_cache.move_to_end(hostname)
+            while len(self._lookup_cache) > self._lookup_cache_size:
+                self._lookup_cache.popitem(last=False)
+
+    def _lookup(
+        self,
+        hostname,
+        options=None,
+        canonical=False,
+        final=False,
+        volatile=None,
+        env=None,
+        lazy=False,
+    ):
         # Init
         if options is None:
             options = SSHConfigDict()
-        # Iterate all stanzas, applying any that match, in turn (so that things
-        # like Match can reference currently understood state)
-        for context in self._config:
-            if not (
-                self._pattern_matches(context.get("host", []), hostname)
-                or self._does_match(
-                    context.get("matches", []),
-                    hostname,
-                    canonical,
-                    final,
-                    options,
-                )
+        if env is None:
+            env = _local_environment()
+        # Iterate all stanzas which may apply, in file order, applying any that
+        # match, in turn (so that things like Match can reference currently
+        # understood state)
+        key = os.path.normcase(hostname)
+        literal_stanzas = self._literal_index.get(key, [])
+        for i in heapq.merge(literal_stanzas, self._unindexed):
+            context = self._config[i]
+            if "host" in context:
+                host_patterns = self._host_patterns[i]
+                if host_patterns is None:
+                    # Not compiled yet, see _load_cache()
+                    host_patterns = _compile_patterns(tuple(context["host"]))
+                    self._host_patterns[i] = host_patterns
+                if not _patterns_match(host_patterns, hostname):
+                    continue
+            elif not self._does_match(
+                context["matches"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
+            ):
+                continue
+            # Stanzas of files included from within a Host or Match block
+            if "guard" in context and not self._guard_matches(
+                context["guard"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
             ):
                 continue
             for key, value in context["config"].items():
@@ -521,9 +1038,33 @@ class SSHConfig:
         if final:
             # Expand variables in resulting values
             # (besides 'Match exec' which was already handled above)
-            options = self._expand_variables(options, hostname)
+            options = self._expand_variables(options, hostname, env, lazy)
         return options
 
+    def _guard_matches(
+        self, guard, hostname, canonical, final, options, volatile, env
+    ):
+        """
+        Check the (nested) conditions of the blocks from within which a
+        stanza's file was included.
+        """
+        while guard is not None:
+            if "host" in guard:
+                if not self._pattern_matches(guard["host"], hostname):
+                    return False
+            elif not self._does_match(
+                guard["matches"],
+                hostname,
+                canonical,
+                final,
+                options,
+                volatile,
+                env,
+            ):
+                return False
+            guard = guard.get("guard")
+        return True
+
     def canonicalize(self, hostname, options, domains):
         """
         Return canonicalized version of ``hostname``.
@@ -534,28 +1075,18 @@ class SSHConfig:
 
         :returns: A canonicalized hostname if one was found, else ``None``.
 
+        :raises: `CouldNotCanonicalize` if no domain resolves and
+            ``CanonicalizeFallbackLocal`` is not ``yes``.
+
         .. versionadded:: 2.7
         """
-        found = False
-        for domain in domains:
-            candidate = "{}.{}".format(hostname, domain)
-            family_specific = _addressfamily_host_lookup(candidate, options)
-            if family_specific is not None:
-                # TODO: would we want to dig deeper into other results? e.g. to
-                # find something that satisfies PermittedCNAMEs when that is
-                # implemented?
-                found = family_specific[0]
-            else:
-                # TODO: what does ssh use here and is there a reason to use
-                # that instead of gethostbyname?
-                try:
-                    found = socket.gethostbyname(candidate)
-                except socket.gaierror:
-                    pass
-            if found:
-                # TODO: follow CNAME (implied by found != candidate?) if
-                # CanonicalizePermittedCNAMEs allows it
-                return candidate
+        # All the candidates are resolved at once, but the first domain
+        # which resolves still wins, like it does in OpenSSH
+        candidates = ["{}.{}".format(hostname, domain) for domain in domains]
+        # TODO: follow CNAME if CanonicalizePermittedCNAMEs allows it
+        found = self._resolver.first(candidates, _address_family(options))
+        if found is not None:
+            return found
         # If we got here, it means canonicalization failed.
         # When CanonicalizeFallbackLocal is undefined or 'yes', we just spit
         # back the original hostname.
@@ -579,25 +1110,23 @@ class SSHConfig:
         # Convenience auto-splitter if not already a list
         if hasattr(patterns, "split"):
             patterns = patterns.split(",")
-        match = False
-        for pattern in patterns:
-            # Short-circuit if target matches a negated pattern
-            if pattern.startswith("!") and fnmatch.fnmatch(
-                target, pattern[1:]
-            ):
-                return False
-            # Flag a match, but continue (in case of later negation) if regular
-            # match occurs
-            elif fnmatch.fnmatch(target, pattern):
-                match = True
-        return match
+        return _patterns_match(_compile_patterns(tuple(patterns)), target)
 
     def _does_match(
-        self, match_list, target_hostname, canonical, final, options
+        self,
+        match_list,
+        target_hostname,
+        canonical,
+        final,
+        options,
+        volatile=None,
+        env=None,
     ):
         matched = []
         candidates = match_list[:]
-        local_username = getpass.getuser()
+        if env is None:
+            env = _local_environment()
+        local_username = env["user"]
         while candidates:
             candidate = candidates.pop(0)
             passed = None
@@ -631,15 +1160,12 @@ class SSHConfig:
             elif type_ == "localuser":
                 passed = self._pattern_matches(param, local_username)
             elif type_ == "exec":
+                if volatile is not None:
+                    volatile.add("exec")
                 exec_cmd = self._tokenize(
-                    options, target_hostname, "match-exec", param
+                    options, target_hostname, "match-exec", param, env
                 )
-                # This is the laziest spot in which we can get mad about an
-                # inability to import Invoke.
-                if invoke is None:
-                    raise invoke_import_error
-                # Like OpenSSH, we 'redirect' stdout but let stderr bubble up
-                passed = invoke.run(exec_cmd, hide="stdout", warn=True).ok
+                passed = self._match_executor.run(exec_cmd)
             # Tackle any 'passed, but was negated' results from above
             if passed is not None and self._should_fail(passed, candidate):
                 return False
@@ -651,7 +1177,7 @@ class SSHConfig:
     def _should_fail(self, would_pass, candidate):
         return would_pass if candidate["negate"] else not would_pass
 
-    def _tokenize(self, config, target_hostname, key, value):
+    def _tokenize(self, config, target_hostname, key, value, env=None):
         """
         Tokenize a string based on current config/hostname data.
 
@@ -659,59 +1185,19 @@ class SSHConfig:
         :param target_hostname: Original target connection hostname.
         :param key: Config key being tokenized (used to filter token list).
         :param value: Config value being tokenized.
+        :param env: Local environment, from `_local_environment`.
 
         :returns: The tokenized version of the input ``value`` string.
         """
-        allowed_tokens = self._allowed_tokens(key)
         # Short-circuit if no tokenization possible
-        if not allowed_tokens:
+        template = self._template(key, value)
+        if template is None:
             return value
-        # Obtain potentially configured hostname, for use with %h.
-        # Special-case where we are tokenizing the hostname itself, to avoid
-        # replacing %h with a %h-bearing value, etc.
-        configured_hostname = target_hostname
-        if key != "hostname":
-            configured_hostname = config.get("hostname", configured_hostname)
-        # Ditto the rest of the source values
-        if "port" in config:
-            port = config["port"]
-        else:
-            port = SSH_PORT
-        user = getpass.getuser()
-        if "user" in config:
-            remoteuser = config["user"]
-        else:
-            remoteuser = user
-        local_hostname = socket.gethostname().split(".")[0]
-        local_fqdn = LazyFqdn(config, local_hostname)
-        homedir = os.path.expanduser("~")
-        tohash = local_hostname + target_hostname + repr(port) + remoteuser
-        # The actual tokens!
-        replacements = {
-            # TODO: %%???
-            "%C": sha1(tohash.encode()).hexdigest(),
-            "%d": homedir,
-            "%h": configured_hostname,
-            # TODO: %i?
-            "%L": local_hostname,
-            "%l": local_fqdn,
-            # also this is pseudo buggy when not in Match exec mode so document
-            # that. also WHY is that the case?? don't we do all of this late?
-            "%n": target_hostname,
-            "%p": port,
-            "%r": remoteuser,
-            # TODO: %T? don't believe this is possible however
-            "%u": user,
-            "~": homedir,
-        }
-        # Do the thing with the stuff
-        tokenized = value
-        for find, replace in replacements.items():
-            if find not in allowed_tokens:
-                continue
-            tokenized = tokenized.replace(find, str(replace))
+        if env is None:
+            env = _local_environment()
+        context = _TokenContext(config, target_hostname, env)
         # TODO: log? eg that value -> tokenized
-        return tokenized
+        return template.format_map(context)
 
     def _allowed_tokens(self, key):
         """
@@ -724,7 +1210,7 @@ class SSHConfig:
         """
         return self.TOKENS_BY_CONFIG_KEY.get(key, [])
 
-    def _expand_variables(self, config, target_hostname):
+    def _expand_variables(self, config, target_hostname, env=None, lazy=False):
         """
         Return a dict of config options with expanded substitutions
         for a given original & current target hostname.
@@ -733,24 +1219,52 @@ class SSHConfig:
 
         :param dict config: the currently parsed config
         :param str hostname: the hostname whose config is being looked up
+        :param dict env: local environment, from `_local_environment`
+        :param bool lazy:
+            return a `LazySSHConfigDict` expanding values on first access,
+            instead of expanding ``config`` in place
         """
-        for k in config:
-            if config[k] is None:
-                continue
-            tokenizer = partial(self._tokenize, config, target_hostname, k)
-            if isinstance(config[k], list):
-                for i, value in enumerate(config[k]):
-                    config[k][i] = tokenizer(value)
-            else:
-                config[k] = tokenizer(config[k])
+        if env is None:
+            env = _local_environment()
+        # Other tokens refer to the expanded hostname, so it goes first
+        if config.get("hostname") is not None:
+            config["hostname"] = self._tokenize(
+                config, target_hostname, "hostname", config["hostname"], env
+            )
+        # Shared by all the values, which are expanded from the same options
+        context = _TokenContext(config, target_hostname, env)
+        keys = [
+            k
+            for k in config
+            if k in self.TOKENS_BY_CONFIG_KEY
+            and k != "hostname"
+            and config[k] is not None
+        ]
+        expand = partial(self._expand_value, context)
+        if lazy:
+            return LazySSHConfigDict(config, expand, keys)
+        for k in keys:
+            config[k] = expand(k, config[k])
         return config
 
+    def _expand_value(self, context, key, value):
+        """
+        Expand the tokens of a ``value`` (or list of values) of config ``key``
+        from a `_TokenContext`.
+        """
+        if isinstance(value, list):
+            return [self._expand_value(context, key, x) for x in value]
+        template = self._template(key, value)
+        if template is None:
+            return value
+        return template.format_map(context)
+
     def _get_hosts(self, host):
         """
         Return a list of host_names from host value.
         """
         try:
-            return shlex.split(host)
+            return _split_words(host)
         except ValueError:
             raise ConfigParseError("Unparsable host {}".format(host))
 
@@ -761,7 +1275,7 @@ class SSHConfig:
         Performs some parse-time validation as well.
         """
         matches = []
-        tokens = shlex.split(match)
+        tokens = _split_words(match)
         while tokens:
             match = {"type": None, "param": None, "negate": False}
             type_ = tokens.pop(0)
@@ -799,41 +1313,574 @@ class SSHConfig:
         return matches
 
 
-def _addressfamily_host_lookup(hostname, options):
+@lru_cache(maxsize=1024)
+def _compile_patterns(patterns):
+    """
+    Compile a tuple of ``ssh_config`` patterns for `_patterns_match`.
+
+    :returns:
+        A 3-tuple of the set of literal patterns, a regex matching any of the
+        wildcard patterns and a regex matching any of the negated patterns. The
+        regexes are ``None`` when there are no such patterns.
+    """
+    literals, wildcards, negated = set(), [], []
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            negated.append(pattern[1:])
+        elif any(c in pattern for c in "*?["):
+            wildcards.append(pattern)
+        else:
+            literals.add(os.path.normcase(pattern))
+    return (
+        frozenset(literals),
+        _compile_fnmatch(wildcards),
+        _compile_fnmatch(negated),
+    )
+
+
+def _compile_fnmatch(patterns):
+    """
+    Compile ``fnmatch``-style ``patterns`` into a single regex, or ``None``.
+    """
+    if not patterns:
+        return None
+    return re.compile(
+        "|".join(fnmatch.translate(os.path.normcase(p)) for p in patterns)
+    )
+
+
+def _patterns_match(compiled, target):
+    """
+    Match ``target`` against patterns compiled by `_compile_patterns`.
+
+    Like OpenSSH, ``target`` matches if it matches any of the patterns, unless
+    it also matches any of the negated ones.
+    """
+    literals, wildcards, negated = compiled
+    target = os.path.normcase(target)
+    if negated is not None and negated.match(target):
+        return False
+    if target in literals:
+        return True
+    return wildcards is not None and wildcards.match(target) is not None
+
+
+# Backslashes and any whitespace which shlex doesn't split on (or str.split()
+# does), which are left to shlex itself
+_SHLEX_SPECIAL = re.compile(r"[\\]|[^\S \t]")
+# A word as split by shlex (in POSIX mode) when there are no escapes, and the
+# quoted parts within it
+_SHLEX_WORD = re.compile(r"""(?:[^ \t"']|"[^"]*"|'[^']*')+""")
+_SHLEX_QUOTED = re.compile(r""""([^"]*)"|'([^']*)'""")
+
+
+def _split_words(value):
+    """
+    Split ``value`` into words exactly like `shlex.split` does, without the
+    overhead of shlex in the common cases.
+    """
+    if _SHLEX_SPECIAL.search(value) is not None:
+        return shlex.split(value)
+    if '"' not in value and "'" not in value:
+        return value.split()
+    words, end = [], 0
+    for match in _SHLEX_WORD.finditer(value):
+        # Anything but spaces and tabs in between words is an unbalanced
+        # quote, for shlex to complain about
+        if value[end : match.start()].strip(" \t"):
+            return shlex.split(value)
+        words.append(_SHLEX_QUOTED.sub(_unquote, match.group()))
+        end = match.end()
+    if value[end:].strip(" \t"):
+        return shlex.split(value)
+    return words
+
+
+def _unquote(match):
+    double, single = match.groups()
+    return double if double is not None else single
+
+
+def _local_environment():
+    """
+    Return the local user, hostname and home directory, as needed by lookups.
+    """
+    return {
+        "user": getpass.getuser(),
+        "hostname": _local_host.hostname(),
+        "homedir": os.path.expanduser("~"),
+        "uid": str(os.getuid()) if hasattr(os, "getuid") else "",
+    }
+
+
+@lru_cache(maxsize=None)
+def _token_regex(tokens):
+    """
+    Compile a regex matching any of ``tokens``, e.g. ``("%%", "%h", "~")``.
+    """
+    return re.compile("|".join(re.escape(token) for token in tokens))
+
+
+def _compile_template(value, tokens, hostname=False):
+    """
+    Compile the ``tokens`` of ``value`` into a template for `str.format_map`,
+    so that all of them get replaced in a single pass.
+
+    Tokens become fields named after their last character (``%h`` is ``h``,
+    ``%%`` is ``%`` and ``~`` is ``~``), matching the names in
+    `_TokenContext`. With ``hostname``, ``%h`` is the original hostname, as
+    it is when expanding the ``HostName`` value itself.
+
+    :returns: The template, or ``None`` if ``value`` has no tokens.
+    """
+    parts, last = [], 0
+    for match in _token_regex(tokens).finditer(value):
+        literal = value[last : match.start()]
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        name = match.group()[-1]
+        if hostname and name == "h":
+            name = "n"
+        parts.append("{" + name + "}")
+        last = match.end()
+    if not parts:
+        return None
+    literal = value[last:]
+    parts.append(literal.replace("{", "{{").replace("}", "}}"))
+    return "".join(parts)
+
+
+class _TokenContext(dict):
+    """
+    Values of the tokens of `SSHConfig.TOKENS_BY_CONFIG_KEY`, by the field
+    names of `_compile_template`, for expanding the options of one lookup.
+
+    The costlier values (``%C`` and ``%l``) are only computed when used.
+    """
+
+    def __init__(self, config, target_hostname, env):
+        self.config = config
+        port = config.get("port", SSH_PORT)
+        remoteuser = config.get("user", env["user"])
+        local_hostname = env["hostname"].split(".")[0]
+        # Hashed as it always has been, to keep the same ControlPaths
+        self.tohash = local_hostname + target_hostname + repr(port)
+        self.tohash += remoteuser
+        super().__init__(
+            {
+                "%": "%",
+                "d": env["homedir"],
+                "h": config.get("hostname", target_hostname),
+                "i": env["uid"],
+                "j": config.get("proxyjump") or "",
+                "k": config.get("hostkeyalias", target_hostname),
+                "L": local_hostname,
+                # also this is pseudo buggy when not in Match exec mode so
+                # document that. also WHY is that the case?? don't we do all
+                # of this late?
+                "n": target_hostname,
+                "p": str(port),
+                "r": remoteuser,
+                # Tunnels aren't supported, which OpenSSH expands to NONE
+                "T": "NONE",
+                "u": env["user"],
+                "~": env["homedir"],
+            }
+        )
+
+    def __missing__(self, name):
+        if name == "C":
+            value = sha1(self.tohash.encode()).hexdigest()
+        elif name == "l":
+            family = _address_family(self.config)
+            value = _local_host.fqdn(family, self["L"])
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+
+def _include_base_dir(path):
+    """
+    Return the directory relative to which the config file at ``path``
+    resolves relative ``Include`` paths: ``/etc/ssh`` for system-wide config
+    files and ``~/.ssh`` for all others (just like in OpenSSH).
+    """
+    if isinstance(path, str) and os.path.abspath(path).startswith("/etc/ssh/"):
+        return "/etc/ssh"
+    return os.path.expanduser("~/.ssh")
+
+
+_fragments = {}
+_fragments_lock = threading.Lock()
+
+
+def _read_fragment(config, path):
     """
-    Try looking up ``hostname`` in an IPv4 or IPv6 specific manner.
+    Return the lines of the included config file at ``path``, as read by
+    `SSHConfig._read_lines`, and the SHA-1 of the contents they were read
+    from.
 
-    This is an odd duck due to needing use in two divergent use cases. It looks
-    up ``AddressFamily`` in ``options`` and if it is ``inet`` or ``inet6``,
-    this function uses `socket.getaddrinfo` to perform a family-specific
-    lookup, returning the result if successful.
+    Files are cached by their modification time and size, so that including
+    the same files again (e.g. after another of them changed) doesn't need to
+    parse them again.
+    """
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _fragments_lock:
+        cached = _fragments.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1], cached[2]
+    with open(path, "rb") as flo:
+        data = flo.read()
+    digest = sha1(data).hexdigest()
+    # Decoded the same way as by open() in text mode
+    lines = config._read_lines(TextIOWrapper(BytesIO(data)))
+    with _fragments_lock:
+        _fragments[path] = (signature, lines, digest)
+    return lines, digest
+
+
+def _copy_options(options, lazy=None):
+    """
+    Return a copy of lookup result ``options`` that shares no lists with it.
+
+    :param bool lazy:
+        Whether to return a `LazySSHConfigDict`, or an `SSHConfigDict` with
+        all values expanded. By default, the copy is of the same type.
+    """
+    if lazy is None:
+        lazy = isinstance(options, LazySSHConfigDict)
+    if isinstance(options, LazySSHConfigDict):
+        copy = options.copy()
+        return copy if lazy else SSHConfigDict(copy.items())
+    copy = SSHConfigDict(
+        (key, value[:] if isinstance(value, list) else value)
+        for key, value in options.items()
+    )
+    return LazySSHConfigDict(copy, None, ()) if lazy else copy
 
-    In any other situation -- lookup failure, or ``AddressFamily`` being
-    unspecified or ``any`` -- ``None`` is returned instead and the caller is
-    expected to do something situation-appropriate like calling
-    `socket.gethostbyname`.
 
-    :param str hostname: Hostname to look up.
-    :param options: `SSHConfigDict` instance w/ parsed options.
-    :returns: ``getaddrinfo``-style tuples, or ``None``, depending.
+def _address_family(options):
+    """
+    Return the `socket.AddressFamily` for the ``AddressFamily`` of
+    ``options``, with ``AF_UNSPEC`` standing for ``any``.
     """
     address_family = options.get("addressfamily", "any").lower()
     if address_family == "any":
-        return
+        return socket.AF_UNSPEC
+    if address_family == "inet":
+        return socket.AF_INET
+    return socket.AF_INET6
+
+
+def _resolve_fqdn(family, host):
+    """
+    Return the FQDN of local ``host``, looked up in ``family`` if specific.
+    """
+    #
+    # If the SSH config contains AddressFamily, use that when determining the
+    # local host's FQDN. Using socket.getfqdn() from the standard library is
+    # the most general solution, but can result in noticeable delays on some
+    # platforms when IPv6 is misconfigured or not available, as it calls
+    # getaddrinfo with no address family specified, so both IPv4 and IPv6 are
+    # checked.
+    #
+    if family != socket.AF_UNSPEC:
+        try:
+            results = socket.getaddrinfo(
+                host,
+                None,
+                family,
+                socket.SOCK_DGRAM,
+                socket.IPPROTO_IP,
+                socket.AI_CANONNAME,
+            )
+        except socket.gaierror:
+            results = []
+        for af, socktype, proto, canonname, sa in results:
+            if canonname and "." in canonname:
+                return canonname
+    # Handle 'any' / unspecified / lookup failure
+    return socket.getfqdn()
+
+
+class LocalHostResolver:
+    """
+    Process-wide cache of the local hostname and FQDN, as used by the ``%L``
+    and ``%l`` tokens.
+
+    FQDNs are cached per `socket.AddressFamily` for ``ttl`` seconds. Once
+    expired, the previous FQDN keeps being returned while a new one is looked
+    up in the background. When there is no previous FQDN to return, the
+    lookup is waited for for up to ``timeout`` seconds, after which the
+    hostname is returned instead (like OpenSSH's ``%l`` without a domain)
+    and the FQDN is used as soon as the lookup finishes.
+    """
+
+    def __init__(self, ttl=LOCAL_HOST_TTL, timeout=LOCAL_FQDN_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Key -> (value, expiry time)
+        self._entries = {}
+        # FQDN key -> event set when its lookup finishes
+        self._resolving = {}
+
+    def hostname(self):
+        """
+        Return the local hostname, from `socket.gethostname`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get("hostname")
+            if entry is not None and now < entry[1]:
+                return entry[0]
+        hostname = socket.gethostname()
+        with self._lock:
+            self._entries["hostname"] = (hostname, now + self.ttl)
+        return hostname
+
+    def fqdn(self, family=socket.AF_UNSPEC, host=None):
+        """
+        Return the FQDN of the local host.
+
+        :param family:
+            The `socket.AddressFamily` to look it up in, with ``AF_UNSPEC``
+            for any.
+        :param str host:
+            The local hostname to look up, by default the first component of
+            `hostname`.
+        """
+        if host is None:
+            host = self.hostname().split(".")[0]
+        key = (family, host)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[1]:
+                return entry[0]
+            done = self._resolving.get(key)
+            if done is None:
+                done = self._resolving[key] = threading.Event()
+                threading.Thread(
+                    target=self._resolve,
+                    args=(key, done),
+                    name="paramiko-fqdn",
+                    daemon=True,
+                ).start()
+        if entry is not None:
+            return entry[0]
+        if done.wait(self.timeout):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0]
+        return self.hostname()
+
+    def clear(self):
+        """
+        Forget all cached values, e.g. after the hostname changed.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _resolve(self, key, done):
+        try:
+            fqdn = _resolve_fqdn(*key)
+        except OSError:
+            fqdn = None
+        with self._lock:
+            if fqdn is not None:
+                self._entries[key] = (fqdn, time.monotonic() + self.ttl)
+            del self._resolving[key]
+        done.set()
+
+
+_local_host = LocalHostResolver()
+
+
+def _resolve_host(hostname, family):
+    """
+    Return an address of ``hostname``, looked up in ``family`` if specific,
+    or ``None`` if it doesn't resolve.
+    """
+    if family != socket.AF_UNSPEC:
+        try:
+            return socket.getaddrinfo(
+                hostname,
+                None,
+                family,
+                socket.SOCK_DGRAM,
+                socket.IPPROTO_IP,
+                socket.AI_CANONNAME,
+            )[0][4][0]
+        except socket.gaierror:
+            pass
+    # TODO: what does ssh use here and is there a reason to use that instead
+    # of gethostbyname?
     try:
-        family = socket.AF_INET6
-        if address_family == "inet":
-            family = socket.AF_INET
-        return socket.getaddrinfo(
-            hostname,
-            None,
-            family,
-            socket.SOCK_DGRAM,
-            socket.IPPROTO_IP,
-            socket.AI_CANONNAME,
-        )
+        return socket.gethostbyname(hostname)
     except socket.gaierror:
-        pass
+        return None
+
+
+class HostResolver:
+    """
+    Resolver of the candidate hostnames of canonicalization, with a cache.
+
+    Outcomes are cached per hostname and `socket.AddressFamily`, for ``ttl``
+    seconds when the hostname resolves and ``negative_ttl`` seconds when it
+    doesn't, and concurrent requests for the same hostname share a single
+    lookup.
+
+    :param resolve:
+        The callable doing the actual lookups, given a hostname and an
+        address family (``AF_UNSPEC`` for any) and returning an address, or
+        ``None`` if the hostname doesn't resolve. By default, uses `socket`.
+        Handy to substitute a stub in tests.
+    """
+
+    def __init__(
+        self,
+        resolve=None,
+        ttl=CANONICAL_TTL,
+        negative_ttl=CANONICAL_NEGATIVE_TTL,
+    ):
+        self.resolve = resolve if resolve is not None else _resolve_host
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # (hostname, family) -> (address or None, expiry time)
+        self._entries = {}
+        # (hostname, family) -> event set when its lookup finishes
+        self._resolving = {}
+
+    def first(self, hostnames, family=socket.AF_UNSPEC):
+        """
+        Return the first of ``hostnames`` which resolves, or ``None``.
+
+        All of them are looked up concurrently, so this takes as long as the
+        slowest lookup up to the first hostname which resolves, instead of
+        the sum of them all.
+        """
+        pending = [(x, self._start(x, family)) for x in hostnames]
+        for hostname, done in pending:
+            done.wait()
+            with self._lock:
+                address, _ = self._entries.get((hostname, family), (None, 0))
+            if address is not None:
+                return hostname
+        return None
+
+    def clear(self):
+        """
+        Forget all cached outcomes.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _start(self, hostname, family):
+        """
+        Start looking ``hostname`` up unless its outcome is cached, returning
+        an event set once it is.
+        """
+        key = (hostname, family)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                return _DONE
+            done = self._resolving.get(key)
+            if done is None:
+                done = self._resolving[key] = threading.Event()
+                threading.Thread(
+                    target=self._resolve,
+                    args=(key, done),
+                    name="paramiko-canonicalize",
+                    daemon=True,
+                ).start()
+        return done
+
+    def _resolve(self, key, done):
+        address = None
+        try:
+            address = self.resolve(*key)
+        except (OSError, UnicodeError):
+            pass
+        finally:
+            ttl = self.ttl if address is not None else self.negative_ttl
+            with self._lock:
+                self._entries[key] = (address, time.monotonic() + ttl)
+                del self._resolving[key]
+            done.set()
+
+
+_host_resolver = HostResolver()
+
+# Returned by `HostResolver._start` for cached outcomes
+_DONE = threading.Event()
+_DONE.set()
+
+
+class MatchExecutor:
+    """
+    Runner of ``Match exec`` commands, with a cache of their outcomes.
+
+    Commands are run with the shell, like OpenSSH does, and pass if they exit
+    with status 0. Those still running after ``timeout`` seconds are killed
+    and fail. Outcomes are cached per (expanded) command for ``ttl`` seconds,
+    ``0`` disabling the cache.
+
+    ``executions`` counts the commands which were run, and ``avoided`` the
+    ones which weren't thanks to the cache.
+    """
+
+    def __init__(self, timeout=MATCH_EXEC_TIMEOUT, ttl=MATCH_EXEC_TTL):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.executions = 0
+        self.avoided = 0
+        self._lock = threading.Lock()
+        # Command -> (passed, expiry time)
+        self._entries = {}
+
+    def run(self, command):
+        """
+        Return whether ``command`` passes, running it unless cached.
+        """
+        with self._lock:
+            entry = self._entries.get(command)
+            if entry is not None and time.monotonic() < entry[1]:
+                self.avoided += 1
+                return entry[0]
+            self.executions += 1
+        try:
+            # Like OpenSSH, we 'redirect' stdout but let stderr bubble up
+            passed = (
+                subprocess.run(
+                    command,
+                    shell=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    timeout=self.timeout,
+                ).returncode
+                == 0
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            passed = False
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[command] = (passed, time.monotonic() + self.ttl)
+        return passed
+
+    def clear(self):
+        """
+        Forget all cached outcomes.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_match_executor = MatchExecutor()
 
 
 class LazyFqdn:
@@ -848,29 +1895,9 @@ class LazyFqdn:
 
     def __str__(self):
         if self.fqdn is None:
-            #
-            # If the SSH config contains AddressFamily, use that when
-            # determining  the local host's FQDN. Using socket.getfqdn() from
-            # the standard library is the most general solution, but can
-            # result in noticeable delays on some platforms when IPv6 is
-            # misconfigured or not available, as it calls getaddrinfo with no
-            # address family specified, so both IPv4 and IPv6 are checked.
-            #
-
-            # Handle specific option
-            fqdn = None
-            results = _addressfamily_host_lookup(self.host, self.config)
-            if results is not None:
-                for res in results:
-                    af, socktype, proto, canonname, sa = res
-                    if canonname and "." in canonname:
-                        fqdn = canonname
-                        break
-            # Handle 'any' / unspecified / lookup failure
-            if fqdn is None:
-                fqdn = socket.getfqdn()
-            # Cache
-            self.fqdn = fqdn
+            self.fqdn = _local_host.fqdn(
+                _address_family(self.config), self.host
+            )
         return self.fqdn
 
 
@@ -937,12 +1964,147 @@ class SSHConfigDict(dict):
         .. versionadded:: 2.5
         """
         return int(self[key])
-# ========================================================================
+
+
+class LazySSHConfigDict(SSHConfigDict):
+    """
+    An `SSHConfigDict` which expands the tokens of a value the first time it
+    is read, and then keeps the expanded value.
+
+    Returned by `SSHConfig.lookup` when called with ``lazy=True``, for callers
+    which only need some of the options: tokens such as ``%C`` (a SHA-1
+    hash) or ``%l`` (the local FQDN) then cost nothing unless one of the
+    values read uses them.
+
+    Every way of reading values (indexing, `get`, `pop`, `popitem`, the
+    `items` and `values` views, copies made with ``dict()``, `copy`, the
+    `copy` module or `pickle`) yields expanded values, values set by callers
+    (also through `update`, `setdefault` or ``|=``) are never expanded, and
+    results compare equal to the `SSHConfigDict` `SSHConfig.lookup` would
+    have returned otherwise.
+    """
+
+    def __init__(self, options=(), expand=None, keys=()):
+        """
+        :param options: the options of the lookup, with unexpanded values
+        :param expand:
+            a callable expanding the value of a key, given the key and value
+        :param keys: the keys whose values may need expanding
+        """
+        super().__init__(options)
+        self._expand = expand
+        self._unexpanded = set(keys)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if key not in self._unexpanded:
+            return super().__getitem__(key)
+        with self._lock:
+            value = super().__getitem__(key)
+            if key in self._unexpanded:
+                value = self._expand(key, value)
+                super().__setitem__(key, value)
+                self._unexpanded.discard(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self._unexpanded.discard(key)
+
+    def __iter__(self):
+        # Merely defining this makes dict() and dict.update() go through
+        # keys() and __getitem__, instead of copying unexpanded values
+        return super().__iter__()
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super().pop(key, *args)
+
+    def popitem(self):
+        with self._lock:
+            key, value = super().popitem()
+            if key in self._unexpanded:
+                value = self._expand(key, value)
+                self._unexpanded.discard(key)
+            return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        # dict.update() would store values without going through __setitem__
+        for other in args + (kwargs,):
+            if hasattr(other, "keys"):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def __reduce__(self):
+        # Used by the copy module and pickle, which would otherwise copy the
+        # unexpanded values (and fail on the lock)
+        return type(self), (dict(self.items()),)
+
+    def copy(self):
+        """
+        Return a copy, which shares no lists with this one and expands the
+        values which haven't been expanded yet on its own.
+        """
+        with self._lock:
+            options = {
+                key: value[:] if isinstance(value, list) else value
+                for key, value in super().items()
+            }
+            return type(self)(options, self._expand, self._unexpanded)
+# ========================================================================
 
 # Path to SSH config file (should be standard), needed to lookup host names and retrieve
 # corresponding user names
 SSH_CONFIG_FILE = "~/.ssh/config"
 
+# Number of host lookups in the SSH config file to memoize
+SSH_LOOKUP_CACHE_SIZE = 256
+
+# Whether to keep parsed SSH config files in kitty's cache dir, so that they don't need
+# to be parsed again when kitty starts
+SSH_CONFIG_DISK_CACHE = True
+
 # Whether to add padding to title of tabs
 PADDED_TABS = False
 
@@ -958,10 +2120,17 @@ RIGHT_SEP = ""
 SOFT_SEP = "│"
 PADDING = " "
 BRANCH_ICON = "󰘬"
+GIT_DIRTY_MARK = "*"
+GIT_AHEAD_MARK = "↑"
+GIT_BEHIND_MARK = "↓"
+GIT_STASH_MARK = "≡"
 ELLIPSIS = "…"
 USER_ICON = ""
 HOST_ICON = "󱡶"
 PAGER_ICON = "󰦪"
+LOAD_ICON = "󰓅"
+KUBE_ICON = "󱃾"
+VENV_ICON = ""
 
 # Colors
 SOFT_SEP_COLOR = Color(89, 89, 89)
@@ -971,6 +2140,75 @@ ACCENTED_ICON_BG_COLOR = Color(53, 132, 228)
 
 MAX_BRANCH_LEN = 21
 
+# Name of the user variable through which shells in SSH sessions report their Git branch
+REMOTE_GIT_BRANCH_USER_VAR = "git_branch"
+
+# Status segments shown on the right-hand side, from left to right. Besides "git" and
+# "identity" (user and host), "venv", "kube" (Kubernetes context) and "load" (load
+# average) are available, see the status_segment() definitions.
+RHS_STATUS_SEGMENTS = ("git", "identity")
+
+# Number of threads computing status segments
+STATUS_SEGMENT_WORKERS = 4
+
+# Interval (in seconds) at which status information of the active window is refreshed in
+# the background, and at which the tab bar is redrawn if that information changed
+STATUS_REFRESH_INTERVAL = 1.0
+
+# Minimum interval (in seconds) between two status refreshes of the same window, and
+# delay after which a window becoming active gets refreshed. While switching tabs
+# quickly, the last known status of each window is shown and only the window the user
+# settles on is refreshed, once they stop switching.
+STATUS_MIN_REFRESH_INTERVAL = 0.5
+STATUS_REFRESH_DEBOUNCE = 0.15
+
+# Interval (in seconds) after which cached Git information is checked for changes, when
+# they can't be watched for (e.g. on systems without inotify)
+GIT_CACHE_POLL_INTERVAL = 2.0
+
+# Whether to show the working tree status (uncommitted changes, commits ahead of and
+# behind upstream, stashes) next to the branch name
+SHOW_GIT_STATUS = True
+
+# Time budget (in seconds) for "git status", and minimum interval between two runs in
+# the same repository. Repositories where it runs out of time are retried after a
+# backoff, while the last known status keeps being shown.
+GIT_STATUS_TIMEOUT = 0.5
+GIT_STATUS_INTERVAL = 5.0
+GIT_STATUS_BACKOFF = 60.0
+
+# Time budget (in seconds) for "git branch", which is only run for repositories whose
+# HEAD can't be read directly
+GIT_BRANCH_TIMEOUT = 0.5
+
+# Mounts (e.g. sshfs or NFS) on which looking up the branch ran out of its time budget
+# SLOW_FS_FAILURES times in a row are left alone for SLOW_FS_COOLDOWN seconds. In the
+# meantime, the last known branch is shown next to SLOW_FS_MARK.
+SLOW_FS_FAILURES = 3
+SLOW_FS_COOLDOWN = 60.0
+SLOW_FS_MARK = "slow fs"
+
+# Interval (in seconds) after which the list of mounts is read again
+MOUNT_TABLE_TTL = 30.0
+
+# Whether to record how long each phase of rendering the tab bar takes. Creating a file
+# named TIMINGS_REQUEST_FILE in kitty's runtime dir dumps the recorded timings to
+# TIMINGS_DUMP_FILE in the same directory.
+PROFILE_TAB_BAR = False
+TIMINGS_REQUEST_FILE = "tab_bar_timings.request"
+TIMINGS_DUMP_FILE = "tab_bar_timings.txt"
+
+# Time budget (in seconds) for drawing the whole tab bar, frames exceeding it are logged
+# along with their slowest phase when profiling
+FRAME_BUDGET = 0.004
+
+# Whether to replay the cells drawn for a tab in a previous frame when the tab hasn't
+# changed. Tabs are considered unchanged as long as their id, title, state, index and
+# maximum length are, so disable this when the tab title template refers to anything
+# else (e.g. the working directory of the active window).
+CACHE_TAB_LAYOUTS = True
+TAB_LAYOUT_CACHE_SIZE = 1024
+
 MIN_TAB_LEN = (
     len(LEFT_SEP)
     + len(RIGHT_SEP)
@@ -996,6 +2234,219 @@ class Button:
 buttons: List[Button] = []
 
 
+class PhaseTimer:
+    """Record timing histograms for the phases of rendering the tab bar.
+
+    Phases timed on the thread drawing a frame (between begin_frame() and end_frame())
+    are also accounted to that frame, so that frames over FRAME_BUDGET can be reported
+    along with their slowest phase. Phases run by the status collector are only recorded
+    in the histograms.
+    """
+
+    # Histogram buckets are powers of two, in microseconds
+    NUM_BUCKETS = 24
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, List[int]] = {}
+        self._totals: Dict[str, float] = {}
+        self._frame_thread: Optional[int] = None
+        self._frame_start = 0.0
+        self._frame_phases: Dict[str, float] = {}
+        self.slow_frames = 0
+
+    def timed(self, phase: str, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        if not PROFILE_TAB_BAR:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def record(self, phase: str, duration: float) -> None:
+        bucket = min(int(duration * 1e6).bit_length(), self.NUM_BUCKETS - 1)
+        with self._lock:
+            histogram = self._histograms.setdefault(phase, [0] * self.NUM_BUCKETS)
+            histogram[bucket] += 1
+            self._totals[phase] = self._totals.get(phase, 0.0) + duration
+        if self._frame_thread == threading.get_ident():
+            self._frame_phases[phase] = self._frame_phases.get(phase, 0.0) + duration
+
+    def begin_frame(self) -> None:
+        self._frame_thread = threading.get_ident()
+        self._frame_start = time.perf_counter()
+        self._frame_phases.clear()
+
+    def end_frame(self) -> None:
+        if self._frame_thread is None:
+            return
+        self._frame_thread = None
+        duration = time.perf_counter() - self._frame_start
+        self.record("frame", duration)
+        if duration > FRAME_BUDGET:
+            self.slow_frames += 1
+            phase, phase_duration = max(self._frame_phases.items(), key=lambda p: p[1])
+            print(
+                f"Tab bar frame took {duration * 1e3:.2f} ms (budget is "
+                f"{FRAME_BUDGET * 1e3:.2f} ms), slowest phase was {phase} "
+                f"({phase_duration * 1e3:.2f} ms)"
+            )
+
+    def dump(self, path: str) -> None:
+        with self._lock:
+            histograms = {k: v[:] for k, v in self._histograms.items()}
+            totals = dict(self._totals)
+
+        budget = FRAME_BUDGET * 1e3
+        lines = [f"Frames over budget of {budget:.2f} ms: {self.slow_frames}"]
+        for phase, histogram in sorted(histograms.items()):
+            count = sum(histogram)
+            lines.append("")
+            lines.append(
+                f"{phase}: {count} samples, mean {totals[phase] / count * 1e6:.1f} us"
+            )
+            for bucket, bucket_count in enumerate(histogram):
+                if bucket_count:
+                    upper = 1 << bucket
+                    lines.append(f"  < {upper:>9} us: {bucket_count}")
+        Path(path).write_text("\n".join(lines) + "\n")
+
+    def dump_if_requested(self) -> None:
+        request_file = Path(runtime_dir()) / TIMINGS_REQUEST_FILE
+        if request_file.exists():
+            request_file.unlink(missing_ok=True)
+            self.dump(str(request_file.with_name(TIMINGS_DUMP_FILE)))
+
+
+phase_timer = PhaseTimer()
+
+
+# A component to draw: its text (None for the title), foreground and background color
+Component = Tuple[Optional[str], int, int]
+
+
+class RenderPlan:
+    """Colors and component sequences needed to draw elements, for a given DrawData.
+
+    Colors are converted once per DrawData, and the sequence of separators, padding and
+    icons is compiled once per combination of element options, so that drawing an
+    element only consists of setting colors and drawing text.
+    """
+
+    def __init__(self, draw_data: DrawData) -> None:
+        self.draw_data = draw_data
+        self.colors = _get_colors(draw_data)
+        self._components: Dict[tuple, List[Component]] = {}
+
+    def components(
+        self,
+        has_title: bool,
+        filled: bool,
+        padded: bool,
+        accented: bool,
+        icon: Optional[str],
+        soft_sep: Optional[str],
+    ) -> List[Component]:
+        key = (has_title, filled, padded, accented, icon, soft_sep)
+        components = self._components.get(key)
+        if components is None:
+            components = self._compile(*key)
+            self._components[key] = components
+        return components
+
+    def _compile(
+        self,
+        has_title: bool,
+        filled: bool,
+        padded: bool,
+        accented: bool,
+        icon: Optional[str],
+        soft_sep: Optional[str],
+    ) -> List[Component]:
+        colors = self.colors
+        if accented:
+            text_fg = colors["accented_fg"]
+            text_bg = colors["accented_bg"]
+            icon_bg = colors["accented_icon_bg"]
+        elif filled:
+            text_fg = colors["filled_fg"]
+            text_bg = colors["filled_bg"]
+            icon_bg = colors["filled_icon_bg"] if icon else colors["filled_bg"]
+        else:
+            text_fg = colors["fg"]
+            text_bg = colors["bg"]
+            icon_bg = colors["bg"]
+
+        components: List[Component] = list()
+
+        # Left separator
+        components.append((LEFT_SEP, icon_bg, colors["bg"]))
+        # Padding between left separator and rest of tab
+        if padded:
+            components.append((PADDING, text_fg, text_bg))
+        # Icon, with padding on the right if there's a tab title, and more padding
+        # before title if the tab is filled and there's a tab title
+        if icon:
+            icon_padding = PADDING if has_title else ""
+            components.append((f"{icon}{icon_padding}", text_fg, icon_bg))
+            if filled and has_title:
+                components.append((PADDING, text_fg, text_bg))
+        # Title
+        components.append((None, text_fg, text_bg))
+        # Padding between tab content and right separator
+        if padded:
+            components.append((PADDING, text_fg, text_bg))
+        # Right separator, which is drawn using the same colors as the left separator
+        # in case there isn't a tab title
+        right_sep_fg = text_bg if has_title else icon_bg
+        components.append((RIGHT_SEP, right_sep_fg, colors["bg"]))
+        # Inter-tab soft separator
+        if soft_sep:
+            components.append((soft_sep, colors["soft_sep_fg"], colors["bg"]))
+
+        return components
+
+
+# Render plans by DrawData identity (kitty keeps one DrawData per tab bar, until its
+# options change)
+render_plans: Dict[int, RenderPlan] = {}
+
+
+def _get_colors(draw_data: DrawData) -> Dict[str, int]:
+    colors = {}
+
+    # Base foreground and background colors
+    colors["fg"] = as_rgb(color_as_int(draw_data.inactive_fg))
+    colors["bg"] = as_rgb(color_as_int(draw_data.default_bg))
+
+    # Foreground, background and icon background colors for filled tabs
+    colors["filled_fg"] = as_rgb(color_as_int(draw_data.active_fg))
+    colors["filled_bg"] = as_rgb(color_as_int(draw_data.active_bg))
+    colors["filled_icon_bg"] = as_rgb(color_as_int(FILLED_ICON_BG_COLOR))
+
+    # Foreground, background and icon background colors for accented tabs
+    colors["accented_fg"] = as_rgb(color_as_int(draw_data.active_fg))
+    colors["accented_bg"] = as_rgb(color_as_int(ACCENTED_BG_COLOR))
+    colors["accented_icon_bg"] = as_rgb(color_as_int(ACCENTED_ICON_BG_COLOR))
+
+    # Inter-tab separator color
+    colors["soft_sep_fg"] = as_rgb(color_as_int(SOFT_SEP_COLOR))
+
+    return colors
+
+
+def _get_render_plan(draw_data: DrawData) -> RenderPlan:
+    plan = render_plans.get(id(draw_data))
+    if plan is None or plan.draw_data is not draw_data:
+        # Plans for DrawData that's no longer used are simply dropped from time to time
+        if len(render_plans) >= 16:
+            render_plans.clear()
+        plan = RenderPlan(draw_data)
+        render_plans[id(draw_data)] = plan
+    return plan
+
+
 def _draw_element(
     title: DrawData | str,
     screen: Screen,
@@ -1003,7 +2454,7 @@ def _draw_element(
     before: int,
     max_tab_length: int,
     index: int,
-    colors: Dict[str, int],
+    plan: RenderPlan,
     filled: bool = False,
     padded: bool = False,
     accented: bool = False,
@@ -1017,63 +2468,181 @@ def _draw_element(
         screen.draw("…".center(max_tab_length))
         return screen.cursor.x
 
-    if accented:
-        text_fg = colors["accented_fg"]
-        text_bg = colors["accented_bg"]
-        icon_bg = colors["accented_icon_bg"]
-    elif filled:
-        text_fg = colors["filled_fg"]
-        text_bg = colors["filled_bg"]
-        icon_bg = colors["filled_icon_bg"] if icon else colors["filled_bg"]
-    else:
-        text_fg = colors["fg"]
-        text_bg = colors["bg"]
-        icon_bg = colors["bg"]
-
-    components = list()
-
-    # Left separator
-    components.append((LEFT_SEP, icon_bg, colors["bg"]))
-    # Padding between left separator and rest of tab
-    if padded:
-        components.append((PADDING, text_fg, text_bg))
-    # Icon, with padding on the right if there's a tab title, and more padding before
-    # title if the tab is filled and there's a tab title
-    if icon:
-        icon_padding = PADDING if title != "" else ""
-        components.append((f"{icon}{icon_padding}", text_fg, icon_bg))
-        if filled and title != "":
-            components.append((PADDING, text_fg, text_bg))
-    # Title
-    components.append((title, text_fg, text_bg))
-    # Padding between tab content and right separator
-    if padded:
-        components.append((PADDING, text_fg, text_bg))
-    # Right separator, which is drawn using the same colors as the left separator in
-    # case there isn't a tab title
-    right_sep_fg = text_bg if title != "" else icon_bg
-    components.append((RIGHT_SEP, right_sep_fg, colors["bg"]))
-    # Inter-tab soft separator
-    if soft_sep:
-        components.append((soft_sep, colors["soft_sep_fg"], colors["bg"]))
-
-    for c in components:
-        screen.cursor.fg = c[1]
-        screen.cursor.bg = c[2]
-        if isinstance(c[0], str):
-            screen.draw(c[0])
+    components = plan.components(title != "", filled, padded, accented, icon, soft_sep)
+
+    cursor = screen.cursor
+    for text, fg, bg in components:
+        cursor.fg = fg
+        cursor.bg = bg
+        if text is not None:
+            screen.draw(text)
+        elif isinstance(title, str):
+            screen.draw(title)
         else:
-            draw_title(c[0], screen, tab, index)
+            draw_title(title, screen, tab, index)
             max_cursor_x = before + max_tab_length - len(LEFT_SEP) - len(PADDING)
-            if screen.cursor.x > max_cursor_x:
-                screen.cursor.x = max_cursor_x - 1
+            if cursor.x > max_cursor_x:
+                cursor.x = max_cursor_x - 1
                 screen.draw("…")
 
     # Element ends before soft separator
-    end = screen.cursor.x - (len(soft_sep) if soft_sep else 0)
+    end = cursor.x - (len(soft_sep) if soft_sep else 0)
     return end
 
 
+# Cursor attributes which are restored when replaying cached tab layouts
+CURSOR_ATTRS = (
+    "fg",
+    "bg",
+    "decoration_fg",
+    "bold",
+    "italic",
+    "reverse",
+    "strikethrough",
+    "dim",
+    "decoration",
+)
+
+
+class _RecordingScreen:
+    # Forwards everything to the actual screen, recording what is drawn where, along
+    # with the cursor attributes that changed since the previous draw
+
+    def __init__(self, screen: Screen, origin: int) -> None:
+        self._screen = screen
+        self._origin = origin
+        self._attrs: tuple = ()
+        self.ops: List[Tuple[int, str, Tuple[Tuple[str, Any], ...]]] = []
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._screen, name)
+
+    def draw(self, text: str) -> None:
+        cursor = self._screen.cursor
+        attrs = tuple(getattr(cursor, name, None) for name in CURSOR_ATTRS)
+        changes = tuple(
+            (name, value)
+            for i, (name, value) in enumerate(zip(CURSOR_ATTRS, attrs))
+            if value is not None and (not self._attrs or self._attrs[i] != value)
+        )
+        self._attrs = attrs
+        self.ops.append((cursor.x - self._origin, text, changes))
+        self._screen.draw(text)
+
+
+class TabLayoutCache:
+    """Cells drawn for each tab in previous frames, keyed by tab id.
+
+    kitty redraws every tab whenever the tab bar changes, even if only one tab did. Tabs
+    whose inputs are unchanged are drawn by replaying their cached cells instead, which
+    skips evaluating the title template.
+    """
+
+    def __init__(self) -> None:
+        self._layouts: Dict[int, Tuple[tuple, list, int, int]] = {}
+        self.enabled = True
+
+    def draw(
+        self,
+        draw_data: DrawData,
+        screen: Screen,
+        tab: TabBarData,
+        before: int,
+        max_tab_length: int,
+        index: int,
+        plan: RenderPlan,
+        soft_sep: Optional[str],
+    ) -> int:
+        if not (CACHE_TAB_LAYOUTS and self.enabled):
+            return self._draw(
+                draw_data, screen, tab, before, max_tab_length, index, plan, soft_sep
+            )
+
+        key = (
+            tab.title,
+            tab.is_active,
+            tab.needs_attention,
+            getattr(tab, "num_windows", None),
+            getattr(tab, "layout_name", None),
+            getattr(tab, "has_activity_since_last_focus", None),
+            index,
+            max_tab_length,
+            soft_sep,
+            plan,
+        )
+        layout = self._layouts.get(tab.tab_id)
+        if layout is not None and layout[0] == key:
+            return self._replay(screen, before, layout)
+
+        recorder = _RecordingScreen(screen, before)
+        try:
+            end = self._draw(
+                draw_data, recorder, tab, before, max_tab_length, index, plan, soft_sep
+            )
+        except TypeError as e:
+            # Only a C function of kitty refusing the recorder in place of its actual
+            # Screen object is expected, which names the recorder's type. Anything else
+            # is a bug, which mustn't go unnoticed by disabling the cache.
+            if type(recorder).__name__ not in str(e):
+                raise
+            # Don't record anymore and draw the tab again over whatever has already been
+            # drawn
+            self.enabled = False
+            self._layouts.clear()
+            screen.cursor.x = before
+            return self._draw(
+                draw_data, screen, tab, before, max_tab_length, index, plan, soft_sep
+            )
+
+        if len(self._layouts) >= TAB_LAYOUT_CACHE_SIZE:
+            self._layouts.clear()
+        self._layouts[tab.tab_id] = (
+            key,
+            recorder.ops,
+            end - before,
+            screen.cursor.x - before,
+        )
+        return end
+
+    def _draw(
+        self,
+        draw_data: DrawData,
+        screen: Screen,
+        tab: TabBarData,
+        before: int,
+        max_tab_length: int,
+        index: int,
+        plan: RenderPlan,
+        soft_sep: Optional[str],
+    ) -> int:
+        return _draw_element(
+            draw_data,
+            screen,
+            tab,
+            before,
+            max_tab_length,
+            index,
+            plan,
+            filled=tab.is_active,
+            padded=PADDED_TABS,
+            soft_sep=soft_sep,
+        )
+
+    def _replay(self, screen: Screen, before: int, layout: tuple) -> int:
+        _, ops, end, cursor_x = layout
+        cursor = screen.cursor
+        for x, text, changes in ops:
+            cursor.x = before + x
+            for name, value in changes:
+                setattr(cursor, name, value)
+            screen.draw(text)
+        cursor.x = before + cursor_x
+        return before + end
+
+
+tab_layout_cache = TabLayoutCache()
+
+
 def _calc_elements_len(elements: List[Dict[str, Any]]) -> int:
     elements_len = 0
     for element in elements:
@@ -1101,75 +2670,1300 @@ def _is_running_pager(active_window: Window) -> bool:
         return False
 
 
-def _get_system_info(active_window: Window) -> Dict[str, Any]:
-    # Local info (and fallback for errors on remote info)
-    user = getpass.getuser()
-    host = socket.gethostname()
-    is_ssh = False
+class SSHConfigCache:
+    """Keep one parsed SSHConfig per config file, reparsed only when the file changes.
+
+    Changes are detected by comparing the inode, modification time and size of the file
+    and of all files it includes. The signature is taken before parsing and checked
+    again afterwards, so a config edited while it is being parsed is not cached. The
+    "skipped_parses" counter tells how many parses were saved by the cache.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._configs: Dict[str, Tuple[tuple, SSHConfig]] = {}
+        # Include patterns seen by the last parse of each file, even if not cached
+        self._includes: Dict[str, List[str]] = {}
+        self.parses = 0
+        self.skipped_parses = 0
+
+    def get(self, path: str) -> SSHConfig:
+        with self._lock:
+            cached = self._configs.get(path)
+            includes = self._includes.get(path, [])
+        signature = _ssh_config_signature(path, includes)
+        if cached is not None and cached[0] == signature:
+            with self._lock:
+                self.skipped_parses += 1
+            return cached[1]
+
+        config = SSHConfig.from_path(
+            path,
+            cache_dir=os.path.join(cache_dir(), "ssh_config")
+            if SSH_CONFIG_DISK_CACHE
+            else None,
+            lookup_cache_size=SSH_LOOKUP_CACHE_SIZE,
+        )
+        parsed_includes = list(config.get_includes())
+        # The files read by the parse are only known afterwards: when they differ from
+        # the ones signed, or changed meanwhile, the next call parses again
+        unchanged = parsed_includes == includes and signature == _ssh_config_signature(
+            path, parsed_includes
+        )
+        with self._lock:
+            self._includes[path] = parsed_includes
+            if unchanged:
+                self._configs[path] = (signature, config)
+            else:
+                self._configs.pop(path, None)
+            self.parses += 1
+        return config
+
+
+def _ssh_config_signature(path: str, includes: List[str]) -> tuple:
+    # Include patterns are globbed again, to notice files being added or removed
+    paths = [path]
+    for pattern in includes:
+        paths.extend(sorted(glob.glob(pattern)))
+
+    signature = []
+    for fpath in paths:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            if fpath == path:
+                raise
+            signature.append((fpath, None))
+            continue
+        signature.append((fpath, st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+ssh_config_cache = SSHConfigCache()
+
 
-    ssh_cmdline = []
-    # The propery "child_is_remote" is True when the command being executed is a
-    # standard "ssh" command, without using the SSH kitten
+def _lookup_ssh_config(config_fpath: str, host: str) -> Dict[str, Any]:
+    # Only "user" is read, so leave the other values unexpanded
+    return ssh_config_cache.get(config_fpath).lookup(host, lazy=True)
+
+
+# Options of ssh(1) which take an argument
+SSH_OPTIONS_WITH_ARG = set("BbcDEeFIiJLlmOoPpQRSWw")
+
+
+def _parse_ssh_cmdline(cmdline: List[str]) -> Optional[Dict[str, Any]]:
+    # Returns the destination of an "ssh" or "kitten ssh" command line, in a single pass
+    # over its arguments, or None if there is no destination. Like ssh(1), options after
+    # the destination are parsed too (up to the remote command), and the first user and
+    # port given win, whether as options or as part of the destination.
+    args = list(cmdline)
+    start = next(
+        (i + 1 for i, arg in enumerate(args) if os.path.basename(arg) == "ssh"), 1
+    )
+    destination = None
+    options: Dict[str, str] = {}
+
+    def set_first(key: str, value: Optional[str]) -> None:
+        if value and key not in options:
+            options[key] = value
+
+    def set_destination(arg: str) -> None:
+        host, port = arg, None
+        if host.startswith("ssh://"):
+            host = host[len("ssh://") :]
+            host, _, port = host.partition(":")
+        if "@" in host:
+            user, _, host = host.rpartition("@")
+            set_first("user", user)
+        set_first("port", port)
+        options["host"] = host
+
+    i = start
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == "--":
+            if destination is None and i < len(args):
+                destination = args[i]
+                set_destination(destination)
+            break
+        if arg.startswith("--"):
+            # Options of the SSH kitten
+            if arg == "--kitten":
+                i += 1
+            continue
+        if not arg.startswith("-"):
+            if destination is not None:
+                # The remote command
+                break
+            destination = arg
+            set_destination(destination)
+            continue
+        # Flags may be combined (e.g. "-tt" or "-4v"), and an option's argument may be
+        # attached to it (e.g. "-p22")
+        for j in range(1, len(arg)):
+            if arg[j] in SSH_OPTIONS_WITH_ARG:
+                value = arg[j + 1 :]
+                if not value and i < len(args):
+                    value = args[i]
+                    i += 1
+                if arg[j] == "o":
+                    # Either "-o Key=Value" or "-o 'Key Value'"
+                    key, *rest = re.split(r"\s*=\s*|\s+", value, maxsplit=1)
+                    key = key.lower()
+                    if key in ("user", "port"):
+                        set_first(key, rest[0] if rest else "")
+                elif arg[j] == "l":
+                    set_first("user", value)
+                elif arg[j] == "p":
+                    set_first("port", value)
+                else:
+                    options[arg[j]] = value
+                break
+
+    if not destination:
+        return None
+
+    return {
+        "user": options.get("user"),
+        "host": options["host"],
+        "port": options.get("port"),
+        "jump": options.get("J"),
+        "config_file": options.get("F"),
+    }
+
+
+def _process_start_time(pid: int) -> Optional[int]:
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_bytes()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses, so fields are counted after
+    # its end. The start time is the 22nd field.
+    return int(stat[stat.rindex(b")") + 2 :].split()[19])
+
+
+def _find_ssh_process(active_window: Window) -> Optional[Tuple[tuple, List[str]]]:
+    # Returns a key identifying the SSH process running in the window, along with its
+    # command line. The propery "child_is_remote" is True when the command being
+    # executed is a standard "ssh" command, without using the SSH kitten.
     if active_window.child_is_remote:
-        procs = sorted(active_window.child.foreground_processes, key=lambda p: p["pid"])
-        for p in procs:
-            if p["cmdline"][0] == "ssh":
-                ssh_cmdline = p["cmdline"]
+        ssh_procs = [
+            p
+            for p in active_window.child.foreground_processes
+            if p["cmdline"] and os.path.basename(p["cmdline"][0]) == "ssh"
+        ]
+        if not ssh_procs:
+            return None
+        proc = max(ssh_procs, key=lambda p: p["pid"])
+        # Without procfs, the command line has to tell apart processes reusing a pid
+        start_time = _process_start_time(proc["pid"])
+        key = (proc["pid"], start_time if start_time else tuple(proc["cmdline"]))
+        return key, proc["cmdline"]
+
     # The command line is not an empty list in case we're running the ssh kitten
+    ssh_cmdline = active_window.ssh_kitten_cmdline()
+    if ssh_cmdline:
+        return (None, tuple(ssh_cmdline)), ssh_cmdline
+    return None
+
+
+def _resolve_ssh_identity(ssh_cmdline: List[str]) -> Dict[str, Any]:
+    # Local info is the fallback for errors on remote info
+    user = getpass.getuser()
+    host = socket.gethostname()
+
+    destination = _parse_ssh_cmdline(ssh_cmdline)
+    if destination is None:
+        print("Could not retrieve SSH connection data")
+        return {"user": user, "host": host, "is_ssh": True}
+
+    host = destination["host"]
+    # When the command line specifies the user we just use it, otherwise we try to
+    # lookup the corresponding user in the SSH config file
+    if destination["user"]:
+        user = destination["user"]
     else:
-        ssh_cmdline = active_window.ssh_kitten_cmdline()
-
-    if ssh_cmdline != []:
-        is_ssh = True
-        # Remove "-tt" argument from SSH cmdline, if present, because the function
-        # get_connection_data() doesn't handle that properly
-        ssh_cmdline = filter(lambda item: item != "-tt", ssh_cmdline)
-        conn_data = get_connection_data(ssh_cmdline)
-        if conn_data:
-            conn_data_hostname = conn_data.hostname
-            user_and_host = conn_data_hostname.split("@")
-            # When only a host is specified on the command line, we try to lookup the
-            # corresponding user in the SSH config file
-            if len(user_and_host) == 1:
-                host = user_and_host[0]
-                config_fpath = str(Path(SSH_CONFIG_FILE).expanduser())
-                host_config = SSHConfig.from_path(config_fpath).lookup(host)
-                if "user" in host_config:
-                    user = host_config["user"]
-            # When the command line specifies both host and user, we just use these
-            elif len(user_and_host) == 2:
-                user, host = user_and_host
-            else:
-                print("Could not parse user and host name")
-        else:
-            print("Could not retrieve SSH connection data")
+        config_fpath = str(
+            Path(destination["config_file"] or SSH_CONFIG_FILE).expanduser()
+        )
+        try:
+            host_config = phase_timer.timed(
+                "ssh_config_lookup", _lookup_ssh_config, config_fpath, host
+            )
+        except OSError:
+            # No SSH config file
+            host_config = {}
+        if "user" in host_config:
+            user = host_config["user"]
 
-    return {"user": user, "host": host, "is_ssh": is_ssh}
+    return {"user": user, "host": host, "is_ssh": True}
 
 
-def _get_git_info(active_window: Window, is_ssh: bool) -> Dict[str, Any]:
-    # Git info currently only works in non-remote windows
-    if is_ssh:
-        return {"is_git_repo": False, "branch": ""}
+class SSHIdentityCache:
+    """Resolved SSH user and host per window, until another SSH process runs in it."""
 
-    cwd = active_window.cwd_of_child
+    # Entries are dropped all at once when this many windows have been seen
+    MAX_ENTRIES = 256
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._identities: Dict[int, Tuple[tuple, Dict[str, Any]]] = {}
+
+    def get(self, window_id: int, key: tuple, ssh_cmdline: List[str]) -> Dict[str, Any]:
+        with self._lock:
+            cached = self._identities.get(window_id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        identity = _resolve_ssh_identity(ssh_cmdline)
+        with self._lock:
+            if len(self._identities) >= self.MAX_ENTRIES:
+                self._identities.clear()
+            self._identities[window_id] = (key, identity)
+        return identity
+
+
+ssh_identity_cache = SSHIdentityCache()
+
+
+def _get_system_info(active_window: Window) -> Dict[str, Any]:
+    ssh_process = _find_ssh_process(active_window)
+    if ssh_process is None:
+        user, host = getpass.getuser(), socket.gethostname()
+        return {"user": user, "host": host, "is_ssh": False}
+
+    key, ssh_cmdline = ssh_process
+    return ssh_identity_cache.get(active_window.id, key, ssh_cmdline)
+
+
+def _find_git_dir(cwd: str) -> Optional[Path]:
+    # Walk up from the working directory until a ".git" entry is found
+    path = Path(cwd)
+    for directory in (path, *path.parents):
+        dot_git = directory / ".git"
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            # Worktrees and submodules have a ".git" file pointing to the actual Git dir
+            content = dot_git.read_text().strip()
+            if not content.startswith("gitdir:"):
+                raise ValueError(f"Unrecognized .git file {dot_git}")
+            git_dir = Path(content[len("gitdir:") :].strip())
+            return git_dir if git_dir.is_absolute() else directory / git_dir
+    return None
+
+
+def _read_git_head(git_dir: Path) -> str:
+    # Returns an empty string for a detached HEAD, just like "git branch --show-current"
+    # does. Raises ValueError or OSError when HEAD can't be interpreted, in which case
+    # Git itself should be asked.
+    head = (git_dir / "HEAD").read_text().strip()
+    if head.startswith("ref:"):
+        ref = head[len("ref:") :].strip()
+        # The reftable backend keeps an invalid placeholder in HEAD
+        if not ref.startswith("refs/heads/") or ref == "refs/heads/.invalid":
+            raise ValueError(f"Unrecognized HEAD {head}")
+        return ref[len("refs/heads/") :]
+    if len(head) in (40, 64) and all(c in "0123456789abcdef" for c in head):
+        return ""
+    raise ValueError(f"Unrecognized HEAD {head}")
+
+
+def _run_git_branch(cwd: Optional[str]) -> Optional[str]:
+    # Raises subprocess.TimeoutExpired if Git runs out of its time budget
     proc = subprocess.run(
-        ["git", "branch", "--show-current"], capture_output=True, cwd=cwd
+        ["git", "branch", "--show-current"],
+        capture_output=True,
+        cwd=cwd,
+        timeout=GIT_BRANCH_TIMEOUT,
     )
 
     # If the command fails we're probably not in a Git repo (note that often the command
     # does not error out, so checking the stderr protects against false negatives)
     if proc.returncode != 0 or len(proc.stderr) > 0:
-        return {"is_git_repo": False, "branch": ""}
+        return None
+
+    return str(proc.stdout, "utf-8").strip()
+
+
+def _run_git_status(cwd: Optional[str]) -> Optional[Dict[str, Any]]:
+    # Raises subprocess.TimeoutExpired if Git runs out of its time budget. Optional
+    # locks are disabled so that Git doesn't write to the index behind the user's back.
+    proc = subprocess.run(
+        [
+            "git",
+            "--no-optional-locks",
+            "status",
+            "--porcelain=v2",
+            "--branch",
+            "--show-stash",
+        ],
+        capture_output=True,
+        cwd=cwd,
+        timeout=GIT_STATUS_TIMEOUT,
+    )
+    # Note that "--show-stash" requires Git 2.35 or later
+    if proc.returncode != 0:
+        return None
+
+    status = {"dirty": False, "ahead": 0, "behind": 0, "stash": 0}
+    for line in str(proc.stdout, "utf-8", errors="replace").splitlines():
+        if line.startswith("# branch.ab "):
+            ahead, behind = line.split()[2:4]
+            status["ahead"], status["behind"] = int(ahead), -int(behind)
+        elif line.startswith("# stash "):
+            status["stash"] = int(line.split()[2])
+        elif not line.startswith("#"):
+            # Changed, renamed, unmerged or untracked entry
+            status["dirty"] = True
+    return status
+
+
+def _format_git_status(status: Optional[Dict[str, Any]]) -> str:
+    if status is None:
+        return ""
+    marks = GIT_DIRTY_MARK if status["dirty"] else ""
+    counts = ""
+    if status["ahead"]:
+        counts += f"{GIT_AHEAD_MARK}{status['ahead']}"
+    if status["behind"]:
+        counts += f"{GIT_BEHIND_MARK}{status['behind']}"
+    if status["stash"]:
+        counts += f"{GIT_STASH_MARK}{status['stash']}"
+    return " ".join(part for part in (marks, counts) if part)
+
+
+def _git_common_dir(git_dir: Path) -> Path:
+    # Worktrees share refs with the main repository, whose Git dir is in "commondir"
+    try:
+        common_dir = Path((git_dir / "commondir").read_text().strip())
+    except OSError:
+        return git_dir
+    return common_dir if common_dir.is_absolute() else git_dir / common_dir
+
+
+class _Inotify:
+    # Constants from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+    )
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    @classmethod
+    def create(cls) -> Optional["_Inotify"]:
+        try:
+            return cls()
+        except (AttributeError, OSError):
+            # Not on Linux, or out of inotify instances
+            return None
+
+    def add_watch(self, path: Path) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        # Fails if the watch is already gone, which is just as good
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List[tuple]:
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset : offset + name_len].rstrip(b"\0")
+                events.append((wd, mask, name.decode(errors="replace")))
+                offset += name_len
+
+
+def _read_mount_points() -> List[str]:
+    # Sorted longest first, so that the first match for a path is its innermost mount
+    try:
+        with open("/proc/mounts") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    mount_points = set()
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        # Whitespace and backslashes in mount points are escaped as octal
+        mount_point = fields[1]
+        for escaped, char in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n")):
+            mount_point = mount_point.replace(escaped, char)
+        mount_points.add(mount_point.replace("\\134", "\\"))
+    return sorted(mount_points, key=len, reverse=True)
+
+
+class MountCircuitBreaker:
+    """Stop touching mounts on which looking up Git information keeps timing out.
+
+    Paths are mapped to their mount point using /proc/mounts, without accessing them.
+    Both reading HEAD and running "git status" count as probes. After SLOW_FS_FAILURES
+    timeouts in a row a mount is considered slow, and it's only probed again once
+    SLOW_FS_COOLDOWN seconds have passed. Only one probe per mount runs at a time, and
+    one which hasn't returned after its timeout (e.g. stuck on a hung NFS or sshfs
+    mount) makes the mount slow right away, without waiting for it to return.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._mount_points: List[str] = []
+        self._mounts: Dict[str, str] = {}
+        self._loaded = -math.inf
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        # Mount -> deadline of the probe in flight on it
+        self._probing: Dict[str, float] = {}
+        self._stuck: Set[str] = set()
+
+    def allow(self, path: str, timeout: float = GIT_BRANCH_TIMEOUT) -> bool:
+        mount = self._mount_point(path)
+        with self._lock:
+            now = time.monotonic()
+            if mount in self._probing:
+                self._check_stuck(mount, now)
+                return False
+            open_until = self._open_until.get(mount)
+            if open_until is not None:
+                if now < open_until:
+                    return False
+                # Let a single probe through, which closes or reopens the breaker
+                self._open_until[mount] = now + SLOW_FS_COOLDOWN
+            self._probing[mount] = now + timeout
+            return True
+
+    def is_slow(self, path: str) -> bool:
+        mount = self._mount_point(path)
+        with self._lock:
+            if mount in self._probing:
+                self._check_stuck(mount, time.monotonic())
+            return mount in self._open_until or mount in self._stuck
+
+    def record(self, path: str, timed_out: bool) -> None:
+        mount = self._mount_point(path)
+        with self._lock:
+            self._probing.pop(mount, None)
+            stuck = mount in self._stuck
+            self._stuck.discard(mount)
+            if not timed_out:
+                self._failures.pop(mount, None)
+                self._open_until.pop(mount, None)
+                return
+            failures = self._failures.get(mount, 0) + 1
+            self._failures[mount] = failures
+            if failures >= SLOW_FS_FAILURES or stuck:
+                if not stuck:
+                    print(f"Git is too slow on {mount}, not looking it up for a while")
+                self._open_until[mount] = time.monotonic() + SLOW_FS_COOLDOWN
+
+    def _check_stuck(self, mount: str, now: float) -> None:
+        # Called with the lock held
+        if mount in self._stuck or now <= self._probing[mount]:
+            return
+        print(f"Git is stuck on {mount}, not looking it up until it returns")
+        self._stuck.add(mount)
+
+    def _mount_point(self, path: str) -> str:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._loaded >= MOUNT_TABLE_TTL:
+                self._mount_points = _read_mount_points()
+                self._mounts.clear()
+                self._loaded = now
+            mount = self._mounts.get(path)
+            if mount is None:
+                mount = next(
+                    (
+                        m
+                        for m in self._mount_points
+                        if path == m or path.startswith(m.rstrip("/") + "/")
+                    ),
+                    "/",
+                )
+                self._mounts[path] = mount
+            return mount
+
+
+mount_breaker = MountCircuitBreaker()
+
+
+class GitRepoCache:
+    """Cache the current branch per repository.
+
+    Entries are invalidated by inotify watches on HEAD, refs/heads and packed-refs.
+    Where inotify isn't available (e.g. on macOS), the modification times of these files
+    are polled at most every GIT_CACHE_POLL_INTERVAL seconds instead. On slow mounts the
+    last known branch and status are returned without touching the repository.
+
+    Segments of different windows may look branches up concurrently, so the state is
+    guarded by a lock, which is never held while touching the file system.
+    """
 
-    branch = str(proc.stdout, "utf-8").strip() or "DETACHED"
+    # Entries and watches are dropped all at once when this many working directories or
+    # repositories have been seen
+    MAX_ENTRIES = 256
+
+    def __init__(self) -> None:
+        self._inotify = _Inotify.create()
+        self._lock = threading.Lock()
+        # Git dir -> {"branch": ..., "signature": ..., "checked": ...}
+        self._repos: Dict[Path, Dict[str, Any]] = {}
+        # Working directory -> (Git dir, time of lookup)
+        self._cwds: Dict[str, Tuple[Optional[Path], float]] = {}
+        # Git dir -> {"status": ..., "next_run": ...}
+        self._statuses: Dict[Path, Dict[str, Any]] = {}
+        # Watch descriptor -> (watched file names or None for any, Git dirs)
+        self._watches: Dict[int, Tuple[Optional[Set[str]], Set[Path]]] = {}
+        self._watched_repos: Set[Path] = set()
+        # Working directory -> last known branch
+        self._last_branches: Dict[str, Optional[str]] = {}
+        # Bumped by _clear, so that lookups which started before don't store their
+        # results (or watches) afterwards
+        self._generation = 0
+
+    def branch(self, cwd: Optional[str]) -> Optional[str]:
+        if not cwd:
+            return None
+        # Answers from the cache don't touch the mount, so they aren't probes: counting
+        # them as successes would keep the breaker from ever opening
+        self._process_events()
+        hit, branch = self._cached_branch(cwd, time.monotonic())
+        if hit:
+            return branch
+        if not mount_breaker.allow(cwd):
+            return self._last_branch(cwd)
+
+        start = time.monotonic()
+        timed_out = False
+        try:
+            branch = self._branch(cwd, start)
+            # Reading the repository can hang just as well as Git on a slow mount
+            timed_out = time.monotonic() - start > GIT_BRANCH_TIMEOUT
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            return self._last_branch(cwd)
+        finally:
+            # Always ends the probe, or the mount would never be probed again
+            mount_breaker.record(cwd, timed_out)
+        with self._lock:
+            self._last_branches[cwd] = branch
+        return branch
+
+    def is_slow(self, cwd: Optional[str]) -> bool:
+        return bool(cwd) and mount_breaker.is_slow(cwd)
+
+    def _cached_branch(self, cwd: str, now: float) -> Tuple[bool, Optional[str]]:
+        # Returns whether the branch is known without touching the repository, and if
+        # so the branch
+        with self._lock:
+            cached = self._cwds.get(cwd)
+            if cached is None or now - cached[1] >= GIT_CACHE_POLL_INTERVAL:
+                return False, None
+            if cached[0] is None:
+                return True, None
+            entry = self._repos.get(cached[0])
+            if entry is None:
+                return False, None
+            if (
+                entry["signature"] is not None
+                and now - entry["checked"] >= GIT_CACHE_POLL_INTERVAL
+            ):
+                return False, None
+            self._last_branches[cwd] = entry["branch"]
+            return True, entry["branch"]
+
+    def _last_branch(self, cwd: str) -> Optional[str]:
+        with self._lock:
+            return self._last_branches.get(cwd)
+
+    def _branch(self, cwd: str, now: float) -> Optional[str]:
+        self._process_events()
+        with self._lock:
+            if max(len(self._cwds), len(self._repos)) >= self.MAX_ENTRIES:
+                self._clear()
+            generation = self._generation
+
+        try:
+            git_dir = self._git_dir(cwd, now)
+        except (OSError, ValueError):
+            return _run_git_branch(cwd)
+        if git_dir is None:
+            return None
+
+        with self._lock:
+            entry = self._repos.get(git_dir)
+        if entry is None or self._is_stale(git_dir, entry, now):
+            # Watched (or signed) before reading HEAD, so that no change in between is
+            # missed
+            watched = self._watch(git_dir, generation)
+            signature = None if watched else _git_signature(git_dir)
+            try:
+                branch = _read_git_head(git_dir)
+            except (OSError, ValueError):
+                branch = _run_git_branch(cwd)
+            entry = {"branch": branch, "signature": signature, "checked": now}
+            with self._lock:
+                # Not cached if the watches went away in the meantime (e.g. _clear ran),
+                # since nothing would ever invalidate the entry
+                if generation == self._generation and (
+                    not watched or git_dir in self._watched_repos
+                ):
+                    self._repos[git_dir] = entry
+        return entry["branch"]
+
+    def status(self, cwd: Optional[str]) -> Optional[Dict[str, Any]]:
+        # Running "git status" can take a long time in large repositories, so it's rate
+        # limited per repository and the last known status is returned in between
+        if self.is_slow(cwd):
+            with self._lock:
+                cached = self._cwds.get(cwd)
+                slow_entry = (
+                    self._statuses.get(cached[0]) if cached and cached[0] else None
+                )
+                return slow_entry["status"] if slow_entry else None
+
+        now = time.monotonic()
+        try:
+            git_dir = self._git_dir(cwd, now)
+        except (OSError, ValueError):
+            return None
+        if git_dir is None:
+            return None
+
+        with self._lock:
+            entry = self._statuses.setdefault(
+                git_dir, {"status": None, "next_run": 0.0}
+            )
+            if now < entry["next_run"]:
+                return entry["status"]
+            # Claimed, so that concurrent lookups return the last known status meanwhile
+            entry["next_run"] = now + GIT_STATUS_BACKOFF
+        # Git status goes through the same breaker as reading HEAD, since the branch may
+        # well come from the cache while the mount hangs
+        if not mount_breaker.allow(cwd, GIT_STATUS_TIMEOUT):
+            with self._lock:
+                return entry["status"]
+        timed_out = False
+        try:
+            status = _run_git_status(cwd)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            with self._lock:
+                return entry["status"]
+        finally:
+            mount_breaker.record(cwd, timed_out)
+        with self._lock:
+            entry["status"] = status
+            entry["next_run"] = time.monotonic() + GIT_STATUS_INTERVAL
+            return status
+
+    def _git_dir(self, cwd: Optional[str], now: float) -> Optional[Path]:
+        if not cwd:
+            raise ValueError("Unknown working directory")
+        # New repositories can't be watched for, so cached lookups expire after a while
+        with self._lock:
+            cached = self._cwds.get(cwd)
+        if cached is not None and now - cached[1] < GIT_CACHE_POLL_INTERVAL:
+            return cached[0]
+        git_dir = _find_git_dir(cwd)
+        with self._lock:
+            self._cwds[cwd] = (git_dir, now)
+        return git_dir
+
+    def _is_stale(self, git_dir: Path, entry: Dict[str, Any], now: float) -> bool:
+        if entry["signature"] is None:
+            # Watched repositories are removed from the cache as soon as they change
+            return False
+        if now - entry["checked"] < GIT_CACHE_POLL_INTERVAL:
+            return False
+        entry["checked"] = now
+        return _git_signature(git_dir) != entry["signature"]
+
+    def _clear(self) -> None:
+        # Called with the lock held
+        if self._inotify is not None:
+            for wd in self._watches:
+                self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._watched_repos.clear()
+        self._repos.clear()
+        self._cwds.clear()
+        self._statuses.clear()
+        self._last_branches.clear()
+        self._generation += 1
+
+    def _watch(self, git_dir: Path, generation: int) -> bool:
+        if self._inotify is None:
+            return False
+        with self._lock:
+            if git_dir in self._watched_repos:
+                return True
+        common_dir = _git_common_dir(git_dir)
+        paths = [
+            (git_dir, {"HEAD"}),
+            (common_dir, {"packed-refs"}),
+            (common_dir / "refs" / "heads", None),
+        ]
+        # Adding watches resolves the paths, which may block, so it's done unlocked
+        added = []
+        try:
+            for path, names in paths:
+                added.append((self._inotify.add_watch(path), names))
+        except OSError:
+            # E.g. the limit of inotify watches was reached, so fall back to polling
+            watched = False
+        else:
+            watched = True
+        with self._lock:
+            if generation != self._generation:
+                # _clear ran meanwhile and wouldn't know about these watches
+                for wd, _ in added:
+                    if wd not in self._watches:
+                        self._inotify.rm_watch(wd)
+                return False
+            for wd, names in added:
+                watched_names, git_dirs = self._watches.setdefault(wd, (set(), set()))
+                if names is None or watched_names is None:
+                    self._watches[wd] = (None, git_dirs)
+                else:
+                    watched_names.update(names)
+                git_dirs.add(git_dir)
+            if watched:
+                self._watched_repos.add(git_dir)
+        return watched
+
+    def _process_events(self) -> None:
+        if self._inotify is None:
+            return
+        events = self._inotify.read_events()
+        with self._lock:
+            for wd, mask, name in events:
+                if mask & _Inotify.IN_Q_OVERFLOW:
+                    # Events were lost, any of which may have been a change of HEAD, so
+                    # every repository has to be read again
+                    self._repos.clear()
+                    continue
+                watched_names, git_dirs = self._watches.get(wd, (None, set()))
+                if mask & _Inotify.IN_IGNORED:
+                    # The watched directory is gone (or the watch was removed by
+                    # _clear), so its repositories need new watches
+                    self._watches.pop(wd, None)
+                    self._watched_repos.difference_update(git_dirs)
+                elif watched_names is not None and name not in watched_names:
+                    continue
+                for git_dir in git_dirs:
+                    self._repos.pop(git_dir, None)
+
+
+def _git_signature(git_dir: Path) -> tuple:
+    common_dir = _git_common_dir(git_dir)
+    signature = []
+    for path in (
+        git_dir / "HEAD",
+        common_dir / "refs" / "heads",
+        common_dir / "packed-refs",
+    ):
+        try:
+            st = path.stat()
+            signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+git_repo_cache = GitRepoCache()
+
+
+class RemoteGitBranches:
+    """Git branches pushed by remote shells, per window and SSH process.
+
+    The user variable outlives the SSH session that set it: not every shell clears it
+    on exit, and none can when the connection drops. So a value is only trusted for the
+    SSH process it was first seen with, and once another SSH process runs in the window
+    it's ignored until the shell pushes a different one. (A new session pushing the
+    same branch name as the previous one is only shown once it changes.)
+    """
+
+    # Entries are dropped all at once when this many windows have been seen
+    MAX_ENTRIES = 256
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Window id -> (SSH process key, value, whether it's left from another process)
+        self._seen: Dict[int, Tuple[tuple, str, bool]] = {}
+
+    def get(self, window_id: int, key: tuple, value: str) -> str:
+        with self._lock:
+            seen = self._seen.get(window_id)
+            stale = False
+            if seen is not None and value == seen[1]:
+                stale = seen[2] or key != seen[0]
+            if len(self._seen) >= self.MAX_ENTRIES and window_id not in self._seen:
+                self._seen.clear()
+            self._seen[window_id] = (key, value, stale)
+        return "" if stale else value
+
+
+remote_git_branches = RemoteGitBranches()
+
+
+def _get_git_info(active_window: Window, ssh_key: Optional[tuple]) -> Dict[str, Any]:
+    if ssh_key is not None:
+        # Looking up the branch on the remote host would be far too slow, so instead it
+        # is pushed by the remote shell (see shell/git_branch_user_var.sh) as a user
+        # variable, which is empty outside of Git repos
+        user_vars = getattr(active_window, "user_vars", {})
+        branch = remote_git_branches.get(
+            active_window.id, ssh_key, user_vars.get(REMOTE_GIT_BRANCH_USER_VAR, "")
+        )
+        branch = branch or None
+        if branch is None:
+            return {
+                "is_git_repo": False,
+                "branch": "",
+                "git_status": "",
+                "slow_fs": False,
+            }
+        branch = _shorten_branch(branch)
+        return {
+            "is_git_repo": True,
+            "branch": branch,
+            "git_status": "",
+            "slow_fs": False,
+        }
+
+    # Reading HEAD directly is much cheaper than spawning Git, which is only used as a
+    # fallback for repository layouts that aren't understood. Either way, the result is
+    # cached until the repository's refs change.
+    cwd = active_window.cwd_of_child
+    branch = git_repo_cache.branch(cwd)
+    slow_fs = git_repo_cache.is_slow(cwd)
+    if branch is None:
+        return {
+            "is_git_repo": False,
+            "branch": "",
+            "git_status": "",
+            "slow_fs": slow_fs,
+        }
+
+    git_status = ""
+    if SHOW_GIT_STATUS:
+        git_status = _format_git_status(git_repo_cache.status(cwd))
+
+    return {
+        "is_git_repo": True,
+        "branch": _shorten_branch(branch or "DETACHED"),
+        "git_status": git_status,
+        "slow_fs": slow_fs,
+    }
+
+
+def _shorten_branch(branch: str) -> str:
     if len(branch) > MAX_BRANCH_LEN:
         start_len = (MAX_BRANCH_LEN - 1) // 2
         end_len = MAX_BRANCH_LEN - start_len - 1
         branch = branch[:start_len] + ELLIPSIS + branch[-end_len:]
-        print(start_len, end_len, len(branch))
+    return branch
+
 
-    return {"is_git_repo": True, "branch": branch}
+# Element of the right-hand side status: title, icon and whether it's accented
+Element = Dict[str, Any]
+
+
+class StatusSegment:
+    """A part of the right-hand side status, computed off the draw path.
+
+    compute() returns the elements to draw for a window, or none to hide the segment.
+    It runs at most every `interval` seconds (per window, unless it is global). When it
+    takes longer than `timeout` seconds, the last known elements are shown until it
+    finishes, and `fallback` is shown before the first result and after failures.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        compute: Callable[[Window], List[Element]],
+        interval: float,
+        timeout: float,
+        fallback: Callable[[], List[Element]],
+        per_window: bool,
+    ) -> None:
+        self.name = name
+        self.compute = compute
+        self.interval = interval
+        self.timeout = timeout
+        self.fallback = fallback
+        self.per_window = per_window
+
+
+status_segments: Dict[str, StatusSegment] = {}
+
+
+def status_segment(
+    name: str,
+    interval: float = 0.0,
+    timeout: float = 1.0,
+    fallback: Callable[[], List[Element]] = list,
+    per_window: bool = True,
+) -> Callable[[Callable[[Window], List[Element]]], Callable[[Window], List[Element]]]:
+    """Register the decorated function as the status segment called `name`."""
+
+    def register(
+        compute: Callable[[Window], List[Element]]
+    ) -> Callable[[Window], List[Element]]:
+        status_segments[name] = StatusSegment(
+            name, compute, interval, timeout, fallback, per_window
+        )
+        return compute
+
+    return register
+
+
+_unknown_segments: Set[str] = set()
+
+
+def _enabled_segments() -> List[StatusSegment]:
+    segments = []
+    for name in RHS_STATUS_SEGMENTS:
+        if name in status_segments:
+            segments.append(status_segments[name])
+        elif name not in _unknown_segments:
+            _unknown_segments.add(name)
+            print(f"Unknown status segment: {name}")
+    return segments
+
+
+def _local_identity() -> List[Element]:
+    # Shown until the identity of a window has been looked up
+    return [
+        {"title": getpass.getuser(), "icon": USER_ICON, "accented": False},
+        {"title": socket.gethostname(), "icon": HOST_ICON, "accented": False},
+    ]
+
+
+@status_segment("identity", timeout=2.0, fallback=_local_identity)
+def _identity_segment(window: Window) -> List[Element]:
+    sys_info = _get_system_info(window)
+    return [
+        {"title": sys_info["user"], "icon": USER_ICON, "accented": sys_info["is_ssh"]},
+        {"title": sys_info["host"], "icon": HOST_ICON, "accented": sys_info["is_ssh"]},
+    ]
+
+
+@status_segment("git", timeout=GIT_STATUS_TIMEOUT + 0.5)
+def _git_segment(window: Window) -> List[Element]:
+    ssh_process = _find_ssh_process(window)
+    git_info = _get_git_info(window, ssh_process[0] if ssh_process else None)
+    if not git_info["is_git_repo"] and not git_info["slow_fs"]:
+        return []
+    title = " ".join(
+        part
+        for part in (
+            git_info["branch"],
+            git_info["git_status"],
+            SLOW_FS_MARK if git_info["slow_fs"] else "",
+        )
+        if part
+    )
+    return [{"title": title, "icon": BRANCH_ICON, "accented": False}]
+
+
+@status_segment("venv", interval=2.0, timeout=0.2)
+def _venv_segment(window: Window) -> List[Element]:
+    # Taken from the environment of the foreground process, i.e. usually the shell
+    venv = window.child.foreground_environ.get("VIRTUAL_ENV")
+    if not venv:
+        return []
+    return [{"title": os.path.basename(venv), "icon": VENV_ICON, "accented": False}]
+
+
+@status_segment("kube", interval=5.0, timeout=0.2, per_window=False)
+def _kube_segment(window: Window) -> List[Element]:
+    kubeconfig = os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)[0]
+    try:
+        with open(os.path.expanduser(kubeconfig)) as f:
+            for line in f:
+                if line.startswith("current-context:"):
+                    context = line.partition(":")[2].strip().strip("\"'")
+                    break
+            else:
+                return []
+    except OSError:
+        return []
+    if not context:
+        return []
+    return [{"title": context, "icon": KUBE_ICON, "accented": False}]
+
+
+@status_segment("load", interval=5.0, timeout=0.1, per_window=False)
+def _load_segment(window: Window) -> List[Element]:
+    load = os.getloadavg()[0]
+    return [{"title": f"{load:.2f}", "icon": LOAD_ICON, "accented": False}]
+
+
+def _default_status() -> Dict[str, List[Element]]:
+    return {segment.name: segment.fallback() for segment in _enabled_segments()}
+
+
+def _collect_status(window: Window) -> Dict[str, List[Element]]:
+    # Compute all segments right away, ignoring their intervals and timeouts
+    return {
+        segment.name: phase_timer.timed(segment.name, segment.compute, window)
+        for segment in _enabled_segments()
+    }
+
+
+class StatusCollector:
+    """Keep a status snapshot per window up to date from a background thread.
+
+    draw_tab() only reads the latest snapshot and requests a refresh, so that reading
+    the SSH config or running Git never blocks kitty's render loop. A timer on the main
+    thread marks the tab bar dirty whenever a snapshot has changed.
+
+    Refresh requests are coalesced: only the most recently requested window is
+    refreshed, no more often than STATUS_MIN_REFRESH_INTERVAL, and windows that already
+    have a snapshot are refreshed STATUS_REFRESH_DEBOUNCE after they were requested.
+    A refresh runs the status segments that are due in parallel, each within its own
+    timeout.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._snapshots: Dict[int, Dict[str, List[Element]]] = {}
+        # (segment name, window id or None for global segments) -> elements, the time
+        # at which they were last computed, and whether they are still being computed
+        self._segments: Dict[Tuple[str, Optional[int]], List[Element]] = {}
+        self._computed_at: Dict[Tuple[str, Optional[int]], float] = {}
+        self._computing: Set[Tuple[str, Optional[int]]] = set()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # Window id -> (time at which it is due for a refresh, window)
+        self._scheduled: Dict[int, Tuple[float, Window]] = {}
+        self._last_refresh: Dict[int, float] = {}
+        self._latest: Optional[int] = None
+        self._changed = False
+        self._started = False
+        self.refreshes = 0
+        self.coalesced = 0
+
+    def snapshot(self, window: Window) -> Dict[str, List[Element]]:
+        self._start()
+        self.request_refresh(window)
+        with self._lock:
+            snapshot = self._snapshots.get(window.id)
+        return snapshot if snapshot is not None else _default_status()
+
+    def request_refresh(self, window: Window) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._latest = window.id
+            if window.id in self._scheduled:
+                return
+            if window.id in self._snapshots:
+                due = max(
+                    now + STATUS_REFRESH_DEBOUNCE,
+                    self._last_refresh.get(window.id, 0.0)
+                    + STATUS_MIN_REFRESH_INTERVAL,
+                )
+            else:
+                # Nothing to show yet, so don't make the user wait
+                due = now
+            self._scheduled[window.id] = (due, window)
+            self._wakeup.notify()
+
+    def _start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            STATUS_SEGMENT_WORKERS, thread_name_prefix="tab-bar-segment"
+        )
+        threading.Thread(target=self._run, name="tab-bar-status", daemon=True).start()
+        add_timer(self._on_timer, STATUS_REFRESH_INTERVAL, True)
+
+    def _next_window(self) -> Window:
+        with self._lock:
+            while True:
+                # Only the window requested last is being shown, refreshing the
+                # windows that were passed through on the way there is wasted work
+                for window_id in self._scheduled.keys() - {self._latest}:
+                    del self._scheduled[window_id]
+                    self.coalesced += 1
+
+                if self._latest not in self._scheduled:
+                    self._wakeup.wait()
+                    continue
+                due, window = self._scheduled[self._latest]
+                now = time.monotonic()
+                if due > now:
+                    self._wakeup.wait(due - now)
+                    continue
+
+                del self._scheduled[window.id]
+                self._last_refresh[window.id] = now
+                self.refreshes += 1
+                return window
+
+    def _run(self) -> None:
+        while True:
+            window = self._next_window()
+            try:
+                status = self._refresh(window)
+            except Exception as e:
+                print(f"Could not collect status of window {window.id}: {e}")
+                continue
+            with self._lock:
+                if self._snapshots.get(window.id) != status:
+                    self._snapshots[window.id] = status
+                    self._changed = True
+
+    def _refresh(self, window: Window) -> Dict[str, List[Element]]:
+        assert self._executor is not None
+        segments = _enabled_segments()
+        now = time.monotonic()
+        running = []
+        for segment in segments:
+            key = (segment.name, window.id if segment.per_window else None)
+            with self._lock:
+                if key in self._computing:
+                    continue
+                if now - self._computed_at.get(key, -math.inf) < segment.interval:
+                    continue
+                self._computing.add(key)
+            future = self._executor.submit(self._compute, segment, key, window)
+            running.append((future, now + segment.timeout))
+
+        # Segments that run out of time keep showing their last known value, and
+        # their result is picked up by the next refresh
+        for future, deadline in running:
+            concurrent.futures.wait([future], max(0.0, deadline - time.monotonic()))
+
+        status = {}
+        with self._lock:
+            for segment in segments:
+                key = (segment.name, window.id if segment.per_window else None)
+                elements = self._segments.get(key)
+                status[segment.name] = (
+                    elements if elements is not None else segment.fallback()
+                )
+        return status
+
+    def _compute(
+        self, segment: StatusSegment, key: Tuple[str, Optional[int]], window: Window
+    ) -> None:
+        try:
+            elements = phase_timer.timed(segment.name, segment.compute, window)
+        except Exception as e:
+            print(f"Could not compute status segment {segment.name}: {e}")
+            elements = segment.fallback()
+        with self._lock:
+            self._segments[key] = elements
+            self._computed_at[key] = time.monotonic()
+            self._computing.discard(key)
+
+    def _on_timer(self, timer_id: Optional[int] = None) -> None:
+        boss: Boss = get_boss()
+        active_window = boss.active_window
+        if active_window is not None:
+            self.request_refresh(active_window)
+        if PROFILE_TAB_BAR:
+            phase_timer.dump_if_requested()
+
+        with self._lock:
+            # Forget about windows that have been closed
+            for window_id in self._snapshots.keys() - boss.window_id_map.keys():
+                del self._snapshots[window_id]
+            for window_id in self._last_refresh.keys() - boss.window_id_map.keys():
+                del self._last_refresh[window_id]
+            for key in list(self._segments):
+                if key[1] is not None and key[1] not in boss.window_id_map:
+                    del self._segments[key]
+                    self._computed_at.pop(key, None)
+            changed, self._changed = self._changed, False
+
+        if changed:
+            for tab_manager in boss.all_tab_managers:
+                tab_manager.mark_tab_bar_dirty()
+
+
+status_collector = StatusCollector()
+
+
+def _draw_rhs_status(
+    screen: Screen,
+    tab: TabBarData,
+    before: int,
+    index: int,
+    plan: RenderPlan,
+    end: int,
+    status: Dict[str, List[Element]],
+    is_running_pager: bool,
+) -> None:
+    elements = list()
+    if is_running_pager:
+        elements.append({"title": "", "icon": PAGER_ICON, "accented": True})
+    for segment_elements in status.values():
+        elements.extend(segment_elements)
+
+    # Move cursor horizontally so that right-hand side status is right-aligned
+    opts = get_options()
+    rhs_status_len = _calc_elements_len(elements)
+    if opts.tab_bar_align == "center":
+        screen.cursor.x = math.ceil(screen.columns / 2 + end / 2) - rhs_status_len
+    else:  # opts.tab_bar_align == "left"
+        screen.cursor.x = screen.columns - rhs_status_len
+
+    for element in elements:
+        _draw_element(
+            element["title"],
+            screen,
+            tab,
+            before,
+            100,
+            index,
+            plan,
+            filled=RHS_STATUS_FILLED,
+            padded=False,
+            accented=element["accented"],
+            icon=element["icon"],
+            soft_sep=PADDING if element is not elements[-1] else None,
+        )
 
 
 def draw_tab(
@@ -1198,25 +3992,10 @@ def draw_tab(
         int: Cursor positions after drawing current tab.
     """
 
-    opts = get_options()
-    colors = {}
-
-    # Base foreground and background colors
-    colors["fg"] = as_rgb(color_as_int(draw_data.inactive_fg))
-    colors["bg"] = as_rgb(color_as_int(draw_data.default_bg))
-
-    # Foreground, background and icon background colors for filled tabs
-    colors["filled_fg"] = as_rgb(color_as_int(draw_data.active_fg))
-    colors["filled_bg"] = as_rgb(color_as_int(draw_data.active_bg))
-    colors["filled_icon_bg"] = as_rgb(color_as_int(FILLED_ICON_BG_COLOR))
-
-    # Foreground, background and icon background colors for accented tabs
-    colors["accented_fg"] = as_rgb(color_as_int(draw_data.active_fg))
-    colors["accented_bg"] = as_rgb(color_as_int(ACCENTED_BG_COLOR))
-    colors["accented_icon_bg"] = as_rgb(color_as_int(ACCENTED_ICON_BG_COLOR))
+    if PROFILE_TAB_BAR and index == 1:
+        phase_timer.begin_frame()
 
-    # Inter-tab separator color
-    colors["soft_sep_fg"] = as_rgb(color_as_int(SOFT_SEP_COLOR))
+    plan = phase_timer.timed("render_plan", _get_render_plan, draw_data)
 
     soft_sep = None
     if DRAW_SOFT_SEP:
@@ -1225,17 +4004,17 @@ def draw_tab(
             soft_sep = SOFT_SEP if both_inactive else PADDING
 
     # Draw main tabs
-    end = _draw_element(
+    end = phase_timer.timed(
+        "draw_tabs",
+        tab_layout_cache.draw,
         draw_data,
         screen,
         tab,
         before,
         max_tab_length,
         index,
-        colors,
-        filled=tab.is_active,
-        padded=PADDED_TABS,
-        soft_sep=soft_sep,
+        plan,
+        soft_sep,
     )
 
     # Draw right-hand side status
@@ -1244,41 +4023,22 @@ def draw_tab(
         active_window = boss.active_window
         assert isinstance(active_window, Window)
 
-        is_running_pager = _is_running_pager(active_window)
-        sys_info = _get_system_info(active_window)
-        user, host, is_ssh = sys_info["user"], sys_info["host"], sys_info["is_ssh"]
-        git_info = _get_git_info(active_window, is_ssh)
-        is_git_repo, branch = git_info["is_git_repo"], git_info["branch"]
-
-        elements = list()
-        if is_running_pager:
-            elements.append({"title": "", "icon": PAGER_ICON, "accented": True})
-        if is_git_repo:
-            elements.append({"title": branch, "icon": BRANCH_ICON, "accented": False})
-        elements.append({"title": user, "icon": USER_ICON, "accented": is_ssh})
-        elements.append({"title": host, "icon": HOST_ICON, "accented": is_ssh})
-
-        # Move cursor horizontally so that right-hand side status is right-aligned
-        rhs_status_len = _calc_elements_len(elements)
-        if opts.tab_bar_align == "center":
-            screen.cursor.x = math.ceil(screen.columns / 2 + end / 2) - rhs_status_len
-        else:  # opts.tab_bar_align == "left"
-            screen.cursor.x = screen.columns - rhs_status_len
-
-        for element in elements:
-            _draw_element(
-                element["title"],
-                screen,
-                tab,
-                before,
-                100,
-                index,
-                colors,
-                filled=RHS_STATUS_FILLED,
-                padded=False,
-                accented=element["accented"],
-                icon=element["icon"],
-                soft_sep=PADDING if element is not elements[-1] else None,
-            )
+        is_running_pager = phase_timer.timed("pager", _is_running_pager, active_window)
+        status = phase_timer.timed("snapshot", status_collector.snapshot, active_window)
+        phase_timer.timed(
+            "draw_status",
+            _draw_rhs_status,
+            screen,
+            tab,
+            before,
+            index,
+            plan,
+            end,
+            status,
+            is_running_pager,
+        )
+
+        if PROFILE_TAB_BAR:
+            phase_timer.end_frame()
 
     return end
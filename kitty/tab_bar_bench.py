@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Benchmarks for tab_bar.py that run outside of kitty.
+
+The kitty modules imported by tab_bar.py are replaced by minimal stand-ins, and fake
+Screen, DrawData, TabBarData, ExtraData, Boss and Window objects are used to render full
+tab bars the way kitty does, one draw_tab() call per tab.
+
+Usage: ./tab_bar_bench.py [GIT_REPO_DIR]
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+TAB_BAR_FILE = Path(__file__).with_name("tab_bar.py")
+
+TAB_COUNTS = (1, 10, 100, 500)
+SCREEN_COLUMNS = 250
+FRAMES = 200
+SSH_CONFIG_HOSTS = 2000
+
+Color = namedtuple("Color", "red green blue")
+
+
+class Cursor:
+    def __init__(self) -> None:
+        self.x = 0
+        self.y = 0
+        self.fg = 0
+        self.bg = 0
+        self.bold = False
+        self.italic = False
+
+
+class Screen:
+    def __init__(self, columns: int) -> None:
+        self.columns = columns
+        self.cursor = Cursor()
+        self.cells: List[str] = []
+
+    def draw(self, text: str) -> None:
+        self.cells.append(text)
+        self.cursor.x += len(text)
+
+    def reset(self) -> None:
+        self.cursor = Cursor()
+        self.cells.clear()
+
+
+class DrawData:
+    def __init__(self) -> None:
+        self.active_fg = Color(255, 255, 255)
+        self.active_bg = Color(69, 69, 69)
+        self.inactive_fg = Color(255, 255, 255)
+        self.inactive_bg = Color(48, 48, 48)
+        self.default_bg = Color(48, 48, 48)
+        self.title_template = "󰨸 {index} {title}"
+        self.active_title_template = "󰅍 {index} {title}"
+
+
+class TabBarData:
+    def __init__(self, tab_id: int, title: str, is_active: bool) -> None:
+        self.tab_id = tab_id
+        self.title = title
+        self.is_active = is_active
+        self.needs_attention = False
+        self.num_windows = 1
+        self.layout_name = "tall"
+        self.has_activity_since_last_focus = False
+
+
+class ExtraData:
+    def __init__(self) -> None:
+        self.prev_tab: Optional[TabBarData] = None
+        self.next_tab: Optional[TabBarData] = None
+        self.for_layout = False
+
+
+class Child:
+    def __init__(self, cmdline: List[str]) -> None:
+        self.argv = cmdline
+        self.foreground_processes = [{"pid": 1000, "cmdline": cmdline}]
+        self.foreground_environ = {"VIRTUAL_ENV": "/home/user/project/.venv"}
+
+
+class Window:
+    def __init__(self, window_id: int, cwd: str, cmdline: List[str]) -> None:
+        self.id = window_id
+        self.cwd_of_child = cwd
+        self.child = Child(cmdline)
+        self.child_is_remote = cmdline[0] == "ssh"
+        self.user_vars: Dict[str, str] = {}
+
+    def ssh_kitten_cmdline(self) -> List[str]:
+        return []
+
+
+class TabManager:
+    def mark_tab_bar_dirty(self) -> None:
+        pass
+
+
+class Boss:
+    def __init__(self) -> None:
+        self.active_window: Optional[Window] = None
+        self.window_id_map: Dict[int, Window] = {}
+        self.all_tab_managers = [TabManager()]
+
+
+boss = Boss()
+
+
+def _draw_title(
+    draw_data: DrawData,
+    screen: Screen,
+    tab: TabBarData,
+    index: int,
+    max_title_length: int = 0,
+) -> None:
+    template = draw_data.title_template
+    if tab.is_active:
+        template = draw_data.active_title_template
+    screen.draw(template.format(index=index, title=tab.title))
+
+
+def _install_kitty_stubs() -> None:
+    modules: Dict[str, Dict[str, Any]] = {
+        "kitty": {},
+        "kitty.boss": {"Boss": Boss},
+        "kitty.constants": {
+            "cache_dir": tempfile.gettempdir,
+            "runtime_dir": tempfile.gettempdir,
+        },
+        "kitty.fast_data_types": {
+            "Color": Color,
+            "Screen": Screen,
+            "add_timer": lambda callback, interval, repeats: 0,
+            "get_boss": lambda: boss,
+            "get_options": lambda: SimpleNamespace(tab_bar_align="left"),
+        },
+        "kitty.tab_bar": {
+            "Dict": Dict,
+            "DrawData": DrawData,
+            "ExtraData": ExtraData,
+            "TabBarData": TabBarData,
+            "as_rgb": lambda x: (x << 8) | 2,
+            "draw_title": _draw_title,
+        },
+        "kitty.utils": {
+            "color_as_int": lambda c: (c.red << 16) | (c.green << 8) | c.blue
+        },
+        "kitty.window": {"Window": Window},
+    }
+    for name, attrs in modules.items():
+        module = ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+def _load_tab_bar() -> ModuleType:
+    _install_kitty_stubs()
+    spec = importlib.util.spec_from_file_location("tab_bar", TAB_BAR_FILE)
+    assert spec is not None and spec.loader is not None
+    tab_bar = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tab_bar)
+    return tab_bar
+
+
+def _timeit(func: Callable[[], Any], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+def _percentiles(samples: List[float]) -> str:
+    samples = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1e6
+
+    return (
+        f"p50 {at(0.50):9.1f}  p90 {at(0.90):9.1f}  "
+        f"p99 {at(0.99):9.1f}  max {at(1.0):9.1f} us"
+    )
+
+
+def _write_ssh_config(path: str, hosts: int) -> None:
+    with open(path, "w") as f:
+        for i in range(hosts):
+            f.write(f"Host host{i} host{i}.example.com\n")
+            f.write(f"    HostName 10.0.{i // 256}.{i % 256}\n")
+            f.write(f"    User user{i}\n")
+            f.write("    IdentityFile ~/.ssh/id_%h\n\n")
+        f.write("Host *\n    ServerAliveInterval 60\n")
+
+
+def _make_windows(git_dir: str, local_dir: str) -> Dict[str, Window]:
+    return {
+        "local": Window(1, local_dir, ["zsh"]),
+        "git": Window(2, git_dir, ["zsh"]),
+        "ssh": Window(3, local_dir, ["ssh", "-tt", f"host{SSH_CONFIG_HOSTS // 2}"]),
+    }
+
+
+def _wait_for_snapshot(tab_bar: ModuleType, window: Window) -> None:
+    tab_bar.status_collector.snapshot(window)
+    deadline = time.monotonic() + 10
+    while window.id not in tab_bar.status_collector._snapshots:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"No status snapshot for window {window.id}")
+        time.sleep(0.01)
+
+
+def check_git_status_format(tab_bar: ModuleType) -> None:
+    status = {"dirty": False, "ahead": 0, "behind": 0, "stash": 0}
+    dirty, ahead = tab_bar.GIT_DIRTY_MARK, tab_bar.GIT_AHEAD_MARK
+    stash = tab_bar.GIT_STASH_MARK
+    for changes, expected in (
+        ({}, ""),
+        ({"dirty": True}, dirty),
+        # Clean but ahead: no leading space
+        ({"ahead": 1}, f"{ahead}1"),
+        ({"stash": 3}, f"{stash}3"),
+        ({"dirty": True, "ahead": 2}, f"{dirty} {ahead}2"),
+    ):
+        formatted = tab_bar._format_git_status({**status, **changes})
+        assert formatted == expected, (changes, formatted)
+    assert tab_bar._format_git_status(None) == ""
+    print("Git status format: ok")
+
+
+def bench_git_info(tab_bar: ModuleType, cwd: str, iterations: int = 200) -> None:
+    window = Window(100, cwd, ["zsh"])
+
+    def read_git_branch() -> None:
+        git_dir = tab_bar._find_git_dir(cwd)
+        if git_dir is not None:
+            tab_bar._read_git_head(git_dir)
+
+    print(f"Git branch detection in {cwd} ({tab_bar._get_git_info(window, None)})")
+    subprocess_time = _timeit(lambda: tab_bar._run_git_branch(cwd), iterations)
+    print(f"  git subprocess: {subprocess_time * 1e6:10.1f} us/call")
+    resolver_time = _timeit(read_git_branch, iterations)
+    print(f"  read HEAD:      {resolver_time * 1e6:10.1f} us/call")
+    cached_time = _timeit(lambda: tab_bar._get_git_info(window, None), iterations)
+    print(f"  _get_git_info:  {cached_time * 1e6:10.1f} us/call (cached)")
+    print(f"  speedup:        {subprocess_time / cached_time:10.1f}x")
+
+
+def bench_collect_status(
+    tab_bar: ModuleType, windows: Dict[str, Window], iterations: int = 50
+) -> None:
+    # This work happens on the status collector thread, not on the draw path
+    print("Status collection (background thread)")
+    for name, window in windows.items():
+        cold_time = _timeit(lambda: tab_bar._collect_status(window), 1)
+        warm_time = _timeit(lambda: tab_bar._collect_status(window), iterations)
+        print(
+            f"  {name:6} window: {cold_time * 1e6:10.1f} us first call, "
+            f"{warm_time * 1e6:10.1f} us/call afterwards"
+        )
+
+
+def bench_draw(
+    tab_bar: ModuleType, windows: Dict[str, Window], quiet: bool = False
+) -> None:
+    draw_data = DrawData()
+    screen = Screen(SCREEN_COLUMNS)
+
+    if not quiet:
+        print(f"Tab bar rendering ({FRAMES} frames, {SCREEN_COLUMNS} columns)")
+    for name, window in windows.items():
+        boss.active_window = window
+        boss.window_id_map = {window.id: window}
+        _wait_for_snapshot(tab_bar, window)
+
+        for num_tabs in TAB_COUNTS:
+            tabs = [
+                TabBarData(i, f"tab {i}", i == num_tabs // 2) for i in range(num_tabs)
+            ]
+            extra_data = [ExtraData() for _ in tabs]
+            for i, extra in enumerate(extra_data):
+                extra.prev_tab = tabs[i - 1] if i > 0 else None
+                extra.next_tab = tabs[i + 1] if i + 1 < num_tabs else None
+            max_tab_length = max(1, SCREEN_COLUMNS // num_tabs)
+
+            frame_times, tab_times = [], []
+            for _ in range(FRAMES):
+                screen.reset()
+                frame_start = time.perf_counter()
+                for i, tab in enumerate(tabs):
+                    tab_start = time.perf_counter()
+                    tab_bar.draw_tab(
+                        draw_data,
+                        screen,
+                        tab,
+                        screen.cursor.x,
+                        max_tab_length,
+                        i + 1,
+                        i + 1 == num_tabs,
+                        extra_data[i],
+                    )
+                    tab_times.append(time.perf_counter() - tab_start)
+                frame_times.append(time.perf_counter() - frame_start)
+
+            if not quiet:
+                print(f"  {name:6} window, {num_tabs:3} tabs")
+                print(f"    per frame: {_percentiles(frame_times)}")
+                print(f"    per tab:   {_percentiles(tab_times)}")
+
+
+def bench_tab_switching(
+    tab_bar: ModuleType, windows: Dict[str, Window], switches: int = 200
+) -> None:
+    # Flip through the windows faster than they can be refreshed, then settle on one
+    collector = tab_bar.status_collector
+    for window in windows.values():
+        _wait_for_snapshot(tab_bar, window)
+    time.sleep(tab_bar.STATUS_MIN_REFRESH_INTERVAL)
+    refreshes, coalesced = collector.refreshes, collector.coalesced
+
+    cycle = list(windows.values())
+    start = time.perf_counter()
+    for i in range(switches):
+        collector.snapshot(cycle[i % len(cycle)])
+        time.sleep(0.005)
+    burst_time = time.perf_counter() - start
+    time.sleep(tab_bar.STATUS_MIN_REFRESH_INTERVAL + tab_bar.STATUS_REFRESH_DEBOUNCE)
+
+    print(f"Tab switching ({switches} switches in {burst_time * 1e3:.0f} ms)")
+    print(f"  status refreshes: {collector.refreshes - refreshes:6}")
+    print(f"  coalesced:        {collector.coalesced - coalesced:6}")
+
+
+def bench_phases(tab_bar: ModuleType, windows: Dict[str, Window]) -> None:
+    # Render with the tab bar's own instrumentation enabled, and print its timings
+    tab_bar.PROFILE_TAB_BAR = True
+    bench_draw(tab_bar, windows, quiet=True)
+    for window in windows.values():
+        tab_bar._collect_status(window)
+    with tempfile.NamedTemporaryFile("r", suffix=".txt") as f:
+        tab_bar.phase_timer.dump(f.name)
+        print("Phase timings")
+        print(f.read())
+
+
+def main() -> None:
+    tab_bar = _load_tab_bar()
+    git_dir = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ssh_config_file = os.path.join(tmp_dir, "ssh_config")
+        _write_ssh_config(ssh_config_file, SSH_CONFIG_HOSTS)
+        tab_bar.SSH_CONFIG_FILE = ssh_config_file
+        tab_bar.cache_dir = lambda: tmp_dir
+        windows = _make_windows(git_dir, tmp_dir)
+
+        check_git_status_format(tab_bar)
+        bench_git_info(tab_bar, git_dir)
+        bench_collect_status(tab_bar, windows)
+        bench_draw(tab_bar, windows)
+        bench_tab_switching(tab_bar, windows)
+        bench_phases(tab_bar, windows)
+
+
+if __name__ == "__main__":
+    main()